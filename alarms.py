@@ -0,0 +1,214 @@
+"""Alarms: any number of them, each starting a task of its own at a time of day
+
+An alarm goes off on some days of the week, or once on a date. Times are
+local to the scheduler's time zone, and are turned into absolute timestamps
+with zoneinfo when they are scheduled, so a daylight saving time change is
+taken into account then, instead of by waking up early to check again.
+A time which is skipped when the clocks go forward is taken to be as long
+after the change (02:30 becomes 03:30), and a time which happens twice when
+they go back goes off the first time.
+
+The scheduler keeps the next timestamp of every enabled alarm in a heap,
+and its thread sleeps until the first one (or until the alarms change).
+It only reads the time through its clock, so it can be fast-forwarded:
+run_due(now) fires everything due by then, and returns the next deadline.
+With a lead time, the scheduler also calls on_prepare that long before
+each alarm goes off, so its task can be made ready to start."""
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+import zoneinfo
+
+log = logging.getLogger("neocontrol.scheduler.alarms")
+
+DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"] # in the order of date.weekday()
+DEFAULT_TASK = "sunrise" # Task of an alarm which doesn't say
+MAX_WAIT = 60.0 # Longest sleep in seconds, so a step of the system clock (NTP on a Pi without a clock) is noticed
+
+def parse_time(text: str):
+    """Time of day from HH:MM[:SS[.ffffff]], where the hour may have a single digit (7:15)"""
+    if not isinstance(text, str):
+        raise TypeError("time must be a string")
+    hour, _, rest = text.partition(':')
+    return datetime.time.fromisoformat('0' + text if len(hour) == 1 and rest else text)
+
+class Alarm:
+    """One alarm: when it goes off, and the task it starts then"""
+
+    def __init__(self, alarm_id: int, name: str, time_of_day: datetime.time, days: list = DAYS, date: datetime.date = None,
+                 task: str = DEFAULT_TASK, arg=None, zone: str = None, enabled: bool = True):
+        if any(day not in DAYS for day in days):
+            raise ValueError(f"Alarm {name}: days must be some of {', '.join(DAYS)}")
+        if time_of_day.tzinfo is not None:
+            raise ValueError(f"Alarm {name}: the time is in the scheduler's time zone, it can't have one of its own")
+        self.id = alarm_id
+        self.name = name
+        self.time = time_of_day
+        self.days = [day for day in DAYS if day in days]
+        self.date = date     # a one-off alarm, days don't matter then
+        self.task = task
+        self.arg = arg
+        self.zone = zone     # the default zone if None
+        self.enabled = enabled
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Create an alarm from its JSON description (see as_dict)"""
+        try:
+            if not isinstance(data, dict):
+                raise TypeError("an alarm must be an object")
+            days = data.get("days", DAYS)
+            if not isinstance(days, list):
+                raise TypeError("days must be a list")
+            return cls(None if data.get("id") is None else int(data["id"]), str(data.get("name") or "Alarm"),
+                       parse_time(data["time"]), [str(day).lower() for day in days],
+                       datetime.date.fromisoformat(data["date"]) if data.get("date") else None,
+                       str(data.get("task") or DEFAULT_TASK), data.get("arg"), data.get("zone") or None,
+                       bool(data.get("enabled", True)))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid alarm {data}: {e}") from e
+
+    def as_dict(self):
+        """JSON description of the alarm"""
+        precise = self.time.second or self.time.microsecond
+        return {"id": self.id, "name": self.name, "time": self.time.isoformat("auto" if precise else "minutes"),
+                "days": self.days, "date": self.date.isoformat() if self.date else None,
+                "task": self.task, "arg": self.arg, "zone": self.zone, "enabled": self.enabled}
+
+    def next_time(self, after: float, timezone: datetime.tzinfo):
+        """Timestamp of the first time the alarm goes off after the timestamp after, None if it never does"""
+        if not self.enabled:
+            return None
+        if self.date is not None:
+            dates = [self.date]
+        else:
+            # The same time next week is always a candidate, unless there are no days
+            today = datetime.datetime.fromtimestamp(after, timezone).date()
+            dates = [today + datetime.timedelta(days) for days in range(8)]
+        for date in dates:
+            if DAYS[date.weekday()] in self.days or self.date is not None:
+                # (converted through UTC, times in the same zone are compared by the clock on the wall)
+                when = datetime.datetime.combine(date, self.time, timezone).timestamp()
+                if when > after:
+                    return when
+        return None
+
+class AlarmScheduler:
+    """Fires alarms at their times, from a thread of its own (see run())
+
+    on_alarm(alarm, when) is called when an alarm goes off, with the
+    timestamp it was due at. A one-off alarm is disabled before that.
+    on_prepare(alarm, when) is called lead_time seconds before, or straight
+    away if the alarm is added (or changed) later than that."""
+
+    def __init__(self, timezone: str, on_alarm, clock=time.time, on_prepare=None, lead_time: float = 0.0):
+        self.timezone = zoneinfo.ZoneInfo(timezone)
+        self.on_alarm = on_alarm
+        self.on_prepare = on_prepare
+        self.lead_time = lead_time
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.alarms = {}  # by ID
+        # (timestamp, sequence number, alarm, None) of the next time of every enabled alarm,
+        # and (timestamp, sequence number, alarm, its time) of when to prepare it
+        self.heap = []
+        self.sequence = itertools.count()
+        self.ids = itertools.count(1)
+
+    def push(self, alarm: Alarm, after: float):
+        """Schedule the next time of an alarm (with the lock held)
+        Entries of alarms which have been changed or removed since are left in the heap, and skipped when they come up"""
+        # Don't let them pile up, if the alarms keep being changed
+        if len(self.heap) > 2 * len(self.alarms) + 16:
+            self.heap = [entry for entry in self.heap if self.current(entry[2])]
+            heapq.heapify(self.heap)
+        when = alarm.next_time(after, self.timezone)
+        if when is not None:
+            heapq.heappush(self.heap, (when, next(self.sequence), alarm, None))
+            if self.on_prepare is not None and self.lead_time > 0:
+                heapq.heappush(self.heap, (when - self.lead_time, next(self.sequence), alarm, when))
+
+    def current(self, alarm: Alarm):
+        """Whether an alarm from the heap is still the one with its ID (with the lock held)"""
+        return self.alarms.get(alarm.id) is alarm
+
+    def add(self, alarm: Alarm):
+        """Add an alarm, or replace the one with its ID, returns it (with an ID if it had none)"""
+        with self.condition:
+            if alarm.id is None:
+                alarm.id = next(self.ids)
+            else:
+                # Later alarms never reuse the ID of a loaded one
+                self.ids = itertools.count(max(alarm.id + 1, next(self.ids)))
+            self.alarms[alarm.id] = alarm
+            self.push(alarm, self.clock())
+            self.condition.notify()
+        return alarm
+
+    def remove(self, alarm_id: int):
+        """Remove an alarm, raises KeyError if there is no such alarm"""
+        with self.condition:
+            del self.alarms[alarm_id]
+            self.condition.notify()
+
+    def get(self, alarm_id: int):
+        with self.condition:
+            return self.alarms[alarm_id]
+
+    def list(self):
+        """Every alarm, by ID"""
+        with self.condition:
+            return [self.alarms[alarm_id] for alarm_id in sorted(self.alarms)]
+
+    def peek(self):
+        """First entry of the heap (an alarm to fire or prepare) which is still current, or None (with the lock held)"""
+        while self.heap and not self.current(self.heap[0][2]):
+            heapq.heappop(self.heap)
+        return self.heap[0] if self.heap else None
+
+    def next_times(self):
+        """Timestamp of the next time of every enabled alarm, by ID"""
+        with self.condition:
+            return {alarm.id: when for when, _, alarm, prepare in self.heap if prepare is None and self.current(alarm)}
+
+    def run_due(self, now: float = None):
+        """Fire every alarm which is due by now (the clock's time by default), returns the next deadline or None"""
+        now = self.clock() if now is None else now
+        fired = []
+        with self.condition:
+            while (upcoming := self.peek()) is not None and upcoming[0] <= now:
+                when, _, alarm, prepare = heapq.heappop(self.heap)
+                if prepare is not None:
+                    fired.append((self.on_prepare, alarm, prepare))
+                    continue
+                if alarm.date is not None:
+                    alarm = self.alarms[alarm.id] = Alarm.from_dict({**alarm.as_dict(), "enabled": False})
+                else:
+                    # From when it was due, so an alarm which is late still goes off the next time
+                    self.push(alarm, when)
+                fired.append((self.on_alarm, alarm, when))
+            upcoming = self.peek()
+        for callback, alarm, when in fired:
+            try:
+                callback(alarm, when)
+            except Exception: # pylint: disable=broad-except
+                log.error("Alarm %s (%s) failed", alarm.id, alarm.name, exc_info=True)
+        return upcoming[0] if upcoming else None
+
+    def run(self):
+        """Fire alarms as they come due, forever"""
+        while True:
+            with self.condition:
+                # Sleep until the first deadline, again after every change
+                while (upcoming := self.peek()) is None or upcoming[0] > (now := self.clock()):
+                    log.debug("Next alarm in %s s", None if upcoming is None else round(upcoming[0] - now, 3))
+                    self.condition.wait(MAX_WAIT if upcoming is None else min(upcoming[0] - now, MAX_WAIT))
+            self.run_due()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="alarms", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,139 @@
+"""Benchmark every task against the emulated strip
+
+Each task renders a fixed number of frames at several LED counts, without
+any frame pacing and without waiting for the (emulated) wire. For every
+task and LED count this reports frames per second, render time percentiles,
+memory allocated per frame (traced with tracemalloc) and the peak RSS of
+the process so far.
+
+    python bench.py                         # run and print the results
+    python bench.py --save bench.json       # store the results as a baseline
+    python bench.py --baseline bench.json   # fail if a task got slower than the baseline
+
+A task has regressed when its frames per second drop by more than the
+threshold (25% by default) compared to the baseline, so baselines should
+be recorded on the machine they are compared on.
+"""
+import argparse
+import json
+import random
+import resource
+import sys
+import time
+import tracemalloc
+import numpy as np
+from tasks import TaskRegistry
+from tasks.common import EmulatedPixelStrip, FrameBuffer, ColorCorrection
+from tasks.timeline import wait_for_compiles
+
+LED_COUNTS = [60, 360, 1500, 5000]
+FRAMES = 200
+FRAME_TIME = 0.01 # Seconds of animation between frames
+# Parameters of the tasks which need some (the others run with their defaults)
+TASK_ARGS = {"static": {"color": [255, 255, 255]}}
+
+def run_frames(render, strip, buffer, correction, frames, times=None):
+    """Render and show up to frames frames, returns how many were rendered"""
+    for frame in range(frames):
+        render_start = time.perf_counter()
+        running = render(frame * FRAME_TIME, FRAME_TIME, buffer)
+        if times is not None:
+            times.append(time.perf_counter() - render_start)
+        buffer.show(strip, correction)
+        if not running:
+            return frame + 1
+    return frames
+
+def bench_task(task, params, num_pixels, frames):
+    """Benchmark one task at one LED count, with its parameters"""
+    # The same random numbers every run, so runs can be compared
+    np.random.seed(0)
+    random.seed(0)
+    strip = EmulatedPixelStrip(num_pixels, verbose=False)
+    # Only measure the CPU time, not the time the frame would spend on the wire
+    strip.wire_time = 0.0
+    buffer = FrameBuffer(num_pixels)
+    # Frames go through the colour correction, like they do on their way to the real strip
+    correction = ColorCorrection()
+    # Measure playing back compiled timelines, not compiling them
+    # (a task may only start its compile on its first frame, like sunset)
+    task(num_pixels, params)(0.0, FRAME_TIME, FrameBuffer(num_pixels))
+    wait_for_compiles()
+    render = task(num_pixels, params)
+    render_times = []
+    start = time.perf_counter()
+    rendered = run_frames(render, strip, buffer, correction, frames, render_times)
+    total_time = time.perf_counter() - start
+
+    # Second pass with tracemalloc, which slows everything down
+    render = task(num_pixels, params)
+    tracemalloc.start()
+    allocated = []
+    for frame in range(rendered):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        render(frame * FRAME_TIME, FRAME_TIME, buffer)
+        buffer.show(strip, correction)
+        # Peak rather than current, so temporaries freed within the frame count too
+        allocated.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    percentiles = np.percentile(np.array(render_times) * 1000, [50, 90, 99])
+    return {
+        "frames": rendered,
+        "fps": rendered / total_time,
+        "render_ms": {"p50": percentiles[0], "p90": percentiles[1], "p99": percentiles[2]},
+        "alloc_kb_per_frame": float(np.mean(allocated)) / 1024,
+        # Linux reports kilobytes
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def compare(results, baseline, threshold):
+    """List the regressions of results compared to baseline"""
+    regressions = []
+    for name, counts in results.items():
+        for count, result in counts.items():
+            base = baseline.get(name, {}).get(count)
+            if base and result["fps"] < base["fps"] * (1 - threshold):
+                regressions.append(f"{name} @ {count} LEDs: {result['fps']:.0f} fps, baseline {base['fps']:.0f} fps")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every task against the emulated strip")
+    parser.add_argument("--tasks", nargs="*", help="only these tasks")
+    parser.add_argument("--leds", nargs="*", type=int, default=LED_COUNTS, help="LED counts to run at")
+    parser.add_argument("--frames", type=int, default=FRAMES, help="frames per task and LED count")
+    parser.add_argument("--baseline", help="JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="fraction of the baseline fps a task may lose")
+    parser.add_argument("--save", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    tasks = TaskRegistry()
+    names = sorted(args.tasks or tasks.names())
+    results = {}
+    print(f"{'task':18s} {'LEDs':>5s} {'fps':>9s} {'p50 ms':>8s} {'p90 ms':>8s} {'p99 ms':>8s} {'KB/frame':>9s} {'RSS MB':>7s}")
+    for name in names:
+        results[name] = {}
+        for count in args.leds:
+            result = bench_task(tasks[name], tasks.params(name, TASK_ARGS.get(name)), count, args.frames)
+            # JSON keys are strings, so use strings here too
+            results[name][str(count)] = result
+            render_ms = result["render_ms"]
+            print(f"{name:18s} {count:5d} {result['fps']:9.0f} {render_ms['p50']:8.3f} {render_ms['p90']:8.3f} "
+                  f"{render_ms['p99']:8.3f} {result['alloc_kb_per_frame']:9.1f} {result['peak_rss_mb']:7.1f}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
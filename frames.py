@@ -0,0 +1,48 @@
+"""Frames pushed over HTTP, decoded straight into a zone's frame
+
+Every update is binary, in the same layout as the preview messages:
+    byte 0      b'F' for a frame, b'D' for single pixels, or b'R' for runs of one colour
+    then, for b'F', 3 bytes (R, G, B) per pixel from the first one (a short frame leaves the rest as they were)
+    or, for b'D', 5 bytes per pixel: its index (little endian) and R, G, B
+    or, for b'R', 7 bytes per run: its first pixel and length (little endian), and R, G, B
+Pixels which aren't in an update keep the colour they had, so a client only
+has to send what changed. Every update is applied with one indexing operation.
+"""
+import numpy as np
+
+PIXEL_DTYPE = np.dtype([("index", "<u2"), ("rgb", "u1", 3)])
+RUN_DTYPE = np.dtype([("start", "<u2"), ("length", "<u2"), ("rgb", "u1", 3)])
+
+def apply_update(pixels, update: bytes):
+    """Apply an update to an (N,3) array of 16-bit levels (like FrameBuffer), returns the number of pixels it sets
+    Raises ValueError if the update is malformed or goes past the end of the frame"""
+    kind, body = update[:1], memoryview(update)[1:]
+    if kind == b'F':
+        if len(body) % 3 or len(body) // 3 > len(pixels):
+            raise ValueError(f"A frame must be 3 bytes per pixel, for at most {len(pixels)} pixels")
+        rgb = np.frombuffer(body, dtype=np.uint8).reshape(-1, 3)
+        # 8-bit colours are stored as 8.8 fixed point
+        pixels[:len(rgb)] = rgb.astype(np.uint16) << 8
+        return len(rgb)
+    if kind == b'D':
+        if len(body) % PIXEL_DTYPE.itemsize:
+            raise ValueError(f"Pixel updates must be {PIXEL_DTYPE.itemsize} bytes each")
+        updates = np.frombuffer(body, dtype=PIXEL_DTYPE)
+        if len(updates) and updates["index"].max() >= len(pixels):
+            raise ValueError(f"Pixel index past the end of the frame ({len(pixels)} pixels)")
+        pixels[updates["index"]] = updates["rgb"].astype(np.uint16) << 8
+        return len(updates)
+    if kind == b'R':
+        if len(body) % RUN_DTYPE.itemsize:
+            raise ValueError(f"Runs must be {RUN_DTYPE.itemsize} bytes each")
+        runs = np.frombuffer(body, dtype=RUN_DTYPE)
+        starts = runs["start"].astype(np.intp)
+        lengths = runs["length"].astype(np.intp)
+        if len(runs) and (starts + lengths).max() > len(pixels):
+            raise ValueError(f"Run past the end of the frame ({len(pixels)} pixels)")
+        # Index of every pixel of every run: each run's start, plus how far into the run it is
+        total = int(lengths.sum())
+        offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        pixels[np.repeat(starts, lengths) + offsets] = np.repeat(runs["rgb"].astype(np.uint16) << 8, lengths, axis=0)
+        return total
+    raise ValueError("An update must start with F, D or R")
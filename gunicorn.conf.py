@@ -0,0 +1,35 @@
+# Gunicorn settings for neocontrol: gunicorn -c gunicorn.conf.py
+# The strips are driven by one engine process (python neocontrol.py engine),
+# which the master starts before the workers, and stops when it exits.
+# The workers are stateless: they send every command to the engine over
+# its Unix domain socket, so there can be as many of them as needed.
+# Each /api/v1/events subscriber keeps a thread busy while it waits for
+# events, so use a threaded worker with room for plenty of idle subscribers.
+# Only max_event_subscribers of a worker's threads may serve them, so open
+# tabs can't starve the API: past that a subscriber gets 503 and tries again
+# later. Across all workers that's workers * max_event_subscribers streams.
+import os
+import subprocess
+import sys
+
+wsgi_app = "neocontrol:create_app()"
+bind = "0.0.0.0:5000"
+workers = 2
+worker_class = "gthread"
+threads = 64
+max_event_subscribers = threads // 2
+raw_env = ["ENGINE_MODE=remote", f"MAX_EVENT_SUBSCRIBERS={max_event_subscribers}"]
+
+engine = None
+
+def on_starting(server):
+    global engine
+    # (raw_env is set in the master too, but the engine drives the strips itself)
+    engine = subprocess.Popen([sys.executable, "neocontrol.py", "engine"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              env={**os.environ, "ENGINE_MODE": "local"})
+    server.log.info("Started the engine process (pid %s)", engine.pid)
+
+def on_exit(server):
+    if engine is not None:
+        engine.terminate()
+        engine.wait(10)
@@ -0,0 +1,204 @@
+"""Command socket between the web workers and the engine, the one process which drives the strips
+
+Messages go over a Unix domain socket, each one framed as:
+    bytes 0-3   length of the rest of the message, big endian
+    byte 4      b'M' for a msgpack body, b'J' for JSON, or b'B' for raw bytes
+    then the body
+msgpack is used when it's installed, JSON otherwise. A message is decoded
+by its own tag, so the two sides don't have to agree on the codec.
+
+A request is {"cmd": name, "args": {...}}, and the reply is {"ok": result}
+or {"error": message, "status": HTTP status}. Commands which return bytes
+(like a preview frame) are answered with a b'B' message instead. A request
+with binary data (like a frame to show) has "payload": true, and is followed
+by a b'B' message with the data, which the command gets as its payload.
+A "subscribe" request turns the connection into a stream of
+{"event": name, "data": ...} messages, which lasts until it is closed."""
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+# msgpack is smaller and faster to decode, but optional
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+log = logging.getLogger("neocontrol.engine.ipc")
+
+HEADER = struct.Struct(">IB")
+MAX_MESSAGE = 16 * 1024 * 1024 # Longest message accepted, so a broken peer can't make us allocate gigabytes
+
+class CommandError(Exception):
+    """A command which failed, with the HTTP status to answer with"""
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+def encode(message):
+    """Frame a message: bytes are sent as they are, anything else with msgpack (or JSON)"""
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        tag, body = b'B', bytes(message)
+    elif msgpack is not None:
+        tag, body = b'M', msgpack.packb(message)
+    else:
+        tag, body = b'J', json.dumps(message, separators=(',', ':')).encode()
+    return HEADER.pack(len(body) + 1, tag[0]) + body
+
+def recv_exactly(sock: socket.socket, size: int):
+    """Read size bytes, raises ConnectionError if the peer goes away first"""
+    data = bytearray(size)
+    view = memoryview(data)
+    while size:
+        received = sock.recv_into(view[-size:], size)
+        if not received:
+            raise ConnectionError("Connection closed")
+        size -= received
+    return data
+
+def recv_message(sock: socket.socket):
+    """Read one message"""
+    length, tag = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    if not 1 <= length <= MAX_MESSAGE:
+        raise ConnectionError(f"Invalid message length {length}")
+    body = recv_exactly(sock, length - 1)
+    if tag == ord('B'):
+        return bytes(body)
+    if tag == ord('M'):
+        if msgpack is None:
+            raise ConnectionError("Got a msgpack message, but msgpack isn't installed")
+        return msgpack.unpackb(body)
+    if tag == ord('J'):
+        return json.loads(body)
+    raise ConnectionError(f"Invalid message tag {tag}")
+
+def send_message(sock: socket.socket, message):
+    sock.sendall(encode(message))
+
+class EngineServer:
+    """Serves commands on a Unix domain socket, one thread per connection
+
+    commands maps each command name to a function, which is called with the
+    request's arguments. subscribe(send) is called for "subscribe" requests,
+    and keeps sending events with send() until that fails."""
+
+    def __init__(self, path: str, commands: dict, subscribe):
+        self.path = path
+        self.commands = commands
+        self.subscribe = subscribe
+        # The socket of an engine which has gone is left behind, the hardware lock says we're the only one now
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(64)
+
+    def serve_forever(self):
+        log.info("Listening on %s (%s)", self.path, "msgpack" if msgpack else "JSON")
+        while True:
+            connection, _ = self.sock.accept()
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+
+    def handle(self, connection: socket.socket):
+        """Answer the requests of one connection until it is closed"""
+        with connection:
+            try:
+                while True:
+                    request = recv_message(connection)
+                    command, args = request.get("cmd"), request.get("args") or {}
+                    if request.get("payload"):
+                        args["payload"] = recv_message(connection)
+                    if command == "subscribe":
+                        self.subscribe(lambda message: send_message(connection, message))
+                        return
+                    send_message(connection, self.run(command, args))
+            except (ConnectionError, OSError):
+                pass # the client went away
+
+    def run(self, command: str, args: dict):
+        """Run a command, returns the reply"""
+        if command not in self.commands:
+            return {"error": f"Unknown command {command}", "status": 400}
+        try:
+            result = self.commands[command](**args)
+        except CommandError as e:
+            return {"error": str(e), "status": e.status}
+        except Exception as e: # pylint: disable=broad-except
+            log.error("Command %s failed", command, exc_info=True)
+            return {"error": f"{command} failed: {e}", "status": 500}
+        if isinstance(result, bytes):
+            return result
+        return {"ok": result}
+
+class EngineClient:
+    """Sends commands to the engine, over one connection per thread (reopened when it breaks)"""
+
+    def __init__(self, path: str, connect_timeout: float = 30.0):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self.local = threading.local()
+
+    def connect(self, timeout: float = None):
+        """New connection, retrying while the engine is starting up"""
+        deadline = time.monotonic() + (self.connect_timeout if timeout is None else timeout)
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise CommandError(f"The engine isn't running ({self.path}): {e}", 503) from e
+                time.sleep(0.1)
+
+    def call(self, command: str, payload: bytes = None, **args):
+        """Run a command in the engine, returns its result or raises CommandError"""
+        message = encode({"cmd": command, "args": args, "payload": payload is not None})
+        if payload is not None:
+            # Both messages in one write
+            message += encode(payload)
+        # A connection left over from before an engine restart can't be sent on, so try a new one once
+        # (but never send a command again once it has gone out, the engine may have run it)
+        for attempt in range(2):
+            sent = False
+            sock = getattr(self.local, "sock", None)
+            if sock is None:
+                sock = self.local.sock = self.connect()
+            try:
+                sock.sendall(message)
+                sent = True
+                reply = recv_message(sock)
+                break
+            except (ConnectionError, OSError) as e:
+                sock.close()
+                self.local.sock = None
+                if attempt or sent:
+                    raise CommandError(f"Lost the connection to the engine: {e}", 503) from e
+        if isinstance(reply, bytes):
+            return reply
+        if "error" in reply:
+            raise CommandError(reply["error"], reply.get("status", 500))
+        return reply["ok"]
+
+    def subscribe(self, timeout: float):
+        """Events from the engine, as (name, data), on a connection of their own
+        Yields None after timeout seconds without an event, and for the engine's keepalives (an event without a name)"""
+        sock = self.connect()
+        try:
+            send_message(sock, {"cmd": "subscribe"})
+            while True:
+                # Wait for the start of a message, once it's there the rest follows
+                readable, _, _ = select.select([sock], [], [], timeout)
+                if not readable:
+                    yield None
+                    continue
+                message = recv_message(sock)
+                yield None if message["event"] is None else (message["event"], message["data"])
+        finally:
+            sock.close()
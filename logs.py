@@ -0,0 +1,120 @@
+"""Logging for neocontrol: leveled, non-blocking and rate-limited
+
+Every part of neocontrol logs to a component logger (or a child of one):
+    neocontrol.engine       the strips, tasks, compositor and engine socket
+    neocontrol.scheduler    the alarm
+    neocontrol.api          the web API
+Only the processes which serve them set up the logging. Without it (e.g.
+in bench.py) only warnings and errors are shown, by Python's default.
+
+Log calls only put the record on a queue. A listener thread formats it
+(the message's % arguments are only merged in then) and writes it out, so
+a slow stdout (like journald) never holds up the thread which logged. A render
+process logs straight to stdout instead (see setup_direct_logging).
+
+Each component may log RATE_LIMIT records per second on average, in bursts
+of up to RATE_BURST. Records over that are dropped and counted, and the
+count is logged with the next record which gets through. Warnings and
+errors are never dropped.
+
+LOG_LEVEL=DEBUG brings back the full detail: thread names, locks, the
+alarm scheduler's wake-ups, and so on."""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper() # DEBUG for everything, INFO for what happens, WARNING for problems only
+RATE_LIMIT = float(os.environ.get("LOG_RATE_LIMIT", 20)) # Records per second each component may log on average (below WARNING)
+RATE_BURST = 50 # Records a component may log at once, before the rate limit applies
+
+listener = None
+
+class RateLimit(logging.Filter):
+    """Token bucket per component, drops the records of a component which logs too much"""
+
+    def __init__(self, rate: float = RATE_LIMIT, burst: int = RATE_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {} # [tokens, last refill, records dropped] by component
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+        # neocontrol.engine.tasks counts towards neocontrol.engine
+        component = ".".join(record.name.split(".")[:2])
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.setdefault(component, [self.burst, now, 0])
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            dropped, bucket[2] = bucket[2], 0
+        if dropped:
+            record.dropped = dropped
+        return True
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are, so the message is formatted by the listener thread, not the caller"""
+
+    def prepare(self, record):
+        return record
+
+class Formatter(logging.Formatter):
+    """The timestamp format neocontrol has always used, plus the number of records dropped before this one"""
+
+    def __init__(self):
+        super().__init__("[%(asctime)s.%(msecs)03d] %(levelname)s %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S")
+
+    def format(self, record):
+        message = super().format(record)
+        dropped = getattr(record, "dropped", 0)
+        if dropped:
+            message += f" ({dropped} earlier messages of {'.'.join(record.name.split('.')[:2])} dropped by the rate limit)"
+        return message
+
+def setup_logging(level: str = None, stream=None):
+    """Send all logging through the queue to stream (stdout), once per process"""
+    global listener
+    if listener is not None:
+        return
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(Formatter())
+    records = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(records)
+    queue_handler.addFilter(RateLimit())
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(level or LOG_LEVEL)
+    # The werkzeug dev server logs every request, which is too much below DEBUG
+    if root.level > logging.DEBUG:
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging)
+
+def setup_direct_logging(level: str = None, stream=None):
+    """Log straight to stream (stdout), rate-limited like setup_logging, in a process which can't count on exiting
+    cleanly to write out a queue (a render process, which is terminated)"""
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(Formatter())
+    handler.addFilter(RateLimit())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level or LOG_LEVEL)
+
+def stop_logging():
+    """Write out the records still in the queue, e.g. before the process exits"""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
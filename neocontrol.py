@@ -1,271 +1,1018 @@
-import importlib
-from flask import Flask, request, jsonify, render_template
+"""LED strip controller: a web API and frontend for the tasks running on the strip
+
+Importing this module is cheap: nothing touches the strip until the app is
+created with create_app() (gunicorn runs "neocontrol:create_app()"), which
+starts the hardware in a background thread so the web server can answer
+straight away. NumPy, the frame pipeline and the tasks are imported by that
+thread, and API requests wait for it to finish.
+
+Only one process may drive the strips, the one holding HARDWARE_LOCK_FILE.
+Usually that is the web server itself (ENGINE_MODE=local). To serve the API
+from several processes (gunicorn workers), the strips are driven by a
+separate engine process instead, and the workers (ENGINE_MODE=remote) send
+it commands over a Unix domain socket (see ipc.py).
+
+python neocontrol.py             runs the dev web server
+python neocontrol.py engine      runs the engine process
+python neocontrol.py profile     reports import times and the time to the first HTTP response"""
+import fcntl
+import itertools
+import logging
+from flask import Flask, Blueprint, Response, current_app, request, jsonify, render_template
 import threading
-import schedule
 import datetime
 import json
 import os
+import signal
+import subprocess
 import sys
+import time
 from tzlocal import get_localzone_name
-from tasks.common import ws
+from alarms import Alarm, AlarmScheduler
+from tasks import Params, TaskRegistry, check_params
+from ipc import CommandError, EngineClient, EngineServer
+from logs import setup_logging
+from state import StateStore, read_json, write_json
 
-# Create instance of the Flask app
-app = Flask(__name__, static_folder='static', static_url_path='')
+# Check if flask_sock is available, the live preview needs it
+try:
+    from flask_sock import Sock
+except ImportError:
+    Sock = None
 
+engine_log = logging.getLogger("neocontrol.engine")
+scheduler_log = logging.getLogger("neocontrol.scheduler")
+api_log = logging.getLogger("neocontrol.api")
 
-# Load alarm data from the file, or set the default alarm
-ALARM_FILE = "alarm.json"
+# The API and the frontend, registered on the app by create_app()
+routes = Blueprint('neocontrol', __name__)
+
+STATE_FILE = "state.json" # Alarms, the task of every zone and the brightness, kept across restarts (see state.py)
+ALARM_FILE = "alarm.json" # Alarms from before the state file, which are moved into it
 TIMEZONE = os.environ.get("TIMEZONE") or os.environ.get("TZ") or get_localzone_name()
-DEFAULT_DAYS = [
-    "monday",
-    "tuesday",
-    "wednesday",
-    "thursday",
-    "friday",
-    "saturday",
-    "sunday",
-]
-if os.path.exists(ALARM_FILE):
-    with open(ALARM_FILE, 'r') as f:
-        alarm_data = json.load(f)
-    if "days" not in alarm_data:
-        alarm_data["days"] = DEFAULT_DAYS
-else:
-    alarm_data = {"time": "06:30", "enabled": True, "days": DEFAULT_DAYS}
-    with open(ALARM_FILE, 'w') as f:
-        json.dump(alarm_data, f)
-
-worker_thread : threading.Thread = None                    # This thread controls the LEDs
-current_task : str = None                     # Name of the currently running task
+scheduler = None # AlarmScheduler, created when the hardware starts
+store = None # StateStore of STATE_FILE, loaded when the hardware starts
+
+# Function to load the alarms from the state, or set the default alarm
+# An alarm file from before there could be several alarms is a single alarm (time, days and enabled), which starts the sunrise
+# An alarm which can't be read is left out (and so dropped from the state), instead of keeping the engine from starting
+def load_alarms():
+    global scheduler
+    scheduler = AlarmScheduler(TIMEZONE, alarm_triggered, on_prepare=prepare_alarm, lead_time=ALARM_LEAD_TIME)
+    alarms = store.get("alarms")
+    if alarms is None:
+        data = read_json(ALARM_FILE)
+        alarms = [{"time": "06:30"}] if data is None else data["alarms"] if isinstance(data, dict) and "alarms" in data else [data]
+    if not isinstance(alarms, list):
+        scheduler_log.warning("Ignoring the alarms, they aren't a list: %s", alarms)
+        alarms = []
+    for alarm in alarms:
+        try:
+            scheduler.add(Alarm.from_dict(alarm))
+        except ValueError as e:
+            scheduler_log.warning("Skipping an alarm: %s", e)
+    save_alarms()
+
+# Function to save the alarms (the state store writes them out soon after)
+def save_alarms():
+    store.set("alarms", [alarm.as_dict() for alarm in scheduler.list()])
+
+worker_threads = {}                     # These threads control the LEDs, one per zone
+current_tasks = {}                      # Name of the task running in each zone
+task_args = {}                          # Parameters (a Params, see tasks) or argument of the task running in each zone
+alarm_tasks = {}                        # ID of the alarm which started the task running in each zone (not there if it was asked for)
 task_lock = threading.Lock()            # so only one worker at a time modifies which task is running
-alarm_lock = threading.Lock()           # so only one worker at a time modifies alarm data
-exit_event = threading.Event()          # to quit worker thread
-alarm_update_event = threading.Event()  # to update alarm time or enabled status
+alarm_lock = threading.Lock()           # so only one worker at a time modifies the alarms (and saves them)
+exit_events = {}                        # to quit the worker thread of each zone (a new event for every worker)
+zone_stats = {}                         # frame counters and latencies of the task running in each zone
+external_frames = {}                    # frame of each zone which shows pushed frames, which updates apply to
+prepared_alarms = {}                    # task of each alarm which is about to go off, made ready to start (see prepare_alarm), by alarm ID
+alarm_starts = {}                       # how quickly each alarm started its task the last time it went off, by alarm ID
+task_requests = {}                      # recent task switch requests, by request ID
+pending_requests = {}                   # the newest task switch request of each zone which hasn't been started yet
+request_condition = threading.Condition() # so only one worker at a time modifies task requests, and to wake up the task controller
+request_ids = itertools.count(1)        # IDs for task switch requests
+MAX_TASK_REQUESTS = 100                 # how many task requests are remembered for status queries
+event_streams = set()                   # one EventStream per connected /api/v1/events subscriber
+event_lock = threading.Lock()           # so only one worker at a time modifies event_streams
+EVENT_KEEPALIVE = 15.0                  # seconds between keepalive comments on idle event streams
+
+# Server-Sent Events
+class EventStream:
+    """Events waiting to be sent to one subscriber
+    Events are snapshots of state, so only the newest one of each kind is kept:
+    a slow subscriber skips the states it missed instead of piling them up"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.events = {}
+
+    def put(self, name, data):
+        with self.condition:
+            self.events[name] = data
+            self.condition.notify()
+
+    def get(self, timeout):
+        """Wait for events, returns them as (name, data) (an empty list on timeout)"""
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+            events = list(self.events.items())
+            self.events.clear()
+            return events
+
+def format_event(name, data):
+    """Format an event in the text/event-stream format"""
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+# Function to send an event to every subscriber
+def publish_event(name, data):
+    with event_lock:
+        for stream in event_streams:
+            stream.put(name, data)
 
 LED_COUNT = 120 * 3
 GPIO_PIN = 10 # Pin to which the LED strip is connected
-STRIP_TYPE = ws.WS2811_STRIP_GRB
-BRIGHTNESS = 255 # 0-255
+STRIP_TYPE = "WS2811_STRIP_GRB" # Name of the strip type constant in rpi_ws281x
+BRIGHTNESS = int(os.environ.get("BRIGHTNESS", 255)) # 0-255, master brightness at the first start (after that, the last one set is kept)
+GAMMA = float(os.environ.get("GAMMA", 1.0)) # 1.0 sends the colours as the tasks render them
+DITHER = os.environ.get("DITHER", "1") != "0" # Temporal dithering of the fractions the 8-bit strip can't show
 TARGET_FREQ = 1200000 # Found empirically
 DMA = GPIO_PIN # Because the DMA channel is connected to the GPIO pin
+TARGET_FPS = float(os.environ.get("TARGET_FPS", 100)) # Frames per second the render loop aims for
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "threaded") # "threaded" (double buffered) or "sync"
+EXECUTION_MODE = os.environ.get("EXECUTION_MODE", "thread") # "thread", or "process" to render tasks in a child process
+KEEPALIVE_INTERVAL = 10.0 # Seconds after which an unchanged frame is sent to the strip again
+TRANSITION_TIME = float(os.environ.get("TRANSITION_TIME", 1.0)) # Seconds of cross-fade when switching tasks, 0 to switch straight away
+ALARM_LEAD_TIME = float(os.environ.get("ALARM_LEAD_TIME", 30)) # Seconds before an alarm goes off that its task is made ready to start, 0 not to
+TASK_POLL_INTERVAL = float(os.environ.get("TASK_POLL_INTERVAL", 2.0)) # Seconds between checks of the tasks directory for changed tasks, 0 to not check
+# Physical strips, zones refer to them by their position in this list (channel)
+# A second strip would go on a PWM1 pin, e.g. {"count": 120, "pin": 13, "dma": 11, "pwm_channel": 1}
+STRIPS = [{"count": LED_COUNT, "pin": GPIO_PIN, "dma": DMA, "pwm_channel": 0}]
+ZONES_FILE = "zones.json"
+# Unless zones.json says otherwise, the whole strip is one zone
+DEFAULT_ZONES = [{"name": "main", "channel": 0, "start": 0, "length": LED_COUNT}]
+DEFAULT_TASK = "fairy_lights" # Task started in the default zone when the hardware starts
+FRAME_TASK = "frame" # Shown as the task of a zone which shows frames pushed to /api/v1/frame
+# Lock file held by the process which drives the strips, so a second process (e.g. another gunicorn worker) can't
+HARDWARE_LOCK_FILE = os.environ.get("HARDWARE_LOCK_FILE", "neocontrol.lock")
+HARDWARE_TIMEOUT = 30.0 # Seconds an API request waits for the hardware (or the engine process) to start
+ENGINE_MODE = os.environ.get("ENGINE_MODE", "local") # "local" to drive the strips in this process, "remote" to send commands to the engine process
+ENGINE_SOCKET = os.environ.get("ENGINE_SOCKET", "neocontrol.sock") # Unix domain socket of the engine process
+# /api/v1/events streams a web process serves at once, more get 503: each one holds a thread (see gunicorn.conf.py)
+MAX_EVENT_SUBSCRIBERS = int(os.environ.get("MAX_EVENT_SUBSCRIBERS", 32))
+event_subscribers = threading.BoundedSemaphore(MAX_EVENT_SUBSCRIBERS)
 
-# Create NeoPixel object with appropriate configuration
-strip = ws.PixelStrip(LED_COUNT, GPIO_PIN, TARGET_FREQ, DMA, invert=False, brightness=BRIGHTNESS, strip_type=STRIP_TYPE)
-# Intialize the library (must be called once before other functions)
-strip.begin()
-
-# Load available tasks from the tasks directory
-TASKS = {}
-for task_file in os.listdir('tasks'):
-    if task_file.endswith('.py') and task_file not in ['__init__.py', 'common.py']:
-        # Get the name of the task from the filename
-        task_name = task_file.split('.')[0]
-        # Import the module
-        module = importlib.import_module(f'tasks.{task_name}')
-        # Add the task to the dictionary
-        TASKS[task_name] = getattr(module, task_name)
-
-# Function to stop the worker thread
-def stop_worker_thread():
-    global worker_thread, exit_event
-    print(f"[{datetime.datetime.now()}] stop_worker_thread() thread: {threading.get_ident()} {threading.current_thread().name}")
+strips = []             # set up when the hardware starts
+outputs = []
+compositor = None
+hardware_ready = threading.Event()  # set once the hardware has started (or failed to)
+hardware_error = None               # why the hardware failed to start
+hardware_lock = threading.Lock()    # so the hardware is only started once
+hardware_lock_file = None           # kept open for as long as the process runs, which holds the lock
+
+# Function returning the zone which tasks run in when no zone is given (the first one)
+def default_zone():
+    return compositor.zones[0].name
+
+# Function to set up the strips, their output stages and the compositor
+def start_strips():
+    global compositor
+    # The frame pipeline needs NumPy, which is slow to import, so it's only imported now
+    from tasks.common import ws, OutputStage, ColorCorrection # pylint: disable=import-outside-toplevel
+    from tasks.compositor import Compositor, Zone # pylint: disable=import-outside-toplevel
+    for config in STRIPS:
+        # Create NeoPixel object with appropriate configuration
+        # The strip always runs at full brightness, the master brightness is applied by the colour correction
+        strip = ws.PixelStrip(config["count"], config["pin"], TARGET_FREQ, config["dma"], invert=False, brightness=255,
+                              channel=config["pwm_channel"], strip_type=getattr(ws, STRIP_TYPE))
+        # Intialize the library (must be called once before other functions)
+        strip.begin()
+        strips.append(strip)
+        # Rendered frames go to the strip through the output stage
+        outputs.append(OutputStage(strip, threaded=OUTPUT_MODE == "threaded", keepalive=KEEPALIVE_INTERVAL,
+                                   correction=ColorCorrection(brightness=store.get("brightness", BRIGHTNESS), gamma=GAMMA, dither=DITHER)))
+    # Load the zones, and composite them onto the strips
+    zone_data = read_json(ZONES_FILE) or DEFAULT_ZONES
+    compositor = Compositor(outputs, [Zone.from_dict(zone) for zone in zone_data], TARGET_FPS)
+
+# Available tasks from the tasks directory, which are only imported when they are first started
+TASKS = TaskRegistry()
+
+# Function to stop the worker thread of a zone
+def stop_worker_thread(zone):
+    engine_log.debug("stop_worker_thread(%s) thread: %s %s", zone, threading.get_ident(), threading.current_thread().name)
+    worker_thread = worker_threads.get(zone)
     if worker_thread and worker_thread.is_alive():
-        print(f"[{datetime.datetime.now()}] stop_worker_thread: setting exit event")
+        exit_event = exit_events[zone]
+        engine_log.debug("stop_worker_thread: setting exit event")
         # Sent the exit event to the worker thread
         exit_event.set()
         # Wait for the worker thread to finish
         # All tasks should periodically check for the exit event and exit gracefully
         # Python doesn't have a way to kill threads, so this is the best we can do
-        print(f"[{datetime.datetime.now()}] stop_worker_thread: joining worker thread")
+        engine_log.debug("stop_worker_thread: joining worker thread")
         worker_thread.join()
         # The worker thread should have exited by now
-        print(f"[{datetime.datetime.now()}] stop_worker_thread: worker thread joined")
-        # Unset the exit event, so a new worker thread can be started again
-        exit_event.clear()
-    print(f"[{datetime.datetime.now()}] stop_worker_thread: done")
-
-# Function which is called when the alarm is triggered
-def alarm_triggered():
-    global worker_thread, current_task, alarm_data, alarm_lock, task_lock, exit_event, strip
-    print(f"[{datetime.datetime.now()}] alarm_triggered() thread: {threading.get_ident()} {threading.current_thread().name}")
-    enabled = False
-    # Check if the alarm is enabled
-    with alarm_lock:
-        enabled = alarm_data["enabled"]
-        print(f"[{datetime.datetime.now()}] alarm_triggered: alarm enabled: {enabled}")
-    # If the alarm is not enabled, there is nothing to do. Otherwise:
-    if enabled:
-        print(f"[{datetime.datetime.now()}] alarm_triggered: enabled")
+        engine_log.debug("stop_worker_thread: worker thread joined")
+    engine_log.debug("stop_worker_thread: done")
+
+# Function returning the available tasks (sorted) and whether each has been loaded, as sent in tasks events
+# details has the load time (ms) and the last load error of each task, its parameters and the task it's a preset of
+def tasks_state():
+    return {"tasks": TASKS.names(), "details": TASKS.status()}
+
+# Function returning the master brightness, as sent in brightness events
+def brightness_state():
+    correction = outputs[0].correction
+    return {"brightness": correction.brightness, "gamma": correction.gamma, "dither": correction.dither}
+
+# Function returning the current task (and its parameters) and the pending task of every zone, as sent in task events
+# task, arg and pending are the ones of the default zone
+def task_state():
+    with request_condition:
+        zones = {}
+        for zone in compositor.zones:
+            pending_request = pending_requests.get(zone.name)
+            arg = task_args.get(zone.name)
+            zones[zone.name] = {"task": current_tasks.get(zone.name), "arg": dict(arg) if isinstance(arg, dict) else arg,
+                                "pending": pending_request["task"] if pending_request else None}
+        return {**zones[default_zone()], "zones": zones}
+
+# Function returning the layout of the zones and their tasks, as sent in zones events
+def zones_state():
+    zones = [{**zone.as_dict(), "task": current_tasks.get(zone.name)} for zone in compositor.zones]
+    return {"channels": [strip.numPixels() for strip in strips], "zones": zones}
+
+# Function returning the details of an alarm, with when it goes off next (None if it doesn't)
+def alarm_details(alarm, next_time, now):
+    return {**alarm.as_dict(),
+            "next_time": datetime.datetime.fromtimestamp(next_time, scheduler.timezone).isoformat(timespec="seconds") if next_time else None,
+            "time_until_alarm": next_time - now if next_time else None, "last_start": alarm_starts.get(alarm.id)}
+
+# Function returning every alarm, and which one goes off next and when, as sent in alarms events
+def alarm_state():
+    now = time.time()
+    next_times = scheduler.next_times()
+    upcoming = min(next_times, key=next_times.get, default=None)
+    return {"alarms": [alarm_details(alarm, next_times.get(alarm.id), now) for alarm in scheduler.list()],
+            "next": upcoming, "time_until_alarm": next_times[upcoming] - now if upcoming else None}
+
+# Function to get a task ready to start in a zone: imported (or the new version of it, if it has changed), with its
+# parameters (the defaults of its preset and the ones in arg) and its render callback set up
+# A task which fails to load fails here, before anything about the zone has changed
+# (in a render process, the process sets the task up itself)
+def set_up_task(task, arg, zone):
+    function = TASKS[task]
+    params = TASKS.params(task, arg)
+    render = None if EXECUTION_MODE == "process" else function(len(compositor.zone(zone)), params)
+    return {"function": function, "params": params, "render": render}
+
+# Function to start a task which has been set up (ready, see set_up_task) in a new worker thread for a zone
+# The old one must be stopped first, or be retired by a transition (then the task renders into the transition's layer)
+# A task with hand_over (an alarm's, see prepare_alarm) has its first frame rendered and handed over straight away
+def start_worker_thread(task, ready, zone, layer=None, alarm_id=None):
+    from tasks.common import run_frames, run_in_process, FrameBuffer, FrameStats # pylint: disable=import-outside-toplevel
+    output = layer or compositor.zone(zone).layer
+    params = ready["params"]
+    current_tasks[zone] = task
+    task_args[zone] = params
+    if alarm_id is None:
+        alarm_tasks.pop(zone, None)
+    else:
+        alarm_tasks[zone] = alarm_id
+    # Each task gets fresh statistics
+    frame_stats = zone_stats[zone] = FrameStats()
+    exit_event = exit_events[zone] = threading.Event()
+    if EXECUTION_MODE == "process":
+        # The worker thread only passes on frames from a render process, which it terminates on exit
+        worker_thread = threading.Thread(target=run_in_process, args=(output, exit_event, TASKS.module(task), params, TARGET_FPS, frame_stats),
+                                         daemon=True)
+    elif ready.get("hand_over"):
+        # The first frame is rendered here, from what the zone shows now, and goes to the strip straight away
+        # The render loop carries on from it
+        start = time.monotonic()
+        buffer = FrameBuffer(len(compositor.zone(zone)))
+        buffer.pixels[:] = output.last_frame()
+        render_start = time.perf_counter()
+        ready["render"](0.0, 0.0, buffer)
+        frame_stats.add_render(time.perf_counter() - render_start)
+        output.submit(buffer, frame_stats)
+        frame_stats.add_first_frame()
+        worker_thread = threading.Thread(target=run_frames, args=(output, exit_event, ready["render"], TARGET_FPS, frame_stats,
+                                                                  buffer, start, params), daemon=True)
+    else:
+        # The render loop calls the render callback once per frame
+        worker_thread = threading.Thread(target=run_frames, args=(output, exit_event, ready["render"], TARGET_FPS, frame_stats),
+                                         kwargs={"params": params}, daemon=True)
+    worker_threads[zone] = worker_thread
+    worker_thread.start()
+    publish_event("task", task_state())
+
+# Function to switch the task of a zone
+# With a transition, the old task keeps running while the new one fades in over it, and is stopped afterwards
+# The new task is set up first (unless it has been prepared), so if it fails to load the old one keeps running
+# An alarm's task is marked as such (alarm_id), see tasks_changed
+def switch_task(task, arg=None, zone=None, transition=TRANSITION_TIME, prepared=None, alarm_id=None):
+    zone = zone or default_zone()
+    if compositor.zone(zone) is None:
+        raise ValueError(f"There is no zone {zone}")
+    ready = prepared or set_up_task(task, arg, zone)
+    if transition > 0:
+        engine_log.info("Zone %s: cross-fading to %s over %s seconds", zone, task, transition)
+        # (the old task may have finished already, then it's just its last frame which fades out)
+        retire = exit_events.get(zone, threading.Event()).set
+        layer = compositor.zone(zone).start_transition(transition, retire)
+        start_worker_thread(task, ready, zone, layer, alarm_id)
+    else:
+        engine_log.info("Zone %s: switching to %s", zone, task)
+        stop_worker_thread(zone)
+        start_worker_thread(task, ready, zone, alarm_id=alarm_id)
+
+# Function which is called (by the scheduler's thread) ALARM_LEAD_TIME seconds before an alarm goes off
+# It makes the alarm's task ready: imported and set up (which loads its compiled timeline, if it has one), so when the
+# alarm goes off only its first frame has to be rendered and handed over. That frame has to start from what the zone
+# shows then, not now, so the task is only warmed up by a copy of it rendering a frame (which starts a compile, and reads
+# the start of the timeline into memory)
+# (in a render process, the task is set up again by the process, but the import and the timeline are ready)
+def prepare_alarm(alarm, when):
+    from tasks.common import FrameBuffer # pylint: disable=import-outside-toplevel
+    start = time.perf_counter()
+    zone = compositor.zone(alarm.zone or default_zone())
+    if zone is None:
+        raise ValueError(f"There is no zone {alarm.zone}")
+    ready = set_up_task(alarm.task, alarm.arg, zone.name)
+    buffer = FrameBuffer(len(zone))
+    buffer.pixels[:] = zone.layer.last_frame()
+    ready["function"](len(zone), TASKS.params(alarm.task, alarm.arg))(0.0, 0.0, buffer)
+    prepared_alarms[alarm.id] = {**ready, "alarm": alarm, "zone": zone, "hand_over": True}
+    scheduler_log.info("Alarm %s (%s): %s is ready, in %.1f ms, %.1f s before its time",
+                       alarm.id, alarm.name, alarm.task, (time.perf_counter() - start) * 1000, when - time.time())
+
+# Function returning the prepared task of an alarm, if nothing it was made ready with has changed since
+def prepared_alarm(alarm):
+    prepared = prepared_alarms.pop(alarm.id, None)
+    if prepared is None:
+        return None
+    same = (prepared["alarm"].task, prepared["alarm"].arg, prepared["alarm"].zone) == (alarm.task, alarm.arg, alarm.zone)
+    if not same or compositor.zone(alarm.zone or default_zone()) is not prepared["zone"] or TASKS[alarm.task] is not prepared["function"]:
+        return None
+    return prepared
+
+# Function which is called (by the scheduler's thread) when an alarm goes off, when is the time it was due
+# Records how long it took until its task's first frame was handed over (start_ms), and was on the strip (photon_ms)
+def alarm_triggered(alarm, when):
+    trigger = time.monotonic()
+    due = trigger - (time.time() - when) # when, on the monotonic clock
+    try:
         with task_lock:
-            print(f"[{datetime.datetime.now()}] alarm_triggered: stopping worker thread")
-            stop_worker_thread()
-            print(f"[{datetime.datetime.now()}] alarm_triggered: preparing new worker thread")
-            current_task = "sunrise" # TODO: make this configurable
-            worker_thread = threading.Thread(target=TASKS[current_task], args=(strip, exit_event), daemon=True)
-            print(f"[{datetime.datetime.now()}] alarm_triggered: starting new worker thread")
-            worker_thread.start()
-            print(f"[{datetime.datetime.now()}] alarm_triggered: worker thread started")
-    print(f"[{datetime.datetime.now()}] alarm_triggered: done")
-
-# Initialize the alarm scheduler
-alarm_schedulers = []
-
-def schedule_alarm():
-    global alarm_schedulers
-    for job in alarm_schedulers:
-        schedule.cancel_job(job)
-    alarm_schedulers = []
-    for day in alarm_data["days"]:
-        job = getattr(schedule.every(), day).at(alarm_data["time"], tz=TIMEZONE).do(alarm_triggered)
-        alarm_schedulers.append(job)
-
-schedule_alarm()
-
-# Function which triggers the alarm on schedule
-def check_alarm():
-    global alarm_schedulers, alarm_update_event
-    print(f"[{datetime.datetime.now()}] check_alarm() thread: {threading.get_ident()} {threading.current_thread().name}")
-    # Never stop checking the alarm
+            prepared = prepared_alarm(alarm)
+            switch_task(alarm.task, alarm.arg, alarm.zone, prepared=prepared, alarm_id=alarm.id)
+            zone = compositor.zone(alarm.zone or default_zone())
+            stats = zone_stats[zone.name]
+        # Frames made after the first one was handed over have it in them
+        submitted = stats.first_frame if stats.started.wait(1.0) else None
+        shown = outputs[zone.channel].wait_shown(submitted, 1.0) if submitted else None
+        start_ms = round((submitted - due) * 1000, 3) if submitted else None
+        photon_ms = round((shown - due) * 1000, 3) if shown else None
+        alarm_starts[alarm.id] = {"time": when, "prepared": prepared is not None, "late_ms": round((trigger - due) * 1000, 3),
+                                  "start_ms": start_ms, "photon_ms": photon_ms}
+        scheduler_log.info("Alarm %s (%s): started %s (%s), first frame handed over after %s ms, on the strip after %s ms",
+                           alarm.id, alarm.name, alarm.task, "prepared" if prepared else "not prepared", start_ms, photon_ms)
+    finally:
+        # A one-off alarm has been disabled
+        if alarm.date is not None:
+            with alarm_lock:
+                save_alarms()
+        publish_event("alarms", alarm_state())
+
+# Function to queue a task switch in a zone, which is done by the task controller thread
+def queue_task(task, arg=None, zone=None, transition=TRANSITION_TIME):
+    with request_condition:
+        zone = zone or default_zone()
+        request = {"id": next(request_ids), "task": task, "arg": arg, "zone": zone, "transition": transition, "status": "queued"}
+        # Only the latest request for each zone matters, an older one which hasn't started yet is dropped
+        if zone in pending_requests:
+            pending_requests[zone]["status"] = "superseded"
+        pending_requests[zone] = request
+        task_requests[request["id"]] = request
+        # Forget the oldest requests
+        while len(task_requests) > MAX_TASK_REQUESTS:
+            del task_requests[next(iter(task_requests))]
+        request_condition.notify()
+        publish_event("task", task_state())
+    return request
+
+# Function which switches tasks as requested, so the HTTP requests don't have to wait for it
+def task_controller():
+    engine_log.debug("task_controller() thread: %s %s", threading.get_ident(), threading.current_thread().name)
     while True:
-        print(f"[{datetime.datetime.now()}] check_alarm: schedule queue: {schedule.jobs}")
-        print(f"[{datetime.datetime.now()}] check_alarm will run all pending jobs")
-        schedule.run_pending()
-        print(f"[{datetime.datetime.now()}] check_alarm ran all pending jobs")
-        print(f"[{datetime.datetime.now()}] check_alarm: schedule queue: {schedule.jobs}")
-        # Check how long until the next alarm
-        next_run = schedule.idle_seconds()
-        # Subtract an hour from long waits to avoid DST issues
-        if next_run > 3600:
-            next_run -= 3600
-        print(f"[{datetime.datetime.now()}] check_alarm will run again in {next_run} seconds")
-        # Wait until the next alarm or until the alarm is updated
-        alarm_update_event.wait(next_run)
-        if alarm_update_event.is_set():
-            print(f"[{datetime.datetime.now()}] check_alarm was woken up by alarm_update_event")
-            # Unset the event which woke up the thread, so it can be used again
-            alarm_update_event.clear()
-        else:
-            print(f"[{datetime.datetime.now()}] check_alarm was woken up by schedule")
-        print(f"[{datetime.datetime.now()}] check_alarm will run again")
-    # This should never be reached, because the loop is infinite and there is no break
-    # The check_alarm thread is daemonised, so it will stop only when the main thread stops
-    print(f"[{datetime.datetime.now()}] check_alarm: done")
-
-# Start the check_alarm thread
-# This thread will run forever, so it is daemonised
-# It will be stopped when the main thread stops
-# The check_alarm thread will check the alarm schedule and trigger the alarm when needed
-print(f"[{datetime.datetime.now()}] starting check_alarm thread")
-alarm_thread = threading.Thread(target=check_alarm, daemon=True)
-alarm_thread.start()
-print(f"[{datetime.datetime.now()}] check_alarm thread started")
-
-with task_lock:
-    stop_worker_thread()
-    current_task = "fairy_lights"
-    worker_thread = threading.Thread(target=TASKS[current_task], args=(strip, exit_event), daemon=True)
-    worker_thread.start()
+        with request_condition:
+            while not pending_requests:
+                request_condition.wait()
+            # Zones take turns, in the order their requests came in
+            request = pending_requests.pop(next(iter(pending_requests)))
+            request["status"] = "switching"
+        engine_log.debug("task_controller: switching zone %s to task %s (request %s)", request['zone'], request['task'], request['id'])
+        try:
+            with task_lock:
+                switch_task(request["task"], request["arg"], request["zone"], request["transition"])
+            status = "done"
+            save_task(request["zone"], request["task"], request["arg"])
+        except Exception: # pylint: disable=broad-except
+            engine_log.warning("Failed to start task %s in zone %s", request['task'], request['zone'], exc_info=True)
+            status = "failed"
+        with request_condition:
+            request["status"] = status
+        engine_log.debug("task_controller: request %s %s", request['id'], status)
 
-# Setting the alarm
-@app.route('/api/v1/alarm', methods=['POST'])
-def set_alarm():
-    global alarm_data, alarm_schedulers
-    data = request.get_json()
-    
-    print(f"[{datetime.datetime.now()}] set_alarm() thread: {threading.get_ident()} {threading.current_thread().name}")
-    print(f"[{datetime.datetime.now()}] set_alarm: entering alarm_lock")
-    # We will be modifying the alarm_data dictionary, so we need to lock it
+# Function to remember the task of a zone, which the zone starts with after a restart
+# Only tasks which were asked for are kept, not the ones alarms start (a restart shouldn't start a sunrise again)
+def save_task(zone, task, arg):
+    store.update("tasks", lambda tasks: {**(tasks or {}), zone: {"task": task, "arg": arg}})
+
+# Function to start the tasks the zones had before the restart, and the default task if the default zone had none
+# They start straight away, instead of cross-fading from the default task, but from the beginning (t=0, from a dark strip):
+# a task's own state isn't saved, only its name and parameters
+def restore_tasks():
+    saved = store.get("tasks") or {}
+    for zone in compositor.zones:
+        task = saved.get(zone.name)
+        if task is None and zone.name == default_zone():
+            task = {"task": DEFAULT_TASK, "arg": None}
+        if task is None:
+            continue
+        try:
+            switch_task(task["task"], task.get("arg"), zone.name, transition=0)
+        except Exception: # pylint: disable=broad-except
+            engine_log.warning("Failed to restore task %s in zone %s", task["task"], zone.name, exc_info=True)
+            if zone.name == default_zone() and task["task"] != DEFAULT_TASK:
+                switch_task(DEFAULT_TASK, zone=zone.name, transition=0)
+
+# Function which is called when tasks have been added, changed or removed in the tasks directory
+# Zones running a task which has changed switch to the new version of it (with a transition, as usual)
+# A task an alarm started keeps running the old version: starting it again would start a sunrise over, and save it as
+# the zone's task
+def tasks_changed(names):
+    engine_log.info("Tasks changed: %s", ", ".join(sorted(names)))
+    status = TASKS.status()
+    with task_lock:
+        changed = [zone for zone, task in current_tasks.items()
+                   if task in names and task in status and status[task]["loaded"] and status[task]["error"] is None
+                   and compositor.zone(zone) is not None]
+        restart = [zone for zone in changed if zone not in alarm_tasks]
+    for zone in set(changed) - set(restart):
+        engine_log.info("Zone %s keeps the old version of %s, which alarm %s started", zone, current_tasks[zone], alarm_tasks[zone])
+    for zone in restart:
+        queue_task(current_tasks[zone], task_args.get(zone), zone)
+    publish_event("tasks", tasks_state())
+
+# Function to take over the strips and start everything which runs in the background
+# Runs once per process, in the thread started by create_app()
+def start_hardware():
+    global hardware_error, hardware_lock_file, store
+    engine_log.debug("start_hardware() thread: %s %s", threading.get_ident(), threading.current_thread().name)
+    start = time.perf_counter()
+    try:
+        # Only one process may drive the strips: the first to lock the file, until it exits
+        hardware_lock_file = open(HARDWARE_LOCK_FILE, 'a')
+        try:
+            fcntl.flock(hardware_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError as e:
+            raise RuntimeError(f"Another process is driving the strips (it holds {HARDWARE_LOCK_FILE})") from e
+        store = StateStore(STATE_FILE)
+        start_strips()
+        load_alarms()
+        # The scheduler's thread sleeps until the next alarm, and runs forever (it's daemonised)
+        scheduler_log.debug("starting the alarm scheduler thread")
+        scheduler.start()
+        with task_lock:
+            restore_tasks()
+        # Start the task_controller thread, which runs forever
+        engine_log.debug("starting task_controller thread")
+        threading.Thread(target=task_controller, daemon=True).start()
+        # Watch the tasks directory for tasks which are added, changed or removed
+        if TASK_POLL_INTERVAL > 0:
+            TASKS.watch(TASK_POLL_INTERVAL, tasks_changed)
+        engine_log.info("Hardware started in %.3f s", time.perf_counter() - start)
+    except Exception as e: # pylint: disable=broad-except
+        engine_log.error("The hardware failed to start", exc_info=True)
+        hardware_error = e
+    hardware_ready.set()
+
+# Function to wait for the hardware to start, raises RuntimeError if it didn't
+def wait_for_hardware(timeout=HARDWARE_TIMEOUT):
+    if not hardware_ready.wait(timeout):
+        raise RuntimeError("The hardware is still starting")
+    if hardware_error is not None:
+        raise RuntimeError(f"The hardware failed to start: {hardware_error}")
+
+# Function to run the engine: the process which drives the strips, for web workers which can't (ENGINE_MODE=remote)
+# It answers their commands over ENGINE_SOCKET, see ipc.py
+def run_engine():
+    setup_logging()
+    # Exit cleanly when stopped (by gunicorn), so what's left of the state is saved on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_hardware()
+    if hardware_error is not None:
+        sys.exit(1)
+    EngineServer(ENGINE_SOCKET, COMMANDS, serve_events).serve_forever()
+
+# Engine commands: everything the API does to the engine, by name
+# Called directly when the engine runs in this process, or by the engine process for the web workers
+# Each one returns what the API responds with, or raises CommandError
+
+# Function to check the task (and its parameters) and zone of an alarm, which the alarm can't check itself
+def validate_alarm(alarm):
+    if alarm.task not in TASKS:
+        raise CommandError("Invalid task")
+    try:
+        TASKS.params(alarm.task, alarm.arg)
+    except (KeyError, ValueError) as e:
+        raise CommandError(f"Invalid parameters: {e}") from e
+    if alarm.zone is not None and compositor.zone(alarm.zone) is None:
+        raise CommandError("Invalid zone")
+    if alarm.date is not None and alarm.enabled and alarm.next_time(time.time(), scheduler.timezone) is None:
+        raise CommandError("Invalid alarm: its date has passed")
+
+def command_alarm(alarm_id):
+    try:
+        alarm = scheduler.get(alarm_id)
+    except KeyError as e:
+        raise CommandError("Unknown alarm", 404) from e
+    return alarm_details(alarm, scheduler.next_times().get(alarm_id), time.time())
+
+def command_create_alarm(data):
+    if not isinstance(data, dict):
+        raise CommandError("Invalid alarm")
+    try:
+        alarm = Alarm.from_dict({**data, "id": None})
+    except ValueError as e:
+        raise CommandError(str(e)) from e
+    validate_alarm(alarm)
+    # Adding and saving together, so the file never misses a change
     with alarm_lock:
-        print(f"[{datetime.datetime.now()}] set_alarm: entered alarm_lock")
-        # If the request contains the "time" key, we will update the alarm time
-        changed = False
-        if "time" in data:
-            # The supplied time must be in the format HH:MM
-            try:
-                print(f"[{datetime.datetime.now()}] set_alarm: setting alarm time to {data['time']}")
-                # Convert the time to HH:MM
-                alarm_data["time"] = datetime.datetime.strptime(data["time"], "%H:%M").strftime("%H:%M")
-                changed = True
-            except:
-                return jsonify({"error": "Invalid time format"}), 400
-        if "days" in data:
-            days = [d.lower() for d in data["days"]]
-            alarm_data["days"] = days
-            changed = True
-        # If the request contains the "enabled" key, we will update the alarm enabled state
-        if "enabled" in data:
-            alarm_data["enabled"] = data["enabled"]
-        if changed:
-            schedule_alarm()
-            print(f"[{datetime.datetime.now()}] set_alarm: setting alarm_update_event")
-            alarm_update_event.set()
-    print(f"[{datetime.datetime.now()}] set_alarm: exiting alarm_lock")
-
-    # Save the updated alarm data to the file
-    with open(ALARM_FILE, 'w') as f:
-        json.dump(alarm_data, f)
-
-    # Respond with the new alarm details, and the delay until the next alarm
-    return jsonify((alarm_data, {"time_until_alarm": schedule.idle_seconds()}))
-
-# Reading the alarm
-@app.route('/api/v1/alarm', methods=['GET'])
-def get_alarm():
-    # We will be reading the alarm_data dictionary, so we need to lock it
+        scheduler.add(alarm)
+        save_alarms()
+    api_log.info("Alarm %s (%s) added: %s", alarm.id, alarm.name, alarm.as_dict())
+    publish_event("alarms", alarm_state())
+    return command_alarm(alarm.id)
+
+# Only the settings in data change
+def command_update_alarm(alarm_id, data):
+    if not isinstance(data, dict):
+        raise CommandError("Invalid alarm")
     with alarm_lock:
-        # Respond with the current alarm details, and the delay until the next alarm
-        return jsonify((alarm_data, {"time_until_alarm": schedule.idle_seconds()}))
+        try:
+            alarm = Alarm.from_dict({**scheduler.get(alarm_id).as_dict(), **data, "id": alarm_id})
+        except KeyError as e:
+            raise CommandError("Unknown alarm", 404) from e
+        except ValueError as e:
+            raise CommandError(str(e)) from e
+        validate_alarm(alarm)
+        scheduler.add(alarm)
+        save_alarms()
+    api_log.info("Alarm %s (%s) changed: %s", alarm.id, alarm.name, alarm.as_dict())
+    publish_event("alarms", alarm_state())
+    return command_alarm(alarm_id)
 
-# Setting the task
-@app.route('/api/v1/task', methods=['POST'])
-def set_task():
-    global worker_thread, current_task
-    task = request.get_json().get("task")
-    #if argument was provided (e.g. colour), pass it to the task. Otherwise, pass None
-    arg = request.get_json().get("arg") or None
+def command_delete_alarm(alarm_id):
+    with alarm_lock:
+        try:
+            scheduler.remove(alarm_id)
+        except KeyError as e:
+            raise CommandError("Unknown alarm", 404) from e
+        prepared_alarms.pop(alarm_id, None)
+        save_alarms()
+    api_log.info("Alarm %s deleted", alarm_id)
+    state = alarm_state()
+    publish_event("alarms", state)
+    return state
 
+def command_set_task(task, arg=None, zone=None, transition=TRANSITION_TIME):
     if task not in TASKS:
         # The requested task is not available
-        return jsonify({"error": "Invalid task"}), 400
+        raise CommandError("Invalid task")
+    try:
+        TASKS.params(task, arg)
+    except (KeyError, ValueError) as e:
+        raise CommandError(f"Invalid parameters: {e}") from e
+    if zone is not None and compositor.zone(zone) is None:
+        raise CommandError("Invalid zone")
+    if not isinstance(transition, (int, float)) or transition < 0:
+        raise CommandError("Invalid transition")
+    task_request = queue_task(task, arg, zone, transition)
+    api_log.info("Queued task %s in zone %s (request %s)", task, task_request['zone'], task_request['id'])
+    return command_task_request(task_request["id"])
 
-    # We will be modifying the worker_thread and current_task variables, so we need to lock them
+# Changing some of the parameters of the task running in a zone, which it picks up while it runs
+# A task which has finished already (or renders in a process of its own) is started again with them instead
+def command_set_params(arg, zone=None):
+    zone = zone or default_zone()
+    if compositor.zone(zone) is None:
+        raise CommandError("Invalid zone")
     with task_lock:
-        print(f"[{datetime.datetime.now()}] set_task: stopping worker thread")
-        stop_worker_thread()
-        print(f"[{datetime.datetime.now()}] set_task: stopped worker thread")
-        # Set the current task to the requested task
-        current_task = task
-        # Create a new worker thread with the requested task
-        worker_thread = threading.Thread(target=TASKS[task], args=(strip, exit_event, arg), daemon=True)
-        print(f"[{datetime.datetime.now()}] set_task: starting worker thread with task {task}")
-        worker_thread.start()
-        print(f"[{datetime.datetime.now()}] set_task: worker thread started")
-    # Respond with the new task
-    return jsonify({"task": current_task})
-
-# Reading the currently running task
-@app.route('/api/v1/task', methods=['GET'])
-def get_task():
-    global current_task
-    # We will be reading the current_task variable, so we need to lock it
+        task, params = current_tasks.get(zone), task_args.get(zone)
+        schema = TASKS.schema(task) if task in TASKS else None
+        if schema is None or not isinstance(params, Params):
+            raise CommandError(f"The task in zone {zone} has no parameters")
+        try:
+            values = check_params(schema, arg)
+        except ValueError as e:
+            raise CommandError(f"Invalid parameters: {e}") from e
+        fixed = [name for name in values if not schema[name].get("live", True)]
+        if fixed:
+            raise CommandError(f"Invalid parameters: {', '.join(fixed)} can only be set when the task starts")
+        restart = not params.update(values) or EXECUTION_MODE == "process"
+        if restart:
+            switch_task(task, dict(params), zone, transition=0)
+        api_log.info("Zone %s: parameters of %s changed to %s%s", zone, task, values, " (started again)" if restart else "")
+        # Kept for a restart, if the task is the one which was asked for
+        store.update("tasks", lambda tasks: {**tasks, zone: {"task": task, "arg": dict(params)}}
+                     if (tasks or {}).get(zone, {}).get("task") == task else tasks)
+    publish_event("task", task_state())
+    return {"zone": zone, "task": task, "arg": dict(params), "restarted": restart}
+
+def command_task_request(request_id):
+    with request_condition:
+        if request_id not in task_requests:
+            raise CommandError("Unknown request", 404)
+        task_request = task_requests[request_id]
+        return {"id": task_request["id"], "task": task_request["task"], "zone": task_request["zone"], "status": task_request["status"]}
+
+def command_task_state():
+    # We will be reading the current_tasks variable, so we need to lock it
     with task_lock:
-        return jsonify({"task": current_task})
+        return task_state()
+
+def command_set_brightness(brightness):
+    # (true and false are ints in Python, but not brightnesses)
+    if isinstance(brightness, bool) or not isinstance(brightness, int) or not 0 <= brightness <= 255:
+        raise CommandError("Invalid brightness")
+    for output in outputs:
+        output.set_brightness(brightness)
+    api_log.info("Brightness set to %s", brightness)
+    store.set("brightness", brightness)
+    state = brightness_state()
+    publish_event("brightness", state)
+    return state
+
+def command_stats(zone=None):
+    zone = zone or default_zone()
+    # We will be reading the current_tasks and zone_stats variables, so we need to lock them
+    with task_lock:
+        if zone not in zone_stats:
+            raise CommandError("Unknown zone", 404)
+        return {"task": current_tasks.get(zone), "zone": zone, "target_fps": TARGET_FPS, "output_mode": OUTPUT_MODE, "execution_mode": EXECUTION_MODE,
+                **zone_stats[zone].as_dict(), "output": compositor.stats.as_dict()}
+
+def command_set_zones(zones):
+    from tasks.compositor import Zone # pylint: disable=import-outside-toplevel
+    try:
+        zones = [Zone.from_dict(zone) for zone in zones]
+        if not zones:
+            raise ValueError("There must be at least one zone")
+    except (KeyError, TypeError, ValueError) as e:
+        raise CommandError(f"Invalid zones: {e}") from e
+    with task_lock:
+        try:
+            compositor.set_zones(zones)
+        except ValueError as e:
+            raise CommandError(f"Invalid zones: {e}") from e
+        api_log.info("Zones set to %s", [zone.name for zone in zones])
+        # The old zones are gone, so stop all their tasks
+        for zone in list(worker_threads):
+            stop_worker_thread(zone)
+            del worker_threads[zone]
+        running = {zone: (current_tasks.pop(zone), task_args.pop(zone), alarm_tasks.pop(zone, None)) for zone in list(current_tasks)}
+        zone_stats.clear()
+        # Pushed frames don't fit a zone which may have changed size, the client has to send a new one
+        external_frames.clear()
+        for zone in zones:
+            if zone.name in running and running[zone.name][0] != FRAME_TASK:
+                task, arg, alarm_id = running[zone.name]
+                try:
+                    start_worker_thread(task, set_up_task(task, arg, zone.name), zone.name, alarm_id=alarm_id)
+                except Exception: # pylint: disable=broad-except
+                    api_log.warning("Failed to start task %s in zone %s again", task, zone.name, exc_info=True)
+    write_json(ZONES_FILE, [zone.as_dict() for zone in zones])
+    # Zones which are gone don't have a task any more
+    store.update("tasks", lambda tasks: {name: task for name, task in (tasks or {}).items() if compositor.zone(name) is not None})
+    state = zones_state()
+    publish_event("zones", state)
+    publish_event("task", task_state())
+    return state
+
+# Showing a frame pushed by a client, or an update to it (see frames.py for the format)
+# The zone's task is stopped, and the zone shows the pushed frames until another task is started
+def command_set_frame(payload, zone=None):
+    from frames import apply_update # pylint: disable=import-outside-toplevel
+    from tasks.common import FrameBuffer, FrameStats # pylint: disable=import-outside-toplevel
+    zone = zone or default_zone()
+    if compositor.zone(zone) is None:
+        raise CommandError("Invalid zone")
+    with task_lock:
+        layer = compositor.zone(zone).layer
+        if current_tasks.get(zone) != FRAME_TASK:
+            api_log.info("Zone %s shows pushed frames", zone)
+            stop_worker_thread(zone)
+            current_tasks[zone] = FRAME_TASK
+            task_args[zone] = None
+            alarm_tasks.pop(zone, None)
+            zone_stats[zone] = FrameStats()
+            # Updates apply to what the zone shows now
+            external_frames[zone] = FrameBuffer(len(compositor.zone(zone)))
+            external_frames[zone].pixels[:] = layer.last_frame()
+            publish_event("task", task_state())
+        buffer = external_frames[zone]
+        start = time.perf_counter()
+        try:
+            pixels = apply_update(buffer.pixels, payload)
+        except ValueError as e:
+            raise CommandError(f"Invalid frame: {e}") from e
+        zone_stats[zone].add_render(time.perf_counter() - start)
+        layer.submit(buffer, zone_stats[zone])
+    return {"zone": zone, "pixels": pixels}
+
+# The newest frame of every strip, one after another, as 8-bit RGB
+# (in the colours the tasks rendered, before the colour correction)
+def command_frame():
+    import numpy as np # pylint: disable=import-outside-toplevel
+    return (np.concatenate([output.last_frame() for output in outputs]) >> 8).astype(np.uint8).tobytes()
+
+COMMANDS = {
+    "alarm_state": alarm_state,
+    "alarm": command_alarm,
+    "create_alarm": command_create_alarm,
+    "update_alarm": command_update_alarm,
+    "delete_alarm": command_delete_alarm,
+    "set_task": command_set_task,
+    "set_params": command_set_params,
+    "task_request": command_task_request,
+    "task_state": command_task_state,
+    "set_brightness": command_set_brightness,
+    "brightness_state": brightness_state,
+    "stats": command_stats,
+    "set_zones": command_set_zones,
+    "zones_state": zones_state,
+    "tasks_state": tasks_state,
+    "frame": command_frame,
+    "set_frame": command_set_frame,
+}
+
+class LocalEngine:
+    """Runs commands in this process, which drives the strips itself"""
+
+    def call(self, command, payload=None, **args):
+        # Commands need the hardware, so they wait for it to start
+        try:
+            wait_for_hardware()
+        except RuntimeError as e:
+            raise CommandError(str(e), 503) from e
+        if payload is not None:
+            args["payload"] = payload
+        return COMMANDS[command](**args)
+
+    def subscribe(self, timeout):
+        """Events as (name, data), starting with the current state, and None after timeout seconds without any"""
+        try:
+            wait_for_hardware()
+        except RuntimeError as e:
+            raise CommandError(str(e), 503) from e
+        stream = EventStream()
+        stream.put("task", task_state())
+        stream.put("alarms", alarm_state())
+        stream.put("brightness", brightness_state())
+        stream.put("zones", zones_state())
+        with event_lock:
+            event_streams.add(stream)
+        try:
+            while True:
+                events = stream.get(timeout)
+                if not events:
+                    yield None
+                yield from events
+        finally:
+            with event_lock:
+                event_streams.discard(stream)
+
+# Function to send the events of the engine to a web worker, until it goes away
+# An idle stream gets a keepalive (no event) now and then, so a dead connection is noticed
+def serve_events(send):
+    for event in LocalEngine().subscribe(EVENT_KEEPALIVE):
+        name, data = event or (None, None)
+        send({"event": name, "data": data})
+
+engine = None # LocalEngine, or EngineClient of the engine process, set by create_app()
+
+# Function to run a command in the engine, and respond with its result
+def engine_response(command, status=200, **args):
+    try:
+        return jsonify(engine.call(command, **args)), status
+    except CommandError as e:
+        return jsonify({"error": str(e)}), e.status
+
+# Reading the alarms, with when each one goes off next
+@routes.route('/api/v1/alarms', methods=['GET'])
+def get_alarms():
+    return engine_response("alarm_state")
+
+# Adding an alarm: its time (HH:MM or H:MM, or with seconds), and days or a date (YYYY-MM-DD), and the task it starts
+@routes.route('/api/v1/alarms', methods=['POST'])
+def add_alarm():
+    return engine_response("create_alarm", 201, data=request.get_json())
+
+# Reading an alarm
+@routes.route('/api/v1/alarms/<int:alarm_id>', methods=['GET'])
+def get_alarm(alarm_id):
+    return engine_response("alarm", alarm_id=alarm_id)
+
+# Changing an alarm, only the settings which are given
+@routes.route('/api/v1/alarms/<int:alarm_id>', methods=['PATCH'])
+def update_alarm(alarm_id):
+    return engine_response("update_alarm", alarm_id=alarm_id, data=request.get_json())
+
+# Deleting an alarm
+@routes.route('/api/v1/alarms/<int:alarm_id>', methods=['DELETE'])
+def delete_alarm(alarm_id):
+    return engine_response("delete_alarm", alarm_id=alarm_id)
+
+# Setting the task
+# The switch happens in the background, the response has the ID to query its status with
+@routes.route('/api/v1/task', methods=['POST'])
+def set_task():
+    data = request.get_json()
+    return engine_response("set_task", 202,
+        task=data.get("task"),
+        #if argument was provided (e.g. colour), pass it to the task. Otherwise, pass None
+        arg=data.get("arg") or None,
+        # The zone to run it in, the default zone if there isn't one
+        zone=data.get("zone") or None,
+        # Seconds to cross-fade from the old task for, 0 to switch straight away
+        transition=data.get("transition", TRANSITION_TIME))
+
+# Changing the parameters of the running task, without starting it again
+@routes.route('/api/v1/task', methods=['PATCH'])
+def set_params():
+    data = request.get_json()
+    return engine_response("set_params",
+        # Only the parameters which change
+        arg=data.get("arg"),
+        # The zone the task runs in, the default zone if there isn't one
+        zone=data.get("zone") or None)
+
+# Reading the status of a task switch request
+@routes.route('/api/v1/task/<int:request_id>', methods=['GET'])
+def get_task_request(request_id):
+    return engine_response("task_request", request_id=request_id)
+
+# Reading the currently running task of every zone
+@routes.route('/api/v1/task', methods=['GET'])
+def get_task():
+    return engine_response("task_state")
+
+# Subscribing to task and alarm changes
+# The current state is sent straight away, and after that only when it changes
+# Past MAX_EVENT_SUBSCRIBERS streams in this process, a subscriber gets 503 (and tries again after Retry-After)
+@routes.route('/api/v1/events', methods=['GET'])
+def events():
+    if not event_subscribers.acquire(blocking=False):
+        api_log.warning("Refused an event subscriber, there are %s already", MAX_EVENT_SUBSCRIBERS)
+        return jsonify({"error": "Too many event subscribers"}), 503, {"Retry-After": str(int(EVENT_KEEPALIVE))}
+    try:
+        stream = engine.subscribe(EVENT_KEEPALIVE)
+        # Get the first events (the current state) now, so a failure can still be answered with an error
+        first = next(stream)
+    except CommandError as e:
+        event_subscribers.release()
+        return jsonify({"error": str(e)}), e.status
+    def generate():
+        for event in itertools.chain([first], stream):
+            # A comment on idle streams, so dead connections are noticed
+            yield format_event(*event) if event else ": keepalive\n\n"
+    response = Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # The server closes the response when the client goes away, even if it never started reading it
+    response.call_on_close(stream.close)
+    response.call_on_close(event_subscribers.release)
+    return response
+
+# Setting the master brightness
+# It applies to whatever is running, without restarting the task
+@routes.route('/api/v1/brightness', methods=['POST'])
+def set_brightness():
+    return engine_response("set_brightness", brightness=request.get_json().get("brightness"))
+
+# Reading the master brightness
+@routes.route('/api/v1/brightness', methods=['GET'])
+def get_brightness():
+    return engine_response("brightness_state")
+
+# Reading the render loop statistics of the task running in a zone (the default zone unless ?zone= is given)
+# Frames sent to the strips are counted by the compositor, under "output"
+@routes.route('/api/v1/stats', methods=['GET'])
+def get_stats():
+    return engine_response("stats", zone=request.args.get("zone") or None)
+
+# Setting the zones
+# Tasks keep running in zones which are still there (restarted, as the zone may have changed size)
+@routes.route('/api/v1/zones', methods=['POST'])
+def set_zones():
+    zones = (request.get_json() or {}).get("zones")
+    if not isinstance(zones, list):
+        return jsonify({"error": "Invalid zones: there must be a list of zones"}), 400
+    return engine_response("set_zones", zones=zones)
+
+# Showing frames pushed by a client in a zone (the default zone unless ?zone= is given)
+# The body is a binary update (see frames.py), which replaces the zone's task until another one is started
+@routes.route('/api/v1/frame', methods=['POST'])
+def set_frame():
+    payload = request.get_data()
+    if not payload:
+        return jsonify({"error": "Invalid frame: the body is empty"}), 400
+    return engine_response("set_frame", payload=payload, zone=request.args.get("zone") or None)
+
+# Reading the zones
+@routes.route('/api/v1/zones', methods=['GET'])
+def get_zones():
+    return engine_response("zones_state")
+
+# Live preview of the strip over a WebSocket (see preview.py for the message format)
+# Query parameters: fps (frames per second), pixels (most pixels per frame), delta (0 for full frames only)
+if Sock is not None:
+    sock = Sock()
+
+    @sock.route('/api/v1/preview', bp=routes)
+    def preview(websocket):
+        import numpy as np # pylint: disable=import-outside-toplevel
+        from preview import PreviewEncoder, stream_preview, DEFAULT_PREVIEW_FPS # pylint: disable=import-outside-toplevel
+        encoder = PreviewEncoder(
+            fps=request.args.get("fps", DEFAULT_PREVIEW_FPS, type=float),
+            max_pixels=request.args.get("pixels", None, type=int),
+            delta=request.args.get("delta", 1, type=int) != 0,
+        )
+        # Runs until the client goes away and sending fails
+        stream_preview(websocket.send, lambda: np.frombuffer(engine.call("frame"), dtype=np.uint8).reshape(-1, 3), encoder)
 
 # Getting all available tasks
-@app.route('/api/v1/tasks', methods=['GET'])
+@routes.route('/api/v1/tasks', methods=['GET'])
 def get_tasks():
-    # Order TASKS.keys() alphabetically and return it as a list
-    tasks = list(TASKS.keys())
-    tasks.sort()
-    return jsonify({"tasks": tasks})
+    return engine_response("tasks_state")
 
 # Frontend
-@app.route('/')
+@routes.route('/')
 def index():
-    return app.send_static_file('index.html')
+    return current_app.send_static_file('index.html')
+
+# Function to create the app
+# With ENGINE_MODE=local, this process drives the strips: the hardware is started in the background (once per process)
+# With ENGINE_MODE=remote, commands go to the engine process (python neocontrol.py engine) over ENGINE_SOCKET
+# With start=False, the API is there but can't be used, e.g. for profiling
+def create_app(start=True):
+    global engine
+    setup_logging()
+    app = Flask(__name__, static_folder='static', static_url_path='')
+    app.register_blueprint(routes)
+    if Sock is not None:
+        sock.init_app(app)
+    if ENGINE_MODE == "remote":
+        engine = EngineClient(ENGINE_SOCKET, HARDWARE_TIMEOUT)
+    else:
+        engine = LocalEngine()
+        if start:
+            with hardware_lock:
+                if not hardware_ready.is_set() and not any(thread.name == "start_hardware" for thread in threading.enumerate()):
+                    threading.Thread(target=start_hardware, name="start_hardware", daemon=True).start()
+    return app
+
+# Function to report where the time to the first HTTP response goes
+# Runs a fresh interpreter with python -X importtime, so nothing is imported yet
+def profile_startup(top=15):
+    script = ("import time; start = time.perf_counter(); import neocontrol; imported = time.perf_counter(); "
+              "app = neocontrol.create_app(start=False); response = app.test_client().get('/'); "
+              "print(f'{imported - start:.4f} {time.perf_counter() - start:.4f} {response.status_code}')")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", script], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    # Lines of "import time: self [us] | cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            imports.append((int(fields[0]), int(fields[1]), fields[2].rstrip()))
+    imported, first_response, status = result.stdout.split()[-3:]
+    print(f"import neocontrol:   {float(imported)*1000:8.1f} ms")
+    print(f"first HTTP response: {float(first_response)*1000:8.1f} ms (GET / -> {status})")
+    print(f"\nslowest imports ({len(imports)} modules):")
+    print(f"{'self ms':>9} {'total ms':>9}  module")
+    for self_time, cumulative, name in sorted(imports, key=lambda i: i[1], reverse=True)[:top]:
+        print(f"{self_time/1000:9.1f} {cumulative/1000:9.1f}  {name}")
 
-# Start the dev web server if this script is run directly
 if __name__ == '__main__':
-    print(f"[{datetime.datetime.now()}] main thread: {threading.get_ident()} {threading.current_thread().name}")
-    app.run(host="0.0.0.0", port=5000)
-    print(f"[{datetime.datetime.now()}] main thread: done")
+    if sys.argv[1:] == ["profile"]:
+        profile_startup()
+    elif sys.argv[1:] == ["engine"]:
+        run_engine()
+    else:
+        # Start the dev web server if this script is run directly
+        app = create_app()
+        api_log.debug("main thread: %s %s", threading.get_ident(), threading.current_thread().name)
+        app.run(host="0.0.0.0", port=5000)
+        api_log.debug("main thread: done")
@@ -0,0 +1,100 @@
+"""Live preview of the frames sent to the strip, encoded for streaming to a browser
+
+Every message is binary:
+    byte 0      b'F' for a full frame, or b'D' for changes since the previous message
+    bytes 1-2   number of pixels in the (possibly downsampled) frame, little endian
+    then, for b'F', 3 bytes (R, G, B) per pixel
+    or, for b'D', 5 bytes per changed pixel: its index (little endian) and R, G, B
+"""
+import math
+import struct
+import time
+import numpy as np
+
+# Rate a client gets if it doesn't ask for one, and the slowest and fastest it may ask for
+DEFAULT_PREVIEW_FPS = 10.0
+MIN_PREVIEW_FPS = 1.0
+MAX_PREVIEW_FPS = 60.0
+# Never downsample below this many pixels
+MIN_PREVIEW_PIXELS = 16
+# Send a full frame at least this often, so a client can't drift away from the strip
+KEYFRAME_INTERVAL = 5.0
+
+DELTA_DTYPE = np.dtype([("index", "<u2"), ("rgb", "u1", 3)])
+
+def decimate(pixels, num_pixels: int):
+    """Downsample an (N,3) frame to num_pixels by averaging neighbouring pixels"""
+    if num_pixels >= len(pixels):
+        return pixels
+    starts = np.linspace(0, len(pixels), num_pixels, endpoint=False).astype(int)
+    sums = np.add.reduceat(pixels.astype(np.uint32), starts, axis=0)
+    counts = np.diff(np.append(starts, len(pixels)))[:, np.newaxis]
+    return (sums // counts).astype(np.uint8)
+
+class PreviewEncoder:
+    """Encodes the frames for one preview client
+
+    The client asks for a frame rate, a maximum number of pixels and whether
+    it understands delta messages (a rate or a number of pixels out of range
+    is brought into it, so ?pixels=0 still gets frames). The encoder lowers the resolution when
+    sending takes up too much of the frame budget (a slow connection), and
+    raises it again when there is plenty of room."""
+
+    def __init__(self, fps: float = DEFAULT_PREVIEW_FPS, max_pixels: int = None, delta: bool = True):
+        if math.isnan(fps):
+            fps = DEFAULT_PREVIEW_FPS
+        self.period = 1.0 / min(max(fps, MIN_PREVIEW_FPS), MAX_PREVIEW_FPS)
+        if max_pixels is not None:
+            max_pixels = max(max_pixels, MIN_PREVIEW_PIXELS)
+        self.max_pixels = max_pixels
+        self.num_pixels = max_pixels
+        self.delta = delta
+        self.previous = None
+        self.last_keyframe = 0.0
+
+    def encode(self, pixels):
+        """Message for the next frame, or None if nothing has changed"""
+        if self.num_pixels is None:
+            self.max_pixels = self.num_pixels = len(pixels)
+        frame = decimate(pixels, self.num_pixels)
+        now = time.monotonic()
+        if (not self.delta or self.previous is None or len(self.previous) != len(frame)
+                or now - self.last_keyframe >= KEYFRAME_INTERVAL):
+            self.previous = frame.copy()
+            self.last_keyframe = now
+            return b"F" + struct.pack("<H", len(frame)) + frame.tobytes()
+        changed = np.flatnonzero(np.any(frame != self.previous, axis=1))
+        if len(changed) == 0:
+            return None
+        self.previous = frame.copy()
+        # A full frame is smaller once more than 3/5 of the pixels have changed
+        if len(changed) * DELTA_DTYPE.itemsize >= len(frame) * 3:
+            return b"F" + struct.pack("<H", len(frame)) + frame.tobytes()
+        delta = np.empty(len(changed), dtype=DELTA_DTYPE)
+        delta["index"] = changed
+        delta["rgb"] = frame[changed]
+        return b"D" + struct.pack("<H", len(frame)) + delta.tobytes()
+
+    def sent(self, send_time: float):
+        """Adapt the resolution to how long the last message took to send"""
+        if send_time > self.period / 2:
+            self.num_pixels = max(MIN_PREVIEW_PIXELS, self.num_pixels // 2)
+        elif send_time < self.period / 10:
+            self.num_pixels = min(self.max_pixels, self.num_pixels * 2)
+
+def stream_preview(send, get_frame, encoder: PreviewEncoder):
+    """Send frames from get_frame() at the encoder's rate until send() fails
+
+    Frames are taken from the output stage when it is time to send one, so
+    the renderer never waits for a slow client: the client just gets fewer
+    (and smaller) frames."""
+    deadline = time.monotonic()
+    while True:
+        message = encoder.encode(get_frame())
+        if message is not None:
+            send_start = time.monotonic()
+            send(message)
+            encoder.sent(time.monotonic() - send_start)
+        # Don't try to catch up if sending made us late
+        deadline = max(deadline + encoder.period, time.monotonic())
+        time.sleep(max(0, deadline - time.monotonic()))
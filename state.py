@@ -0,0 +1,116 @@
+"""State which survives a restart (or a power cut): the alarms, the task of every zone and the brightness
+
+Files are never written in place. A new version is written to a temporary
+file next to it, flushed to the disk with fsync, and renamed over the old
+one, so the file is always either the old version or the new one, whole.
+
+Sliders send an update on every step, so updates only change the state in
+memory, and a writer thread saves them: straight away if nothing has been
+written for WRITE_INTERVAL seconds, otherwise all the updates which came in
+since in one write at the end of the interval. At most WRITE_INTERVAL
+seconds of updates can be lost, and the SD card isn't written 50 times a
+second. flush() (run at exit) writes what's left."""
+import atexit
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger("neocontrol.engine.state")
+
+WRITE_INTERVAL = float(os.environ.get("STATE_WRITE_INTERVAL", 1.0)) # Shortest time in seconds between two writes of the state file
+
+def read_json(path: str):
+    """Contents of a JSON file, or None if it isn't there
+    A file which can't be read is moved aside (to .corrupt), so it's not lost but doesn't stop the start either"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        log.warning("Can't read %s, moving it to %s.corrupt", path, path, exc_info=True)
+        os.replace(path, path + ".corrupt")
+        return None
+
+def write_json(path: str, data):
+    """Replace a JSON file atomically: write a temporary file, fsync it, and rename it over the old one"""
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    # The rename is only durable once the directory is on the disk too
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class StateStore:
+    """A JSON object of state in a file, updated in memory and saved by a writer thread (see the module)"""
+
+    def __init__(self, path: str, interval: float = WRITE_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock() # so writes can't overtake each other
+        self.state = read_json(path) or {}
+        self.dirty = False  # the state has changed since it was last written
+        self.writes = 0     # how many times the file has been written
+        self.updates = 0    # how many updates there have been
+        self.thread = None
+
+    def get(self, key: str, default=None):
+        with self.condition:
+            return self.state.get(key, default)
+
+    def set(self, key: str, value):
+        """Change a part of the state, it's saved soon"""
+        self.update(key, lambda _: value)
+
+    def update(self, key: str, function):
+        """Change a part of the state to function(its current value, or None), it's saved soon"""
+        with self.condition:
+            self.state[key] = function(self.state.get(key))
+            self.dirty = True
+            self.updates += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write_changes, name="state", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+            self.condition.notify()
+
+    def flush(self):
+        """Write the state now, if it has changed"""
+        # The file is written without holding up updates (fsync can take a while on an SD card)
+        with self.write_lock:
+            with self.condition:
+                if not self.dirty:
+                    return
+                data = copy.deepcopy(self.state)
+                self.dirty = False
+            try:
+                write_json(self.path, data)
+            except OSError:
+                with self.condition:
+                    self.dirty = True
+                raise
+            self.writes += 1
+
+    def write_changes(self):
+        """Writer thread: save the state whenever it changes, at most once per interval"""
+        while True:
+            with self.condition:
+                while not self.dirty:
+                    self.condition.wait()
+            try:
+                self.flush()
+            except OSError:
+                log.error("Can't write %s", self.path, exc_info=True)
+            # Updates which come in now are written together, at the end of the interval
+            time.sleep(self.interval)
@@ -10,13 +10,17 @@ if (!authKey) {
 }
 
 const currentAlarm = document.getElementById("current-alarm");
-const alarmTimeInput = document.getElementById("alarm-time");
-const alarmEnabledInput = document.getElementById("alarm-enabled");
-const dayCheckboxes = document.querySelectorAll(".day-checkbox");
+const alarmsContainer = document.getElementById("alarms-container");
+const alarmTemplate = document.getElementById("alarm-template");
+const addAlarmButton = document.getElementById("add-alarm");
 const tasksContainer = document.getElementById("tasks-container");
+const paramsContainer = document.getElementById("params-container");
+const previewCanvas = document.getElementById("preview");
+const brightnessInput = document.getElementById("brightness");
 
-let alarmUpdateInterval;
-let taskUpdateInterval;
+let countdownInterval;
+let lastAlarm = null;       // latest alarms data from the server
+let lastAlarmTime = 0;      // when it was received, to count down from
 
 function formatAlarmTime(time) {
     const [hour, minute] = time.split(':');
@@ -31,72 +35,317 @@ function formatTimeUntil(seconds) {
     return `in ${hours} hours ${minutes} minutes`;
 }
 
-function getSelectedDays() {
-    return Array.from(dayCheckboxes)
+function getSelectedDays(row) {
+    return Array.from(row.querySelectorAll(".day-checkbox"))
         .filter(cb => cb.checked)
         .map(cb => cb.getAttribute("data-day"));
 }
 
-function sendAlarmUpdate() {
-    clearInterval(alarmUpdateInterval);
-    return fetch("/api/v1/alarm", {
+// Alarms are added with POST, changed with PATCH and deleted with DELETE, the alarms event updates the list
+function sendAlarmRequest(method, url, body) {
+    return fetch(url, {
+        method: method,
+        headers: { "Content-Type": "application/json", 'Authorization': `Bearer ${authKey}` },
+        body: body && JSON.stringify(body),
+    });
+}
+
+function sendAlarmUpdate(row) {
+    return sendAlarmRequest("PATCH", `/api/v1/alarms/${row.getAttribute("data-id")}`, {
+        time: row.querySelector(".alarm-time").value,
+        enabled: row.querySelector(".alarm-enabled").checked,
+        task: row.querySelector(".alarm-task").value,
+        days: getSelectedDays(row),
+    });
+}
+
+function addAlarm() {
+    return sendAlarmRequest("POST", "/api/v1/alarms", { time: "06:30" });
+}
+
+// Sent on every step of the slider, the strip follows it while it moves
+function sendBrightnessUpdate() {
+    return fetch("/api/v1/brightness", {
         method: "POST",
         headers: { "Content-Type": "application/json", 'Authorization': `Bearer ${authKey}` },
-        body: JSON.stringify({
-            time: alarmTimeInput.value,
-            enabled: alarmEnabledInput.checked,
-            days: getSelectedDays()
-        }),
-    }).then(() => {
-        updateAlarm();
-        clearInterval(alarmUpdateInterval);
-        alarmUpdateInterval = setInterval(updateAlarm, 60000);
+        body: JSON.stringify({ brightness: parseInt(brightnessInput.value) }),
     });
 }
 
-let updateAlarmRequest = null;
-function updateAlarm() {
-    updateAlarmRequest = fetch("/api/v1/alarm",
-        {headers: {
-            'Authorization': `Bearer ${authKey}`,
-            },
-        })
-        .then((response) => response.json())
-        .then((data) => {
-            const alarmTime = formatAlarmTime(data[0].time)
-            const timeUntilAlarm = formatTimeUntil(data[1].time_until_alarm);
-            currentAlarm.textContent = data[0].enabled
-                ? `${alarmTime} (${timeUntilAlarm})`
-                : "Disabled";
-            alarmTimeInput.value = data[0].time;
-            alarmEnabledInput.checked = data[0].enabled;
-            dayCheckboxes.forEach(cb => {
-                cb.checked = data[0].days.includes(cb.getAttribute("data-day"));
-            });
+function showBrightness(data) {
+    brightnessInput.value = data.brightness;
+}
+
+// The countdown is worked out locally from the last alarms event, without asking the server
+function showCountdown() {
+    if (!lastAlarm) {
+        return;
+    }
+    const next = lastAlarm.alarms.find((alarm) => alarm.id === lastAlarm.next);
+    if (!next) {
+        currentAlarm.textContent = "None";
+        return;
+    }
+    const elapsed = (Date.now() - lastAlarmTime) / 1000;
+    const timeUntilAlarm = formatTimeUntil(Math.max(0, lastAlarm.time_until_alarm - elapsed));
+    currentAlarm.textContent = `${formatAlarmTime(next.time)} (${timeUntilAlarm})`;
+}
+
+function showAlarms(data) {
+    lastAlarm = data;
+    lastAlarmTime = Date.now();
+    showCountdown();
+    showAlarmList();
+}
+
+// A row for every alarm, built again on every alarms event
+function showAlarmList() {
+    alarmsContainer.replaceChildren();
+    lastAlarm.alarms.forEach((alarm) => {
+        const row = alarmTemplate.content.firstElementChild.cloneNode(true);
+        row.setAttribute("data-id", alarm.id);
+        row.querySelector(".alarm-time").value = alarm.time;
+        row.querySelector(".alarm-enabled").checked = alarm.enabled;
+        const taskSelect = row.querySelector(".alarm-task");
+        new Set([...(taskNames ? taskNames.split(",") : []), alarm.task]).forEach((task) => {
+            taskSelect.add(new Option(task, task));
+        });
+        taskSelect.value = alarm.task;
+        row.querySelectorAll(".day-checkbox").forEach(cb => {
+            cb.checked = alarm.days.includes(cb.getAttribute("data-day"));
+            cb.addEventListener("change", () => sendAlarmUpdate(row));
+        });
+        row.querySelectorAll(".alarm-time, .alarm-enabled, .alarm-task").forEach((input) => {
+            input.addEventListener("change", () => sendAlarmUpdate(row));
+        });
+        row.querySelector(".alarm-delete").addEventListener("click", () => {
+            sendAlarmRequest("DELETE", `/api/v1/alarms/${alarm.id}`);
+        });
+        alarmsContainer.appendChild(row);
+    });
+}
+
+let currentTask = null;
+let currentArg = null;
+function showTask(data) {
+    currentTask = data.task;
+    currentArg = data.arg;
+    updateTasks();
+    showParams();
+}
+
+// Parameters are changed with PATCH, the running task picks them up without starting again
+function sendParams(arg) {
+    return fetch("/api/v1/task", {
+        method: "PATCH",
+        headers: { "Content-Type": "application/json", 'Authorization': `Bearer ${authKey}` },
+        body: JSON.stringify({ arg: arg }),
+    });
+}
+
+// A slider for every number the current task can change while it runs, built again when the task changes
+let paramsTask = null;
+function showParams() {
+    const details = taskDetails[currentTask];
+    const params = (details && details.params) || {};
+    if (paramsTask !== currentTask) {
+        paramsTask = currentTask;
+        paramsContainer.replaceChildren();
+        Object.entries(params).forEach(([name, spec]) => {
+            if (!["number", "integer"].includes(spec.type) || spec.live === false || spec.min === undefined || spec.max === undefined) {
+                return;
+            }
+            const label = document.createElement("label");
+            label.textContent = spec.label || name;
+            const input = document.createElement("input");
+            input.type = "range";
+            input.className = "param";
+            input.setAttribute("data-param", name);
+            input.min = spec.min;
+            input.max = spec.max;
+            input.step = spec.type === "integer" ? 1 : (spec.max - spec.min) / 1000;
+            input.addEventListener("input", () => sendParams({ [name]: Number(input.value) }));
+            label.appendChild(input);
+            paramsContainer.appendChild(label);
         });
+    }
+    // The values from the server, apart from the slider being moved
+    paramsContainer.querySelectorAll(".param").forEach((input) => {
+        const value = currentArg && currentArg[input.getAttribute("data-param")];
+        if (value !== null && value !== undefined && document.activeElement !== input) {
+            input.value = value;
+        }
+    });
 }
 
-let updateTaskRequest = null;
 function updateTasks() {
-    updateTaskRequest = fetch("/api/v1/task",
+    const taskButtons = document.querySelectorAll(".task-button");
+    taskButtons.forEach((button) => {
+        if (button.getAttribute("data-task") === currentTask) {
+            button.classList.add("active");
+        } else {
+            button.classList.remove("active");
+        }
+    });
+}
+
+// Server-Sent Events from /api/v1/events, read with fetch so the auth header can be sent
+// The server sends the current state when we connect, and then only changes
+const eventHandlers = { task: showTask, alarms: showAlarms, brightness: showBrightness, tasks: showTaskList };
+function handleEvent(text) {
+    let name = "message";
+    const data = [];
+    text.split("\n").forEach((line) => {
+        if (line.startsWith("event:")) {
+            name = line.slice(6).trim();
+        } else if (line.startsWith("data:")) {
+            data.push(line.slice(5).trim());
+        }
+    });
+    if (data.length && eventHandlers[name]) {
+        eventHandlers[name](JSON.parse(data.join("\n")));
+    }
+}
+
+function subscribeEvents() {
+    const decoder = new TextDecoder();
+    let pending = "";
+    fetch("/api/v1/events",
         {headers: {
             'Authorization': `Bearer ${authKey}`,
             },
         })
-        .then((response) => response.json())
-        .then((data) => {
-            const taskButtons = document.querySelectorAll(".task-button");
-            taskButtons.forEach((button) => {
-                if (button.getAttribute("data-task") === data.task) {
-                    button.classList.add("active");
-                } else {
-                    button.classList.remove("active");
-                }
-            });
+        .then((response) => {
+            const reader = response.body.getReader();
+            function read() {
+                return reader.read().then(({ done, value }) => {
+                    if (done) {
+                        throw new Error("Event stream closed");
+                    }
+                    pending += decoder.decode(value, { stream: true });
+                    const events = pending.split("\n\n");
+                    pending = events.pop();
+                    events.forEach(handleEvent);
+                    return read();
+                });
+            }
+            return read();
+        })
+        .catch(() => {
+            // Reconnect after a short delay
+            setTimeout(subscribeEvents, 5000);
         });
 }
 
+// Live preview of the strip over a WebSocket
+// Messages start with "F" (full frame) or "D" (changed pixels only) and the number of pixels,
+// the server downsamples to at most as many pixels as the canvas is wide
+let previewPixels = new Uint8Array(0);
+function drawPreview() {
+    const context = previewCanvas.getContext("2d");
+    const count = previewPixels.length / 3;
+    const width = previewCanvas.width / count;
+    for (let i = 0; i < count; i++) {
+        context.fillStyle = `rgb(${previewPixels[i * 3]}, ${previewPixels[i * 3 + 1]}, ${previewPixels[i * 3 + 2]})`;
+        context.fillRect(Math.floor(i * width), 0, Math.ceil(width), previewCanvas.height);
+    }
+}
+
+function handlePreviewMessage(event) {
+    const view = new DataView(event.data);
+    const kind = String.fromCharCode(view.getUint8(0));
+    const count = view.getUint16(1, true);
+    if (previewPixels.length !== count * 3) {
+        previewPixels = new Uint8Array(count * 3);
+    }
+    if (kind === "F") {
+        previewPixels.set(new Uint8Array(event.data, 3, count * 3));
+    } else if (kind === "D") {
+        for (let offset = 3; offset + 5 <= event.data.byteLength; offset += 5) {
+            const index = view.getUint16(offset, true);
+            previewPixels.set(new Uint8Array(event.data, offset + 2, 3), index * 3);
+        }
+    }
+    drawPreview();
+}
+
+function connectPreview() {
+    const protocol = location.protocol === "https:" ? "wss:" : "ws:";
+    const socket = new WebSocket(`${protocol}//${location.host}/api/v1/preview?fps=20&pixels=${previewCanvas.width}`);
+    socket.binaryType = "arraybuffer";
+    socket.addEventListener("message", handlePreviewMessage);
+    // Reconnect after a short delay
+    socket.addEventListener("close", () => setTimeout(connectPreview, 5000));
+}
+
 let setTaskRequest = null;
+let taskNames = null;
+let taskDetails = {};       // load status and parameters of every task
+// Build a button for every task, again whenever tasks are added or removed on the server
+function showTaskList(data) {
+    taskDetails = data.details || {};
+    if (taskNames !== data.tasks.join()) {
+        taskNames = data.tasks.join();
+        tasksContainer.replaceChildren();
+        data.tasks.forEach((task) => {
+            let taskElement;
+            if (task === "static") {
+                taskElement = document.createElement("input");
+                taskElement.type = "color";
+                taskElement.className = "task-button";
+                taskElement.setAttribute("data-task", task);
+
+                function handleStaticColorChange(event) {
+                    const rgb = event.target.value;
+                    const arg = { color: [parseInt(rgb.slice(1, 3), 16), parseInt(rgb.slice(3, 5), 16), parseInt(rgb.slice(5, 7), 16)] };
+                    // Once it's running, only the colour changes
+                    if (currentTask === "static") {
+                        setTaskRequest = sendParams(arg);
+                        return;
+                    }
+                    setTaskRequest = fetch("/api/v1/task", {
+                        method: "POST",
+                        headers: { "Content-Type": "application/json", 'Authorization': `Bearer ${authKey}` },
+                        body: JSON.stringify({ task: "static", arg: arg }),
+                    });
+                }
+                taskElement.addEventListener("input", handleStaticColorChange);
+                taskElement.addEventListener("focus", handleStaticColorChange);
+            } else {
+                taskElement = document.createElement("button");
+                taskElement.textContent = task;
+                taskElement.className = "task-button";
+                taskElement.setAttribute("data-task", task);
+                taskElement.addEventListener("click", () => {
+                    // abort previous setTaskRequest if it exists and is still in flight
+                    if (setTaskRequest && setTaskRequest.status === 0) {
+                        setTaskRequest.abort();
+                    }
+                    setTaskRequest = fetch("/api/v1/task", {
+                        method: "POST",
+                        headers: { "Content-Type": "application/json", 'Authorization': `Bearer ${authKey}` },
+                        body: JSON.stringify({ task: task }),
+                    });
+                });
+            }
+            tasksContainer.appendChild(taskElement);
+        });
+    }
+    // Show why a task failed to load when hovering over it
+    document.querySelectorAll(".task-button").forEach((button) => {
+        const details = taskDetails[button.getAttribute("data-task")];
+        button.title = details && details.error ? details.error : "";
+    });
+    // Highlight the current task, in case its event arrived before the buttons existed
+    updateTasks();
+    paramsTask = null;
+    showParams();
+    // The alarms can start any task
+    if (lastAlarm) {
+        showAlarmList();
+    }
+}
+
 function initializeTasks() {
     fetch("/api/v1/tasks",
         {headers: {
@@ -104,63 +353,17 @@ function initializeTasks() {
             },
         })
         .then((response) => response.json())
-        .then((data) => {
-            data.tasks.forEach((task) => {
-                let taskElement;
-                if (task === "static") {
-                    taskElement = document.createElement("input");
-                    taskElement.type = "color";
-                    taskElement.className = "task-button";
-                    taskElement.setAttribute("data-task", task);
-
-                    function handleStaticColorChange(event) {
-                        const rgb = event.target.value;
-                        setTaskRequest = fetch("/api/v1/task", {
-                            method: "POST",
-                            headers: { "Content-Type": "application/json", 'Authorization': `Bearer ${authKey}` },
-                            body: JSON.stringify({ task: "static", arg: [parseInt(rgb.slice(1, 3), 16), parseInt(rgb.slice(3, 5), 16), parseInt(rgb.slice(5, 7), 16)] }),
-                        });
-                        setTaskRequest.then(() => {
-                            updateTasks();
-                        });
-                    }
-                    taskElement.addEventListener("input", handleStaticColorChange);
-                    taskElement.addEventListener("focus", handleStaticColorChange);
-                } else {
-                    taskElement = document.createElement("button");
-                    taskElement.textContent = task;
-                    taskElement.className = "task-button";
-                    taskElement.setAttribute("data-task", task);
-                    taskElement.addEventListener("click", () => {
-                        // abort previous setTaskRequest if it exists and is still in flight
-                        if (setTaskRequest && setTaskRequest.status === 0) {
-                            setTaskRequest.abort();
-                        }
-                        setTaskRequest = fetch("/api/v1/task", {
-                            method: "POST",
-                            headers: { "Content-Type": "application/json", 'Authorization': `Bearer ${authKey}` },
-                            body: JSON.stringify({ task: task }),
-                        });
-                        setTaskRequest.then(() => {
-                            updateTasks();
-                        });
-                    });
-                }
-                tasksContainer.appendChild(taskElement);
-            });
-            updateTasks();
-        });
+        .then(showTaskList);
 }
 
 function init() {
-    updateAlarm();
     initializeTasks();
-    alarmUpdateInterval = setInterval(updateAlarm, 60000);
-    taskUpdateInterval = setInterval(updateTasks, 60000);
+    subscribeEvents();
+    connectPreview();
+    countdownInterval = setInterval(showCountdown, 30000);
 }
 
-alarmTimeInput.addEventListener("change", sendAlarmUpdate);
-alarmEnabledInput.addEventListener("change", sendAlarmUpdate);
-dayCheckboxes.forEach(cb => cb.addEventListener("change", sendAlarmUpdate));
+addAlarmButton.addEventListener("click", addAlarm);
+brightnessInput.addEventListener("input", sendBrightnessUpdate);
 
 init();
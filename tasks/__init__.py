@@ -0,0 +1,298 @@
+"""Tasks which can run on the LED strip
+Every module in this package is a task with a function of the same name,
+apart from the helper modules listed in HELPER_MODULES
+
+A task can declare its parameters in PARAMS, a dictionary of the spec of
+each one by name:
+    type         "number", "integer", "boolean", "color" ([r, g, b], 0-255) or "choice"
+    default      its value if it isn't given (None: not set, the task decides)
+    min, max     range of a number or an integer
+    choices      values of a choice
+    unit, label  for the frontend
+    live         False if it only applies when the task starts (True by default)
+and PRESETS, other task names which run it with some parameters set, by
+name. Both are literals, so they are read without importing the task. The
+task function is then called with the parameters (a Params) instead of the
+argument it was given, and reads them while it runs, so they can be changed
+without starting it again. A task without PARAMS gets its argument as is."""
+import ast
+import importlib.util
+import logging
+import math
+import os
+import sys
+import threading
+import time
+
+# Modules which are not tasks
+HELPER_MODULES = ['__init__.py', 'common.py', 'particles.py', 'timeline.py', 'compositor.py']
+
+TASK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+log = logging.getLogger("neocontrol.engine.tasks")
+
+PARAM_TYPES = ["number", "integer", "boolean", "color", "choice"]
+params_lock = threading.Lock() # so a task can't finish while its parameters are being changed (see Params)
+
+def check_param(name: str, spec: dict, value):
+    """Value of a parameter, checked against its spec (and converted to its type), raises ValueError"""
+    kind = spec.get("type", "number")
+    if value is None:
+        if spec.get("default") is not None:
+            raise ValueError(f"{name} must be set")
+        return None
+    if kind in ("number", "integer"):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"{name} must be a number")
+        if kind == "integer" and value != int(value):
+            raise ValueError(f"{name} must be an integer")
+        value = int(value) if kind == "integer" else float(value)
+        if not spec.get("min", value) <= value <= spec.get("max", value):
+            raise ValueError(f"{name} must be between {spec.get('min')} and {spec.get('max')}")
+    elif kind == "boolean":
+        if not isinstance(value, bool):
+            raise ValueError(f"{name} must be true or false")
+    elif kind == "color":
+        if (not isinstance(value, (list, tuple)) or len(value) != 3
+                or any(isinstance(c, bool) or not isinstance(c, (int, float)) or not 0 <= c <= 255 for c in value)):
+            raise ValueError(f"{name} must be a colour, [red, green, blue] from 0 to 255")
+        value = tuple(value)
+    elif kind == "choice":
+        if value not in spec["choices"]:
+            raise ValueError(f"{name} must be one of {', '.join(map(str, spec['choices']))}")
+    else:
+        raise ValueError(f"{name} has an unknown type {kind}")
+    return value
+
+def check_params(schema: dict, values):
+    """Parameters in values (a dictionary, or the value on its own for a task with a single parameter), checked
+    against the schema, raises ValueError"""
+    if values is None:
+        return {}
+    if not isinstance(values, dict):
+        # Which is what the argument of a task like static was before there were parameters
+        if len(schema) != 1:
+            raise ValueError("parameters must be an object")
+        values = {next(iter(schema)): values}
+    unknown = values.keys() - schema.keys()
+    if unknown:
+        raise ValueError(f"unknown parameters {', '.join(sorted(unknown))}")
+    return {name: check_param(name, schema[name], value) for name, value in values.items()}
+
+def read_schema(path: str):
+    """PARAMS and PRESETS of a task file, read without importing it, raises ValueError (or OSError)"""
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), path)
+    found = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            if node.targets[0].id in ("PARAMS", "PRESETS"):
+                try:
+                    found[node.targets[0].id] = ast.literal_eval(node.value)
+                except ValueError as e:
+                    raise ValueError(f"{node.targets[0].id} must be a literal") from e
+    params, presets = found.get("PARAMS"), found.get("PRESETS") or {}
+    for name, spec in (params or {}).items():
+        if spec.get("type", "number") not in PARAM_TYPES:
+            raise ValueError(f"Parameter {name} has an unknown type {spec.get('type')}")
+        check_param(name, spec, spec.get("default"))
+    for name, values in presets.items():
+        check_params(params or {}, values)
+    return params, presets
+
+class Params(dict):
+    """Parameters of a running task, which can be changed while it runs
+
+    The task reads them whenever it needs them, and version counts the
+    changes, so it can tell when to work something out again. The render
+    loop only lets a task finish if they haven't changed since it last
+    rendered (see finish()), so a change is never missed: either the task
+    sees it, or update() says it has finished and has to be started again."""
+
+    def __init__(self, values: dict):
+        super().__init__(values)
+        self.version = 0
+        self.finished = False
+
+    def update(self, values: dict):
+        """Change some of the parameters, returns False if the task has finished"""
+        with params_lock:
+            super().update(values)
+            self.version += 1
+            return not self.finished
+
+    def finish(self, version: int):
+        """Mark the task as finished, unless the parameters have changed since version, returns whether it is"""
+        with params_lock:
+            self.finished = self.version == version
+            return self.finished
+
+class TaskRegistry:
+    """Every task in the tasks directory, imported the first time it's used
+
+    The directory is indexed by filename, without importing anything (only
+    the parameters and presets are read, see the package). A task is
+    imported when it's first asked for, and imported again when its file
+    has changed since: the new version is loaded into a new module, which
+    only replaces the old one if it loaded without errors. watch() keeps
+    checking the directory for new, changed and removed tasks.
+    A preset is a task of its own for everything but the import, which is
+    the one of its module. Helper modules are not reloaded."""
+
+    def __init__(self, directory: str = TASK_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.files = {}    # modification time of every task file, by task name
+        self.schemas = {}  # {"params", "presets", "error"} of every task file, by task name
+        self.presets = {}  # module of every preset, by preset name
+        self.loaded = {}   # {"function", "mtime", "load_time", "error"} of every task which has been imported
+        self.scan()
+
+    def scan(self):
+        """Update the index from the directory, returns the names of the tasks which were added, changed or removed
+        (with the presets of the modules which were)"""
+        files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.py') and entry.name not in HELPER_MODULES:
+                    files[entry.name[:-3]] = entry.stat().st_mtime
+        with self.lock:
+            changed = {name for name in files.keys() | self.files.keys() if files.get(name) != self.files.get(name)}
+        schemas = {}
+        for name in changed & files.keys():
+            try:
+                params, presets = read_schema(os.path.join(self.directory, f'{name}.py'))
+                schemas[name] = {"params": params, "presets": presets, "error": None}
+            except (OSError, SyntaxError, ValueError) as e:
+                log.warning("Failed to read the parameters of task %s: %s", name, e)
+                schemas[name] = {"params": None, "presets": {}, "error": repr(e)}
+        with self.lock:
+            changed |= {preset for preset, name in self.presets.items() if name in changed}
+            self.files = files
+            for name in changed - files.keys():
+                self.loaded.pop(name, None)
+                self.schemas.pop(name, None)
+            self.schemas.update(schemas)
+            self.presets = {}
+            for name in sorted(self.schemas):
+                for preset in self.schemas[name]["presets"]:
+                    if preset in files or preset in self.presets:
+                        log.warning("Preset %s of task %s is already a task", preset, name)
+                    else:
+                        self.presets[preset] = name
+            changed |= {preset for preset, name in self.presets.items() if name in changed}
+        return changed
+
+    def names(self):
+        """Names of all the tasks (and presets), sorted"""
+        with self.lock:
+            return sorted([*self.files, *self.presets])
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.files or name in self.presets
+
+    def module(self, name):
+        """Name of the module of a task, which is the task's own name unless it's a preset"""
+        with self.lock:
+            return self.presets.get(name, name)
+
+    def schema(self, name):
+        """Parameters of a task, with the defaults of its preset, None if it has none, raises KeyError"""
+        with self.lock:
+            return self.preset_schema(name)
+
+    def preset_schema(self, name):
+        """Parameters of a task, see schema() (with the lock held)"""
+        module = self.presets.get(name, name)
+        if module not in self.files:
+            raise KeyError(name)
+        params = self.schemas[module]["params"]
+        if params is None:
+            return None
+        preset = self.schemas[module]["presets"].get(name, {})
+        return {param: {**spec, "default": preset.get(param, spec.get("default"))} for param, spec in params.items()}
+
+    def params(self, name, arg=None):
+        """Parameters to start a task with: the defaults (of its preset) and the ones in arg, as a Params
+        (or arg as it is, for a task without parameters), raises ValueError and KeyError"""
+        schema = self.schema(name)
+        if schema is None:
+            return arg
+        return Params({**{param: spec.get("default") for param, spec in schema.items()}, **check_params(schema, arg)})
+
+    def __getitem__(self, name):
+        """Task function by name, imported (or reloaded, if its file has changed) as needed"""
+        with self.lock:
+            name = self.presets.get(name, name)
+            if name not in self.files:
+                raise KeyError(name)
+            loaded = self.loaded.get(name)
+            if loaded is None or loaded["mtime"] != self.files[name]:
+                loaded = self.load(name, self.files[name])
+            if loaded["function"] is None:
+                raise ImportError(f"Task {name} failed to load: {loaded['error']}")
+            return loaded["function"]
+
+    def load(self, name: str, mtime: float):
+        """Import a task into a new module (with the lock held)
+        On failure, the previous version (if any) stays in use, and the error is kept"""
+        start = time.perf_counter()
+        module_name = f'{__name__}.{name}'
+        previous = self.loaded.get(name, {"function": None})
+        try:
+            spec = importlib.util.spec_from_file_location(module_name, os.path.join(self.directory, f'{name}.py'))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            function = getattr(module, name)
+        except Exception as e: # pylint: disable=broad-except
+            log.warning("Failed to load task %s", name, exc_info=True)
+            loaded = {**previous, "mtime": mtime, "load_time": time.perf_counter() - start, "error": repr(e)}
+        else:
+            # Swap in the new version, for render processes and anything else which imports it by name
+            sys.modules[module_name] = module
+            loaded = {"function": function, "mtime": mtime, "load_time": time.perf_counter() - start, "error": None}
+            log.info("Loaded task %s in %.1f ms", name, loaded['load_time'] * 1000)
+        self.loaded[name] = loaded
+        return loaded
+
+    def reload_changed(self):
+        """Scan the directory, and reload the imported tasks which have changed
+        Returns the names of the tasks which were added, changed or removed"""
+        changed = self.scan()
+        for name in changed:
+            with self.lock:
+                if name in self.loaded and name in self.files:
+                    self.load(name, self.files[name])
+        return changed
+
+    def status(self):
+        """Load status of every task: whether it's loaded, how long that took (ms) and the last error,
+        its parameters (see schema()), and the task it's a preset of (None if it isn't one)"""
+        with self.lock:
+            status = {}
+            for name in sorted([*self.files, *self.presets]):
+                module = self.presets.get(name, name)
+                loaded = self.loaded.get(module)
+                error = self.schemas[module]["error"]
+                if loaded is None:
+                    status[name] = {"loaded": False, "load_ms": None, "error": error}
+                else:
+                    status[name] = {"loaded": loaded["function"] is not None, "load_ms": loaded["load_time"]*1000,
+                                    "error": loaded["error"] or error}
+                status[name]["params"] = self.preset_schema(name)
+                status[name]["preset_of"] = module if module != name else None
+            return status
+
+    def watch(self, interval: float = 2.0, on_change=None):
+        """Check the directory every interval seconds in a background thread
+        on_change(names) is called with the tasks which were added, changed or removed"""
+        def poll():
+            while True:
+                time.sleep(interval)
+                changed = self.reload_changed()
+                if changed and on_change is not None:
+                    on_change(changed)
+        thread = threading.Thread(target=poll, daemon=True)
+        thread.start()
+        return thread
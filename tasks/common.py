@@ -1,52 +1,117 @@
 """Common functions for all tasks"""
+import collections
 import datetime
-import math         # pylint: disable=unused-import
-import random       # pylint: disable=unused-import
-import threading    # pylint: disable=unused-import
-import time         # pylint: disable=unused-import
-import numpy as np  # pylint: disable=unused-import
+import functools
+import importlib
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from . import Params
 
 now = datetime.datetime.now
+log = logging.getLogger("neocontrol.engine.tasks")
+
+class EmulatedPixelStrip:
+    """In-memory rpi_ws281x-like strip, for running and benchmarking without the hardware
+
+    Pixels are kept in a NumPy array of packed colours. show() behaves like the
+    real one: it waits for the previous frame to finish going down the wire
+    (24 bits per LED at freq_hz, plus the reset time), latches the frame, and
+    returns while the new one is "sent". The most recent shown frames can be
+    kept in a ring buffer, and verbose logs a line (at DEBUG) for every show()."""
+
+    RESET_TIME = 55e-6 # Seconds of low signal which latch a frame, as in rpi_ws281x
+
+    def __init__(self, num, pin=18, freq_hz=800000, dma=10, invert=False, brightness=255, channel=0, strip_type=None, # pylint: disable=unused-argument,too-many-arguments
+                 record: int = 0, verbose: bool = None):
+        self.num_pixels = num
+        self.freq_hz = freq_hz
+        self.brightness = brightness
+        self.verbose = os.environ.get("EMULATOR_VERBOSE") == "1" if verbose is None else verbose
+        self.pixels = np.zeros(num, dtype=np.uint32)
+        self.wire_time = num * 24 / freq_hz + self.RESET_TIME
+        self.busy_until = 0.0
+        self.shows = 0
+        # Ring buffer of shown frames (as the LEDs see them, after brightness) and when they were shown
+        self.recorded = np.zeros((record, num), dtype=np.uint32)
+        self.recorded_times = np.zeros(record)
+
+    def begin(self):
+        """Initialise the strip"""
+        log.info("Emulated strip: begin, %s pixels, %.2f ms per frame", self.num_pixels, self.wire_time * 1000)
+
+    def setPixelColor(self, n, color): # pylint: disable=invalid-name
+        """Set one pixel to a packed colour"""
+        self.pixels[n] = color
+
+    def getPixelColor(self, n): # pylint: disable=invalid-name
+        """Packed colour of one pixel"""
+        return int(self.pixels[n])
+
+    def __setitem__(self, pos, value):
+        """Set a pixel or a slice of pixels, like rpi_ws281x"""
+        self.pixels[pos] = value
+
+    def __getitem__(self, pos):
+        return self.pixels[pos]
+
+    def setBrightness(self, brightness): # pylint: disable=invalid-name
+        """Set the brightness applied when the frame is sent (0-255)"""
+        self.brightness = brightness
+
+    def getBrightness(self): # pylint: disable=invalid-name
+        """Brightness applied when the frame is sent (0-255)"""
+        return self.brightness
+
+    def show(self):
+        """Wait for the previous frame to be sent, then start sending this one"""
+        wait = self.busy_until - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        self.busy_until = time.perf_counter() + self.wire_time
+        if len(self.recorded):
+            # Scale every channel by the brightness, like rpi_ws281x does when it sends the frame
+            channels = (self.pixels[:,np.newaxis] >> np.array([24, 16, 8, 0], dtype=np.uint32)) & 0xFF
+            channels = (channels * (self.brightness + 1)) >> 8
+            slot = self.shows % len(self.recorded)
+            self.recorded[slot] = (channels << np.array([24, 16, 8, 0], dtype=np.uint32)).sum(axis=1)
+            self.recorded_times[slot] = time.monotonic()
+        self.shows += 1
+        if self.verbose:
+            log.debug("Emulated strip: show %s", self.shows)
+
+    def frames(self):
+        """The recorded frames, oldest first, and the times they were shown"""
+        count = min(self.shows, len(self.recorded))
+        order = (np.arange(self.shows - count, self.shows)) % max(len(self.recorded), 1)
+        return self.recorded[order], self.recorded_times[order]
+
+    def numPixels(self): # pylint: disable=invalid-name
+        """Number of pixels in the strip"""
+        return self.num_pixels
+
+    def getPixels(self): # pylint: disable=invalid-name
+        """All the pixels, as packed colours"""
+        return self.pixels
+
+def EmulatedColor(red, green, blue, white=0): # pylint: disable=invalid-name
+    """Pack a colour the same way as rpi_ws281x.Color"""
+    return (white << 24) | (red << 16) | (green << 8) | blue
 
 # Check if rpi_ws281x library is available
 try:
     import rpi_ws281x as ws # type: ignore
 except ImportError:
-    # Define dummy class for local testing
-    class DummyPixelStrip:
-        """Dummy rpi_ws281x-like class for local testing"""
-        def __init__(self, *args, **kwargs): # pylint: disable=unused-argument
-            self.num_pixels = kwargs.get('led_count', 4)
-
-        def begin(self):
-            """Dummy begin method"""
-            print(f"[{now()}] Dummy strip: begin")
-
-        def setPixelColor(self, i, color_obj): # pylint: disable=invalid-name
-            """Dummy setPixelColor method"""
-            print(f"[{now()}] Dummy strip: set pixel[{i}] to {color_obj}")
-
-        def show(self):
-            """Dummy show method"""
-            print(f"[{now()}] Dummy strip: show")
-
-        def numPixels(self): # pylint: disable=invalid-name
-            """Dummy numPixels method"""
-            return self.num_pixels
-        
-        def getPixels(self):
-            """Dummy getPixels method"""
-            return [0]*self.num_pixels
-
-    def DummyColor(*color): # pylint: disable=invalid-name
-        """Dummy Color method"""
-        return color
-
-    # Replace rpi_ws281x with dummy implementation
-    ws = type("Dummy_rpi_ws281x", (object,), { # pylint: disable=invalid-name
-        "PixelStrip": DummyPixelStrip,
-        "Color": DummyColor,
-        "WS2811_STRIP_GRB": "Dummy_WS2811_STRIP_GRB"
+    # Replace rpi_ws281x with the emulated strip for local testing
+    ws = type("Emulated_rpi_ws281x", (object,), { # pylint: disable=invalid-name
+        "PixelStrip": EmulatedPixelStrip,
+        "Color": EmulatedColor,
+        "WS2811_STRIP_GRB": "Emulated_WS2811_STRIP_GRB"
     })
 
 def black_body_rgb(temp,brightness=1.0):
@@ -73,27 +138,71 @@ def black_body_rgb(temp,brightness=1.0):
         blu = 138.5177312231 * math.log(blu) - 305.0447927307
     return red*brightness, grn*brightness, blu*brightness
 
-def generate_temp_lut(min_temp=500, max_temp=25000, step=0.02):
-    """Function to generate a lookup table for black body temperature estimation"""
-    lut = {}
+def black_body_rgb_array(temp, brightness=1.0):
+    """Function to calculate an (N,3) array of RGB from an array of black body temperatures
+    Same results as black_body_rgb, but for many temperatures at once"""
+    temp = np.asarray(temp, dtype=float) / 100.0
+    brightness = np.clip(brightness, 0, 1)
+    low = temp <= 66
+    red = np.full(temp.shape, 255.0)
+    grn = np.empty(temp.shape)
+    blu = np.full(temp.shape, 255.0)
+    grn[low] = 99.4708025861 * np.log(temp[low]) - 161.1195681661
+    red[~low] = 329.698727446 * ((temp[~low] - 60) ** -0.1332047592)
+    grn[~low] = 288.1221695283 * ((temp[~low] - 60) ** -0.0755148492)
+    blu[temp <= 19] = 0
+    mid = (temp > 19) & (temp < 66)
+    blu[mid] = 138.5177312231 * np.log(temp[mid] - 10) - 305.0447927307
+    return np.stack((red, grn, blu), axis=-1) * np.asarray(brightness)[..., np.newaxis]
+
+class BlackBodyTable:
+    """Lookup table of black body colours on an evenly spaced grid of temperatures
 
-    temp = min_temp
-    while temp <= max_temp:
-        rgb = black_body_rgb(temp)
-        #lut[rgb] = temp
-        #only keep 2 decimal places
-        lut[rgb] = int(round(temp, 0))
-        temp *= 1+step
+    Going from temperature to colour is a direct index into the grid.
+    Going from colour to temperature is a nearest neighbour search: the
+    colours are projected onto their principal axis and sorted, so only the
+    colours whose projection is within reach of the best candidate have
+    to be compared."""
 
-    return lut
+    def __init__(self, min_temp=500, max_temp=25000, step=10):
+        self.min_temp = min_temp
+        self.step = step
+        self.temps = np.arange(min_temp, max_temp + step, step)
+        # The strip can only show 0-255, so compare against clamped colours
+        self.colors = np.clip(black_body_rgb_array(self.temps), 0, 255)
+        centred = self.colors - self.colors.mean(axis=0)
+        self.axis = np.linalg.svd(centred, full_matrices=False)[2][0]
+        projection = self.colors @ self.axis
+        self.order = np.argsort(projection)
+        self.sorted_projection = projection[self.order]
 
-temp_lut = generate_temp_lut()
+    def rgb(self, temp):
+        """Colour(s) of the grid temperature(s) closest to temp"""
+        index = np.rint((np.asarray(temp) - self.min_temp) / self.step).astype(int)
+        return self.colors[np.clip(index, 0, len(self.temps) - 1)]
 
+    def temperature(self, target_rgb):
+        """Temperature whose colour is closest to target_rgb"""
+        target_rgb = np.asarray(target_rgb, dtype=float)
+        target = target_rgb @ self.axis
+        # The colour with the closest projection gives an upper bound on the distance
+        start = min(int(np.searchsorted(self.sorted_projection, target)), len(self.order) - 1)
+        radius = np.sqrt(np.sum((self.colors[self.order[start]] - target_rgb) ** 2))
+        # Nothing further than that along the axis can be any closer
+        low = np.searchsorted(self.sorted_projection, target - radius, side='left')
+        high = np.searchsorted(self.sorted_projection, target + radius, side='right')
+        candidates = self.order[low:high]
+        dist = np.sum((self.colors[candidates] - target_rgb) ** 2, axis=1)
+        return int(self.temps[candidates[np.argmin(dist)]])
+
+@functools.cache
+def temp_lut():
+    """Black body lookup table, built the first time it is needed"""
+    return BlackBodyTable()
 
 def rgb_black_body(target_rgb=(255,255,255)):
     """Function to estimate black body temperature from RGB"""
-    closest_rgb = min(temp_lut.keys(), key=lambda rgb: (rgb[0] - target_rgb[0]) ** 2 + (rgb[1] - target_rgb[1]) ** 2 + (rgb[2] - target_rgb[2]) ** 2)
-    return temp_lut[closest_rgb]
+    return temp_lut().temperature(target_rgb)
 
 def float_to_int(color):
     """Function to convert float RGB to int RGB and clamp values to 0-255"""
@@ -103,14 +212,126 @@ def packed24_to_rgb(packed):
     """Function to convert packed 24-bit RGB to tuple of ints"""
     return (packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF
 
+def rgb_to_packed24(rgb):
+    """Function to convert an (N,3) array of RGB values to packed 24-bit colours
+    This is the same layout that ws.Color produces, the strip_type given to
+    ws.PixelStrip takes care of reordering the channels (e.g. to GRB) on the wire"""
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    return (rgb[...,0] << 16) | (rgb[...,1] << 8) | rgb[...,2]
+
 def strip_to_rgb(strip: ws.PixelStrip):
-    """Function to convert strip to list of RGB tuples"""
-    color_data = strip.getPixels()
-    return [packed24_to_rgb(color_data[i]) for i in range(strip.numPixels())]
+    """Function to convert strip to an (N,3) array of RGB values"""
+    num_pixels = strip.numPixels()
+    color_data = np.array(strip.getPixels()[:num_pixels], dtype=np.uint32)
+    return np.stack(packed24_to_rgb(color_data), axis=-1).astype(np.uint8)
+
+def write_pixels(strip: ws.PixelStrip, packed):
+    """Function to write a whole frame of packed 24-bit colours to the strip
+    rpi_ws281x accepts slice assignment, which sets all the pixels in one call
+    instead of going through setPixelColor once per pixel"""
+    strip[0:len(packed)] = packed.tolist()
+
+class FrameBuffer:
+    """A whole frame of pixels, backed by an (N,3) NumPy array of 16-bit RGB values
+
+    The values are 8.8 fixed point (colour*256), so a colour 0-255 keeps
+    8 more bits of precision than the strip has. These are turned into 8-bit
+    colours on the way to the strip, by ColorCorrection or by truncating.
+    Tasks draw into the buffer with whole-array operations, and then send it
+    to the strip with a single call to show()"""
 
-def strip_to_temp(strip: ws.PixelStrip):
-    """Function to convert strip to average black body temperature"""
-    rgb_data = strip_to_rgb(strip)
+    def __init__(self, num_pixels: int):
+        self.pixels = np.zeros((num_pixels,3), dtype=np.uint16)
+        self.time = None # when the compositor made the frame (monotonic), to tell when it reaches the strip
+
+    @classmethod
+    def from_strip(cls, strip: ws.PixelStrip):
+        """Create a buffer holding whatever the strip currently shows"""
+        buffer = cls(strip.numPixels())
+        buffer.pixels[:] = strip_to_rgb(strip).astype(np.uint16) << 8
+        return buffer
+
+    def __len__(self):
+        return len(self.pixels)
+
+    def fill(self, color):
+        """Set every pixel to the same colour (0-255, fractions are kept)"""
+        self.pixels[:] = np.clip(np.asarray(color)*256, 0, 65535)
+
+    def set(self, colors):
+        """Set the pixels from an (N,3) array (or list of tuples) of floats or ints
+        Values are clamped to 0-255, and fractions are kept"""
+        self.pixels[:] = np.clip(np.asarray(colors)*256, 0, 65535)
+
+    def set_fixed(self, colors):
+        """Set the pixels from an (N,3) array of 8.8 fixed point values (colour*256)
+        Values are clamped to the 16-bit range"""
+        self.pixels[:] = np.clip(colors, 0, 65535)
+
+    def rgb(self):
+        """Return the frame as an (N,3) array of 8-bit colours (truncated)"""
+        return (self.pixels >> 8).astype(np.uint8)
+
+    def packed(self):
+        """Return the frame as an array of packed 24-bit colours"""
+        return rgb_to_packed24(self.rgb())
+
+    def show(self, strip: ws.PixelStrip, correction: "ColorCorrection" = None):
+        """Write the whole frame to the strip and send it to the LEDs
+        With a ColorCorrection, the frame goes through it instead of being truncated"""
+        if correction is None:
+            write_pixels(strip, self.packed())
+        else:
+            write_pixels(strip, rgb_to_packed24(correction.apply(self.pixels)))
+        strip.show()
+
+class ColorCorrection:
+    """Gamma and master brightness, applied to every frame on its way to the strip
+
+    A lookup table maps each 16-bit level to a corrected 8.8 fixed point
+    level, so the whole frame is corrected with one indexing operation.
+    The 8 fractional bits are then turned into temporal dithering: each
+    pixel is rounded up on the right share of frames (a colour of 10.25
+    shows 11 on a quarter of them), which gives the strip in-between levels
+    it can't otherwise show. Every pixel and channel starts at a different
+    point of the dithering sequence, so neighbouring LEDs don't step up
+    together (which is what would make a slow fade look banded).
+
+    The brightness can be changed at any time, it takes effect on the next
+    frame sent to the strip."""
+
+    DITHER_STEP = 40503 # 65536 / golden ratio, spreads the thresholds of consecutive frames evenly
+
+    def __init__(self, brightness: int = 255, gamma: float = 1.0, dither: bool = True):
+        self.gamma = gamma
+        self.dither = dither
+        self.frame = 0
+        self.offsets = None
+        self.set_brightness(brightness)
+
+    def set_brightness(self, brightness: int):
+        """Set the master brightness (0-255)"""
+        self.brightness = min(max(int(brightness), 0), 255)
+        # Colours only go up to 255 (65280 in 8.8), anything above is clamped
+        levels = np.minimum(np.arange(65536) / 65280, 1.0)
+        # Replace the table in one go, a frame being corrected keeps using the old one
+        self.lut = np.rint(levels**self.gamma * (self.brightness / 255) * 65280).astype(np.uint16)
+
+    def apply(self, pixels):
+        """Correct an (N,3) array of 16-bit levels, returns (N,3) 8-bit colours for the strip"""
+        levels = self.lut[pixels]
+        if not self.dither:
+            return (levels >> 8).astype(np.uint8)
+        if self.offsets is None or self.offsets.shape != pixels.shape:
+            self.offsets = np.random.default_rng(0).integers(0, 65536, pixels.shape, dtype=np.uint16)
+        self.frame += 1
+        # Threshold (0-255) of every pixel for this frame, added to the fraction so it carries
+        # over to the integer part as often as the fraction is large (at most 65280+255, no overflow)
+        threshold = (self.offsets + np.uint16(self.frame * self.DITHER_STEP & 0xFFFF)) >> 8
+        return ((levels + threshold) >> 8).astype(np.uint8)
+
+def rgb_to_temp(rgb_data):
+    """Function to convert an (N,3) array of RGB values to average black body temperature"""
     # Find the average colour of the strip
     avg_color = np.mean(rgb_data,axis=0)
     # scale it so that the largest component is 255
@@ -122,30 +343,6 @@ def strip_to_temp(strip: ws.PixelStrip):
     avg_color = rgb_black_body(avg_color)
     return avg_color
 
-def interpolate_strip(strip: ws.PixelStrip, exit_event:threading.Event, final_colors: list[tuple[int,int,int]], duration: float, curve: float = 0.5):
-    """Function to interpolate between initial strip state and final strip state"""
-    jitter = np.random.randint(0,255,(strip.numPixels(),3))
-    rgb_data = strip_to_rgb(strip)
-    rgb_data = np.array(rgb_data)*256
-    final_colors = np.array(final_colors)*256
-    diff = final_colors-rgb_data
-    start_time = time.time()
-    elapsed_time = 0
-    print(f"[{datetime.datetime.now()}] Interpolate strip over {duration} seconds")
-    while elapsed_time < duration and not exit_event.is_set():
-        frac = int(((elapsed_time / duration)**curve)*16536)
-        current = rgb_data+(frac*diff)//16536 + jitter
-        current = current.astype(int)
-        current >>= 8
-        for i in range(strip.numPixels()):
-            color = float_to_int(current[i])
-            color_obj = ws.Color(*color)
-            strip.setPixelColor(i,color_obj)
-        strip.show()
-        exit_event.wait(0.01)
-        elapsed_time = time.time() - start_time
-    print(f"[{datetime.datetime.now()}] Interpolation finished")
-
 def hsv_to_rgb(hue, sat, val):
     """Function to calculate RGB from HSV
     Range: h: 0-1, s: 0-1, v: 0-1"""
@@ -168,11 +365,438 @@ def hsv_to_rgb(hue, sat, val):
     }
     return switcher.get(c_1 % 6, (0,0,0))
 
-def fill(strip: ws.PixelStrip, color = None):
-    """Function to fill the whole strip with a single colour"""
-    if color is not None:
-        print(f"[{datetime.datetime.now()}] Fill with color {color}")
-        color_obj = ws.Color(*color)
-        for i in range(strip.numPixels()):
-            strip.setPixelColor(i,color_obj)
-        strip.show()
+def hsv_to_rgb_array(hue, sat, val):
+    """Function to calculate an (N,3) array of RGB from arrays of HSV
+    Same results as hsv_to_rgb, but for a whole strip at once"""
+    hue, sat, val = np.broadcast_arrays(np.asarray(hue, dtype=float), sat, val)
+    c_1 = np.trunc(hue*6.0).astype(int)
+    c_2 = (hue*6.0) - c_1
+    p_1 = (255*(val*(1.0 - sat))).astype(int)
+    p_2 = (255*(val*(1.0 - sat*c_2))).astype(int)
+    p_3 = (255*(val*(1.0 - sat*(1.0 - c_2)))).astype(int)
+    val = (255*val).astype(int)
+    # All six cases of the switcher in hsv_to_rgb, picked per pixel
+    cases = np.stack([
+        np.stack((val, p_3, p_1), axis=-1),
+        np.stack((p_2, val, p_1), axis=-1),
+        np.stack((p_1, val, p_3), axis=-1),
+        np.stack((p_1, p_2, val), axis=-1),
+        np.stack((p_3, p_1, val), axis=-1),
+        np.stack((val, p_1, p_2), axis=-1),
+    ])
+    rgb = np.take_along_axis(cases, (c_1 % 6)[np.newaxis,...,np.newaxis], axis=0)[0]
+    rgb[sat == 0.0] = 0
+    return rgb
+
+# Tasks are functions taking the number of pixels and an optional argument,
+# and returning a render callback: render(t, dt, buffer) is called once per
+# frame with the time since the task started, the time since the previous
+# frame, and the FrameBuffer to draw into (which still holds the previous
+# frame). It returns True while there are more frames to come, and False
+# once the buffer holds the final frame of the task.
+
+def fill_color(color = None):
+    """Render callback which fills the whole strip with a single colour"""
+    def render(t, dt, buffer):
+        if color is not None:
+            log.debug("Fill with color %s", color)
+            buffer.fill(color)
+        return False
+    return render
+
+def hold(duration: float):
+    """Render callback which keeps the current frame for duration seconds"""
+    def render(t, dt, buffer):
+        return t < duration
+    return render
+
+def fade_to(final_colors, duration: float, curve: float = 0.5):
+    """Render callback which interpolates from the current frame to final_colors
+    final_colors is either a single colour or one colour per pixel"""
+    rgb_data = diff = None
+    def render(t, dt, buffer):
+        nonlocal rgb_data, diff
+        if rgb_data is None:
+            # Start from whatever the previous task left in the buffer
+            log.debug("Interpolate strip over %s seconds", duration)
+            rgb_data = buffer.pixels.astype(np.int64)
+            # Fractions of the final colours are kept, the output stage dithers them
+            diff = np.rint(np.asarray(final_colors, dtype=float)*256).astype(np.int64) - rgb_data
+        if t >= duration:
+            buffer.set(np.broadcast_to(final_colors, buffer.pixels.shape))
+            log.debug("Interpolation finished")
+            return False
+        frac = int(((t / duration)**curve)*16536)
+        buffer.set_fixed(rgb_data+(frac*diff)//16536)
+        return True
+    return render
+
+def sequence(*renders):
+    """Render callback which runs several render callbacks one after another
+    Each one gets its own time, starting from 0 when the previous one finishes"""
+    renders = list(renders)
+    start_time = 0.0
+    def render(t, dt, buffer):
+        nonlocal start_time
+        if renders and not renders[0](t - start_time, dt, buffer):
+            # This one is finished, the next one starts from the next frame
+            renders.pop(0)
+            start_time = t
+        return bool(renders)
+    return render
+
+class FrameStats:
+    """Frame counters and latency samples collected by the render loop and output stage"""
+
+    def __init__(self, window: int = 1000):
+        self.lock = threading.Lock()
+        self.rendered = 0
+        self.shown = 0
+        self.dropped = 0
+        self.replaced = 0
+        self.suppressed = 0
+        # Only the most recent frames are kept for the percentiles
+        self.render_times = collections.deque(maxlen=window)
+        self.show_times = collections.deque(maxlen=window)
+        self.first_frame = None # when the first frame was handed over (monotonic)
+        self.started = threading.Event() # set then
+
+    def add_render(self, render_time: float):
+        """Record a frame which was rendered"""
+        with self.lock:
+            self.rendered += 1
+            self.render_times.append(render_time)
+
+    def add_show(self, show_time: float):
+        """Record a frame which was sent to the strip"""
+        with self.lock:
+            self.shown += 1
+            self.show_times.append(show_time)
+
+    def add_first_frame(self):
+        """Record that the first frame has been handed over (only the first call counts)"""
+        with self.lock:
+            if self.first_frame is None:
+                self.first_frame = time.monotonic()
+                self.started.set()
+
+    def add_dropped(self, count: int):
+        """Record frames which were skipped because a frame went over budget"""
+        with self.lock:
+            self.dropped += count
+
+    def add_replaced(self):
+        """Record a rendered frame which was replaced by a newer one before it could be sent"""
+        with self.lock:
+            self.replaced += 1
+
+    def add_suppressed(self):
+        """Record a frame which was not sent, because it was identical to the previous one"""
+        with self.lock:
+            self.suppressed += 1
+
+    def as_dict(self):
+        """Counters and latency percentiles (in milliseconds), ready for JSON"""
+        def percentiles(samples):
+            if not samples:
+                return None
+            values = np.percentile(np.array(samples)*1000, [50, 90, 99])
+            return {"p50": values[0], "p90": values[1], "p99": values[2], "max": max(samples)*1000}
+        with self.lock:
+            return {
+                "rendered": self.rendered,
+                "shown": self.shown,
+                "dropped": self.dropped,
+                "replaced": self.replaced,
+                "suppressed": self.suppressed,
+                "render_ms": percentiles(self.render_times),
+                "show_ms": percentiles(self.show_times),
+            }
+
+class OutputStage:
+    """Sends rendered frames to the strip
+
+    In synchronous mode, submit() shows the frame straight away, so render
+    time and the time spent in strip.show() add up. In threaded mode there
+    is a pair of buffers: submit() copies the frame into the back buffer and
+    returns, while a sender thread swaps it to the front and shows it. The
+    next frame is then rendered while the previous one is on the wire. If
+    a newer frame is submitted before the sender gets to the back buffer,
+    the older one is replaced and never shown.
+
+    A frame identical to the previous one is not sent at all, unless the
+    strip hasn't been refreshed for keepalive seconds. In threaded mode the
+    sender also refreshes the strip after keepalive seconds without frames.
+
+    Every frame sent goes through the colour correction (gamma, master
+    brightness and dithering) on the way to the strip."""
+
+    def __init__(self, strip: ws.PixelStrip, threaded: bool = True, keepalive: float = 10.0, correction: ColorCorrection = None):
+        self.strip = strip
+        self.threaded = threaded
+        self.keepalive = keepalive
+        self.correction = correction or ColorCorrection()
+        self.last_show = time.monotonic()
+        # Start from what the strip is showing
+        self.front = FrameBuffer.from_strip(strip)
+        self.back = FrameBuffer(len(self.front))
+        self.back.pixels[:] = self.front.pixels
+        self.pending = False    # back buffer holds a frame which hasn't been sent yet
+        self.stats = None       # statistics of the task which submitted the pending frame
+        self.shown = (None, self.last_show) # (time of the frame the strip shows, when it got there)
+        self.condition = threading.Condition()
+        if threaded:
+            threading.Thread(target=self.send_frames, daemon=True).start()
+
+    def last_frame(self):
+        """Copy of the most recently submitted frame"""
+        with self.condition:
+            return self.back.pixels.copy()
+
+    def keepalive_due(self):
+        """Whether the strip should be refreshed even if nothing has changed"""
+        return time.monotonic() - self.last_show >= self.keepalive
+
+    def submit(self, buffer: FrameBuffer, stats: FrameStats):
+        """Queue a frame to be sent to the strip (or send it now, if not threaded)"""
+        if not self.threaded:
+            if np.array_equal(buffer.pixels, self.back.pixels) and not self.keepalive_due():
+                stats.add_suppressed()
+                return
+            with self.condition:
+                show_start = time.perf_counter()
+                buffer.show(self.strip, self.correction)
+                self.last_show = time.monotonic()
+                stats.add_show(time.perf_counter() - show_start)
+                self.back.pixels[:] = buffer.pixels
+                self.shown = (buffer.time, self.last_show)
+                self.condition.notify_all()
+            return
+        with self.condition:
+            # Same as the newest frame (whether it has been sent yet or not)
+            if np.array_equal(buffer.pixels, self.back.pixels) and not self.keepalive_due():
+                stats.add_suppressed()
+                if self.pending:
+                    self.back.time = buffer.time
+                else:
+                    # Already on the strip
+                    self.shown = (buffer.time, time.monotonic())
+                    self.condition.notify_all()
+            else:
+                if self.pending:
+                    self.stats.add_replaced()
+                self.back.pixels[:] = buffer.pixels
+                self.back.time = buffer.time
+                self.pending = True
+                self.condition.notify()
+            self.stats = stats
+
+    def send_frames(self):
+        """Sender thread: show the newest frame whenever there is one"""
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.condition.wait(self.keepalive)
+                if self.pending:
+                    # Swap, so the renderer can write the next frame into the back buffer
+                    self.front, self.back = self.back, self.front
+                    self.back.pixels[:] = self.front.pixels
+                    self.back.time = self.front.time
+                    self.pending = False
+                elif not self.keepalive_due():
+                    continue
+                # Otherwise nothing new has come in for a while, so send the front buffer again
+                stats = self.stats
+            show_start = time.perf_counter()
+            self.front.show(self.strip, self.correction)
+            self.last_show = time.monotonic()
+            if stats is not None:
+                stats.add_show(time.perf_counter() - show_start)
+            with self.condition:
+                self.shown = (self.front.time, self.last_show)
+                self.condition.notify_all()
+
+    def wait_shown(self, since: float, timeout: float):
+        """Wait until the strip shows a frame the compositor made after since (monotonic)
+        Returns when it got there, or None if it didn't within timeout seconds"""
+        with self.condition:
+            if self.condition.wait_for(lambda: self.shown[0] is not None and self.shown[0] > since, timeout):
+                return self.shown[1]
+            return None
+
+    def set_brightness(self, brightness: int):
+        """Change the master brightness, and send the newest frame again with it"""
+        self.correction.set_brightness(brightness)
+        with self.condition:
+            if self.threaded:
+                self.pending = True
+                self.condition.notify()
+            else:
+                self.back.show(self.strip, self.correction)
+                self.last_show = time.monotonic()
+
+def run_frames(output: OutputStage, exit_event: threading.Event, render, fps: float, stats: FrameStats = None,
+               buffer: FrameBuffer = None, start_time: float = None, params=None):
+    """Render loop: call render(t, dt, buffer) at a fixed frame rate and output every frame
+
+    Each frame has a deadline, and the loop sleeps until the next one. If a
+    frame takes longer than its budget, the frames which could not be shown
+    in time are skipped (and counted as dropped) rather than slowing down the
+    animation, which always gets the real time since the task started.
+    A task whose first frame was rendered ahead of time (into buffer, and
+    already handed over at start_time) carries on from there.
+    With the task's parameters (a Params), an fps in them sets the frame
+    rate instead, and a task which finishes just as they change carries on."""
+    stats = stats or FrameStats()
+    live = isinstance(params, Params)
+    if buffer is None:
+        # Start from the last frame, so tasks can fade from it
+        last = output.last_frame()
+        buffer = FrameBuffer(len(last))
+        buffer.pixels[:] = last
+    start_time = time.monotonic() if start_time is None else start_time
+    deadline = start_time
+    last_t = 0.0
+    while not exit_event.is_set():
+        t = time.monotonic() - start_time
+        version = params.version if live else None
+        render_start = time.perf_counter()
+        running = render(t, t - last_t, buffer)
+        stats.add_render(time.perf_counter() - render_start)
+        output.submit(buffer, stats)
+        stats.add_first_frame()
+        last_t = t
+        if not running and (not live or params.finish(version)):
+            break
+        period = 1.0 / ((params.get("fps") if live else None) or fps)
+        deadline += period
+        late = time.monotonic() - deadline
+        if late > 0:
+            # Over budget: give up on the frames we have missed instead of catching up
+            missed = int(late // period) + 1
+            stats.add_dropped(missed)
+            deadline += missed * period
+        exit_event.wait(deadline - time.monotonic())
+
+class SharedFrame:
+    """A frame in shared memory, written by a render process and read by its parent
+
+    It has the same submit() and last_frame() methods as OutputStage, so
+    run_frames can render into it. The header holds a sequence number which
+    is odd while a frame is being written (a seqlock), the number of dropped
+    frames, a flag set when the task has finished, and the render time of
+    the latest frame."""
+
+    HEADER_SIZE = 32
+
+    def __init__(self, num_pixels: int, name: str = None):
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=self.HEADER_SIZE + num_pixels*3*2)
+        self.name = self.shm.name
+        self.counters = np.ndarray((3,), dtype=np.int64, buffer=self.shm.buf)
+        self.render_time = np.ndarray((1,), dtype=np.float64, buffer=self.shm.buf, offset=24)
+        self.pixels = np.ndarray((num_pixels,3), dtype=np.uint16, buffer=self.shm.buf, offset=self.HEADER_SIZE)
+
+    def last_frame(self):
+        """Copy of the frame in shared memory"""
+        return self.pixels.copy()
+
+    def submit(self, buffer: FrameBuffer, stats: FrameStats):
+        """Write a frame, along with the latest statistics"""
+        self.counters[0] += 1
+        self.pixels[:] = buffer.pixels
+        self.counters[1] = stats.dropped
+        self.render_time[0] = stats.render_times[-1]
+        self.counters[0] += 1
+
+    def read(self, pixels):
+        """Copy the frame into pixels, returns its sequence number (None if it was being written)"""
+        sequence = int(self.counters[0])
+        if sequence % 2:
+            return None
+        pixels[:] = self.pixels
+        if int(self.counters[0]) != sequence:
+            return None
+        return sequence
+
+    def finish(self):
+        """Mark the task as finished"""
+        self.counters[2] = 1
+
+    @property
+    def finished(self):
+        return bool(self.counters[2])
+
+    @property
+    def dropped(self):
+        return int(self.counters[1])
+
+    def close(self, unlink: bool = False):
+        """Release the shared memory (and free it, in the parent)"""
+        # The views have to go before the memory can be closed
+        del self.counters, self.render_time, self.pixels
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+# Render processes are forked from a fork server, not from the engine: a fork
+# of the engine would get its threads' locks in whatever state they were in
+# (like the timeline compile lock, or a logging lock), and its logging queue
+# with no listener thread to write it out. The fork server imports the main
+# script once (only what's at module level, which doesn't start anything) and
+# NumPy and the task helpers, so a render process still starts with them.
+process_context = multiprocessing.get_context("forkserver")
+process_context.set_forkserver_preload(["__main__", "tasks.common", "tasks.timeline"])
+
+def render_process(name: str, num_pixels: int, task: str, arg, fps: float):
+    """Entry point of a render process: run a task's render loop into shared memory
+    task is the name of the task's module (see TaskRegistry.module), arg its parameters"""
+    # (logs is in the same directory as the main script, which is on the path)
+    from logs import setup_direct_logging # pylint: disable=import-outside-toplevel
+    setup_direct_logging()
+    frame = SharedFrame(num_pixels, name)
+    module = importlib.import_module(f'tasks.{task}')
+    render = getattr(module, task)(num_pixels, arg)
+    # The parent terminates the process, so nothing ever sets the exit event
+    run_frames(frame, threading.Event(), render, fps, params=arg)
+    frame.finish()
+    frame.close()
+
+def run_in_process(output: OutputStage, exit_event: threading.Event, task: str, arg, fps: float, stats: FrameStats = None, kill_timeout: float = 1.0):
+    """Run a task in a render process, and pass its frames on to the output stage
+
+    Unlike run_frames, this doesn't rely on the task returning control: when
+    the exit event is set, the process is terminated (and killed if it hasn't
+    gone after kill_timeout seconds). Rendering also doesn't compete with the
+    web server for the GIL."""
+    stats = stats or FrameStats()
+    last = output.last_frame()
+    frame = SharedFrame(len(last))
+    # Start from the last frame, so tasks can fade from it
+    frame.pixels[:] = last
+    buffer = FrameBuffer(len(last))
+    process = process_context.Process(target=render_process, args=(frame.name, len(last), task, arg, fps), daemon=True)
+    process.start()
+    last_sequence = 0
+    try:
+        while not exit_event.wait(0.5 / fps):
+            finished = frame.finished
+            sequence = frame.read(buffer.pixels)
+            if sequence is not None and sequence != last_sequence:
+                frames = (sequence - last_sequence) // 2
+                # Frames which were overwritten before we got to them
+                for _ in range(frames - 1):
+                    stats.add_replaced()
+                stats.add_dropped(frame.dropped - stats.dropped)
+                stats.add_render(float(frame.render_time[0]))
+                output.submit(buffer, stats)
+                stats.add_first_frame()
+                last_sequence = sequence
+            elif finished or not process.is_alive():
+                break
+    finally:
+        process.terminate()
+        process.join(kill_timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        frame.close(unlink=True)
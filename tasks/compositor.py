@@ -0,0 +1,278 @@
+"""Zones: logical segments of one or more physical strips, each running its own task
+
+A zone is a run of pixels on one of the physical strips (channels), which
+its task sees as a plain strip of len(zone) pixels. Reversed zones, and
+zigzag zones where every other row of pixels runs backwards, are remapped
+through index arrays worked out once, when the layout is set.
+
+A task renders into a layer of its zone, which has the submit() and
+last_frame() methods of an OutputStage, so a task's render loop (or render
+process) runs into it the same way it would run into the strip. Usually a
+zone has just the one layer, but when it switches tasks with a transition
+the old and the new task run side by side, each into its own layer, and
+the zone cross-fades between them until the old one is retired.
+
+The compositor thread combines the newest frame of every zone into one
+frame per physical strip, and passes those on to the strips' output
+stages. Zones are layered in order, later zones on top."""
+from .common import *
+
+BLEND_MODES = ("normal", "add", "max")
+
+def zone_indices(start: int, length: int, reverse: bool = False, zigzag: int = 0):
+    """Physical pixel of each logical pixel of a zone
+    zigzag is the length of a row, when every other row runs backwards"""
+    logical = np.arange(length)
+    if zigzag:
+        row, col = np.divmod(logical, zigzag)
+        logical = row * zigzag + np.where(row % 2, zigzag - 1 - col, col)
+    if reverse:
+        logical = logical[::-1]
+    return start + logical
+
+def blend_pixels(mode: str, below, above, opacity: float):
+    """Blend an (N,3) layer of 16-bit levels onto the ones below it"""
+    below = below.astype(np.float32)
+    above = above.astype(np.float32)
+    if mode == "add":
+        blended = below + above * opacity
+    elif mode == "max":
+        blended = np.maximum(below, above * opacity)
+    else:
+        blended = below + (above - below) * opacity
+    return np.clip(blended, 0, 65535)
+
+class Layer:
+    """What one task renders into: its zone, or one side of the zone during a transition"""
+
+    def __init__(self, zone: "Zone", pixels):
+        self.zone = zone
+        self.pixels = pixels
+
+    def last_frame(self):
+        """Copy of the newest frame of the layer"""
+        with self.zone.compositor.condition:
+            return self.pixels.copy()
+
+    def submit(self, buffer: FrameBuffer, stats: FrameStats):
+        """Hand a frame over to the compositor"""
+        compositor = self.zone.compositor
+        with compositor.condition:
+            if np.array_equal(buffer.pixels, self.pixels):
+                stats.add_suppressed()
+                return
+            self.pixels[:] = buffer.pixels
+            compositor.dirty = True
+            compositor.condition.notify()
+
+class Zone:
+    """A segment of a physical strip, which runs its own task"""
+
+    def __init__(self, name: str, channel: int, start: int, length: int, reverse: bool = False, zigzag: int = 0,
+                 blend: str = "normal", opacity: float = 1.0):
+        if length <= 0 or start < 0:
+            raise ValueError(f"Zone {name}: start must be at least 0 and length more than 0")
+        if zigzag < 0 or (zigzag and length % zigzag):
+            raise ValueError(f"Zone {name}: length must be a whole number of zigzag rows")
+        if blend not in BLEND_MODES:
+            raise ValueError(f"Zone {name}: blend must be one of {', '.join(BLEND_MODES)}")
+        if not 0.0 <= opacity <= 1.0:
+            raise ValueError(f"Zone {name}: opacity must be between 0 and 1")
+        self.name = name
+        self.channel = channel
+        self.start = start
+        self.length = length
+        self.reverse = reverse
+        self.zigzag = zigzag
+        self.blend = blend
+        self.opacity = opacity
+        self.indices = zone_indices(start, length, reverse, zigzag)
+        self.compositor = None
+        self.pixels = None  # part of the compositor's sources, set when the zone is added to it
+        self.layer = None   # the layer of the current task
+        # During a transition: the layer of the old task, and when the old task is retired
+        self.outgoing = None
+        self.transition_start = self.transition_duration = 0.0
+        self.retire = None
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Create a zone from its JSON description (see as_dict)"""
+        try:
+            return cls(str(data["name"]), int(data.get("channel", 0)), int(data.get("start", 0)), int(data["length"]),
+                       bool(data.get("reverse", False)), int(data.get("zigzag", 0)),
+                       data.get("blend", "normal"), float(data.get("opacity", 1.0)))
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Invalid zone {data}: {e}") from e
+
+    def as_dict(self):
+        """JSON description of the zone"""
+        return {"name": self.name, "channel": self.channel, "start": self.start, "length": self.length,
+                "reverse": self.reverse, "zigzag": self.zigzag, "blend": self.blend, "opacity": self.opacity}
+
+    def __len__(self):
+        return self.length
+
+    def start_transition(self, duration: float, retire):
+        """Start cross-fading to a new layer over duration seconds, returns the new layer
+        The current layer keeps being shown underneath, and retire() is called
+        (from the compositor thread) once it is no longer needed. A transition
+        which is still going is cut short, from where it has got to."""
+        with self.compositor.condition:
+            callback = self.finish_transition()
+            # Both sides start from what the zone shows, so a task can fade from it
+            self.outgoing = self.layer
+            self.outgoing.pixels = self.pixels.copy()
+            self.layer = Layer(self, self.pixels.copy())
+            self.transition_start = time.monotonic()
+            self.transition_duration = duration
+            self.retire = retire
+            self.compositor.dirty = True
+            self.compositor.condition.notify()
+        if callback is not None:
+            callback()
+        return self.layer
+
+    def finish_transition(self):
+        """End the transition (with the compositor's lock held), returns the callback which retires the old task"""
+        if self.outgoing is None:
+            return None
+        self.pixels[:] = self.layer.pixels
+        # The new layer draws straight into the compositor's sources again
+        self.layer.pixels = self.pixels
+        callback = self.retire
+        self.outgoing = self.retire = None
+        return callback
+
+    def blend_transition(self, now: float):
+        """Cross-fade the two layers into the zone (with the compositor's lock held)
+        Returns the callback which retires the old task when the transition is over"""
+        alpha = (now - self.transition_start) / self.transition_duration
+        if alpha >= 1.0:
+            return self.finish_transition()
+        self.pixels[:] = blend_pixels("normal", self.outgoing.pixels, self.layer.pixels, alpha)
+        return None
+
+class Compositor:
+    """Combines the frames of all zones, and sends the result to one output stage per physical strip
+
+    The frames of all zones live in one array (sources), with a black row at
+    the end. Where the top layer is an opaque "normal" zone, the pixel just
+    comes from that zone, so for each strip a single index array (worked
+    out when the layout is set) picks every pixel from the right zone in one
+    pass. Only layers which blend with what's below them, and aren't hidden
+    under an opaque zone, need another pass each."""
+
+    def __init__(self, outputs: list, zones: list, fps: float = 100.0):
+        self.outputs = outputs # one OutputStage per physical strip, by channel
+        self.period = 1.0 / fps # time between frames (transitions are blended every frame, even without new frames)
+        self.buffers = [FrameBuffer(len(output.last_frame())) for output in outputs]
+        self.stats = FrameStats()
+        self.condition = threading.Condition()
+        self.dirty = False  # a zone has a frame which hasn't been composited yet
+        self.zones = []
+        self.set_zones(zones)
+        threading.Thread(target=self.composite_frames, daemon=True).start()
+
+    def set_zones(self, zones: list):
+        """Replace the layout (the old zones must not be used any more)
+        Every zone starts from what its part of the strip currently shows"""
+        names = set()
+        for zone in zones:
+            if zone.name in names:
+                raise ValueError(f"Zone {zone.name} is defined twice")
+            names.add(zone.name)
+            if not 0 <= zone.channel < len(self.outputs):
+                raise ValueError(f"Zone {zone.name}: there is no channel {zone.channel}")
+            if zone.start + zone.length > len(self.buffers[zone.channel]):
+                raise ValueError(f"Zone {zone.name}: goes past the end of channel {zone.channel}")
+        total = sum(len(zone) for zone in zones)
+        sources = np.zeros((total + 1, 3), dtype=np.uint16)
+        plans = []
+        for channel, output in enumerate(self.outputs):
+            last = output.last_frame()
+            # Pixels which no zone covers come from the black row
+            top = np.full(len(last), total)
+            blends = []
+            offset = 0
+            for zone in zones:
+                source = np.arange(offset, offset + len(zone))
+                offset += len(zone)
+                if zone.channel != channel:
+                    continue
+                sources[source] = last[zone.indices]
+                if zone.blend == "normal" and zone.opacity == 1.0:
+                    top[zone.indices] = source
+                    # Blending layers underneath are hidden where this zone covers them
+                    visible = []
+                    for blend, opacity, physical, below in blends:
+                        keep = ~np.isin(physical, zone.indices)
+                        if keep.any():
+                            visible.append((blend, opacity, physical[keep], below[keep]))
+                    blends = visible
+                else:
+                    blends.append((zone.blend, zone.opacity, zone.indices, source))
+            plans.append((top, blends))
+        with self.condition:
+            # The old zones' tasks are stopped by the caller, except the ones still to be retired
+            retired = [zone.finish_transition() for zone in self.zones]
+            offset = 0
+            for zone in zones:
+                zone.pixels = sources[offset:offset + len(zone)]
+                zone.layer = Layer(zone, zone.pixels)
+                zone.compositor = self
+                offset += len(zone)
+            self.zones = zones
+            self.sources = sources
+            self.plans = plans
+            self.dirty = True
+            self.condition.notify()
+        for callback in retired:
+            if callback is not None:
+                callback()
+
+    def zone(self, name: str):
+        """Zone by name, or None"""
+        return next((zone for zone in self.zones if zone.name == name), None)
+
+    def transitions(self):
+        """Zones which are in the middle of a transition"""
+        return [zone for zone in self.zones if zone.outgoing is not None]
+
+    def composite(self):
+        """Frame of every physical strip, from the newest frames of the zones"""
+        frames = []
+        for top, blends in self.plans:
+            # np.take is several times faster than indexing with an array, for whole rows
+            frame = np.take(self.sources, top, axis=0)
+            for blend, opacity, physical, source in blends:
+                frame[physical] = blend_pixels(blend, np.take(frame, physical, axis=0), np.take(self.sources, source, axis=0), opacity)
+            frames.append(frame)
+        return frames
+
+    def composite_frames(self):
+        """Compositor thread: whenever a zone has a new frame, composite and send every strip's frame
+        Frames which come in together (from different zones) are composited together"""
+        last_composite = 0.0
+        while True:
+            # At most one frame per period, however many zones (or sides of a transition) send frames
+            time.sleep(max(0.0, last_composite + self.period - time.monotonic()))
+            with self.condition:
+                while not self.dirty and not self.transitions():
+                    self.condition.wait()
+                if not self.dirty:
+                    # Only transitions going on, but the blend still changes every frame
+                    self.condition.wait(self.period)
+                self.dirty = False
+                composite_start = time.perf_counter()
+                now = last_composite = time.monotonic()
+                retired = [zone.blend_transition(now) for zone in self.transitions()]
+                frames = self.composite()
+                self.stats.add_render(time.perf_counter() - composite_start)
+            for callback in retired:
+                if callback is not None:
+                    callback()
+            for output, buffer, frame in zip(self.outputs, self.buffers, frames):
+                buffer.pixels[:] = frame
+                buffer.time = now
+                output.submit(buffer, self.stats)
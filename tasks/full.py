@@ -0,0 +1,38 @@
+from .common import *
+
+PARAMS = {
+    "temperature": {"type": "number", "default": 2500.0, "min": 1000.0, "max": 6600.0, "unit": "K", "label": "Colour temperature"},
+    "brightness": {"type": "number", "default": 1.0, "min": 0.0, "max": 1.0, "label": "Brightness"},
+    "pixels": {"type": "integer", "default": 0, "min": 0, "max": 65535, "label": "Lit pixels from the start (0 for all)"},
+    "duration": {"type": "number", "default": 10.0, "min": 0.0, "max": 3600.0, "unit": "s", "label": "Fade time"},
+    "curve": {"type": "number", "default": 1.0, "min": 0.1, "max": 10.0, "label": "Fade curve"},
+}
+
+PRESETS = {
+    "full1500k": {"temperature": 1500.0},
+    "full2500k": {"temperature": 2500.0},
+    "full3500k": {"temperature": 3500.0},
+    "full6600k": {"temperature": 6600.0},
+    "dim1500k": {"temperature": 1500.0, "brightness": 0.1, "pixels": 240, "curve": 0.5},
+    "dim2500k": {"temperature": 2500.0, "brightness": 0.1, "pixels": 240, "curve": 0.5},
+    "blank": {"brightness": 0.0, "duration": 5.0, "curve": 0.5},
+}
+
+def full(num_pixels: int, params):
+    """Fade to the colour of a black body, on the whole strip or the start of it
+    When the parameters change, it fades again from where it got to"""
+    version = fade = None
+    start = 0.0
+    def render(t, dt, buffer):
+        nonlocal version, fade, start
+        if params.version != version:
+            version = params.version
+            # Not rounded to ints, the output stage dithers the fraction
+            colors = np.clip(black_body_rgb(params["temperature"], params["brightness"]), 0, 255)
+            if 0 < params["pixels"] < num_pixels:
+                # The rest are black
+                colors = np.concatenate([np.broadcast_to(colors, (params["pixels"], 3)), np.zeros((num_pixels - params["pixels"], 3))])
+            fade = fade_to(colors, params["duration"], params["curve"])
+            start = t
+        return fade(t - start, dt, buffer)
+    return render
@@ -0,0 +1,120 @@
+"""Particle system shared by the firefly tasks"""
+from .common import *
+
+class ParticleSystem:
+    """Particles drifting along the strip, stored as one NumPy array per attribute
+
+    The live particles are always the first `count` entries of each array.
+    Every particle fades in over the first half of its life and out over the
+    second half, and is drawn anti-aliased across the two pixels nearest to it."""
+
+    def __init__(self, strip_length: int, hue_fn, max_particles: int = 100,
+                 spawn_rate: float = 10.0, speed_sigma: float = 3.0,
+                 duration_mean: float = 5.0, duration_sigma: float = 3.0, duration_min: float = 2.0,
+                 rng: np.random.Generator = None):
+        self.strip_length = strip_length
+        # hue_fn(rng, n) returns an array of n hues (0-1) for newly spawned particles
+        self.hue_fn = hue_fn
+        self.max_particles = max_particles
+        self.spawn_rate = spawn_rate        # particles per second, on average
+        self.speed_sigma = speed_sigma      # pixels per second
+        self.duration_mean = duration_mean  # seconds
+        self.duration_sigma = duration_sigma
+        self.duration_min = duration_min
+        self.rng = rng or np.random.default_rng()
+        self.count = 0
+        self.position = np.zeros(max_particles)
+        self.speed = np.zeros(max_particles)
+        self.hue = np.zeros(max_particles)
+        self.color = np.zeros((max_particles,3))
+        self.birth = np.zeros(max_particles)
+        self.duration = np.ones(max_particles)
+
+    def spawn(self, num: int, current_time: float):
+        """Add up to num new particles, as long as there is room below max_particles"""
+        num = min(num, self.max_particles - self.count)
+        if num <= 0:
+            return
+        new = slice(self.count, self.count + num)
+        self.position[new] = self.rng.uniform(0, self.strip_length, num)
+        self.speed[new] = self.rng.normal(0, self.speed_sigma, num)
+        self.hue[new] = self.hue_fn(self.rng, num)
+        # The hue never changes, so the full brightness colour is worked out only once
+        self.color[new] = hsv_to_rgb_array(self.hue[new], 1, 1)
+        self.birth[new] = current_time
+        self.duration[new] = np.maximum(self.duration_min, self.rng.normal(self.duration_mean, self.duration_sigma, num))
+        self.count += num
+
+    def advance(self, current_time: float, dt: float):
+        """Move every particle by dt seconds and remove the ones which have expired"""
+        live = slice(0, self.count)
+        alive = (current_time - self.birth[live]) <= self.duration[live]
+        # Compact the surviving particles to the front of the arrays
+        keep = np.flatnonzero(alive)
+        for array in (self.position, self.speed, self.hue, self.color, self.birth, self.duration):
+            array[:len(keep)] = array[keep]
+        self.count = len(keep)
+        live = slice(0, self.count)
+        self.position[live] = (self.position[live] + self.speed[live] * dt) % self.strip_length
+
+    def brightness(self, current_time: float):
+        """Brightness (0-1) of every live particle: ramp up, then ramp down"""
+        live = slice(0, self.count)
+        half_duration = self.duration[live] / 2
+        elapsed_time = current_time - self.birth[live]
+        return np.clip(1 - np.abs(elapsed_time - half_duration) / half_duration, 0, 1)
+
+    def splat(self, pixel_colors, current_time: float):
+        """Add every live particle to an (N,3) float array of pixel colours"""
+        live = slice(0, self.count)
+        pos = self.position[live]
+        int_pos = pos.astype(int) % self.strip_length
+        next_pos = (int_pos + 1) % self.strip_length
+        frac = (pos - int_pos)[:,np.newaxis]
+        color = self.color[live] * self.brightness(current_time)[:,np.newaxis]
+        # np.add.at accumulates particles which land on the same pixel
+        np.add.at(pixel_colors, int_pos, color * (1 - frac))
+        np.add.at(pixel_colors, next_pos, color * frac)
+        return pixel_colors
+
+    def step(self, current_time: float, dt: float):
+        """Spawn new particles and move the existing ones, for a frame lasting dt seconds"""
+        self.spawn(self.rng.poisson(self.spawn_rate * dt), current_time)
+        self.advance(current_time, dt)
+
+def render_particles(particles: ParticleSystem):
+    """Render callback which animates a particle system"""
+    pixel_colors = None
+    def render(t, dt, buffer):
+        nonlocal pixel_colors
+        if pixel_colors is None:
+            pixel_colors = np.zeros((len(buffer),3))
+        particles.step(t, dt)
+        pixel_colors[:] = 0
+        particles.splat(pixel_colors, t)
+        # Clamp the blended colours into the frame
+        buffer.set(pixel_colors)
+        return True
+    return render
+
+def benchmark(counts=(10, 100, 1000), strip_length=360, frames=1000):
+    """Measure CPU time per frame with a fixed number of live particles"""
+    for count in counts:
+        particles = ParticleSystem(strip_length, lambda rng, n: rng.random(n), max_particles=count,
+                                   duration_mean=1e9, duration_min=1e9)
+        particles.spawn(count, 0.0)
+        buffer = FrameBuffer(strip_length)
+        pixel_colors = np.zeros((strip_length,3))
+        start = time.process_time()
+        for frame in range(frames):
+            current_time = frame * 0.01
+            particles.advance(current_time, 0.01)
+            pixel_colors[:] = 0
+            particles.splat(pixel_colors, current_time)
+            buffer.set(pixel_colors)
+            buffer.packed()
+        cpu_time = (time.process_time() - start) / frames
+        print(f"{count:5d} particles: {cpu_time*1e6:8.1f} us CPU per frame")
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,28 +1,18 @@
 from .common import *
 
-def purple(strip: ws.PixelStrip, exit_event: threading.Event, arg = None):
+def purple(num_pixels: int, arg = None):
     t_rate = 0.275
     i_rate = 0.055
-    start_time = time.time()
-    elapsed_time = 0
-    while not exit_event.is_set():
-        for i in range(strip.numPixels()):
-            # Strip has zigzag topology, so loop back every 120 pixels
-            #j = i % 240
-            #if j < 120:
-            #    pos = j
-            #else:
-            #    pos = 240 - j
-            pos = i
-            # hue progresses along the strip (i) and with time (elapsed_time)
-            # saturation and value are always 1 (full)
-            pos = elapsed_time*t_rate+pos*i_rate
-            hue_mean = 0.89
-            hue_var = 0.12
-            hue = hue_mean + hue_var * math.sin(pos)
-            color = hsv_to_rgb(hue,1,1)
-            color_obj = ws.Color(*color)
-            strip.setPixelColor(i,color_obj)
-        strip.show()
-        exit_event.wait(0.1)
-        elapsed_time = time.time() - start_time
+    # Strip has zigzag topology, so loop back every 120 pixels
+    #j = np.arange(num_pixels) % 240
+    #pos = np.where(j < 120, j, 240 - j)
+    pos = np.arange(num_pixels)
+    hue_mean = 0.89
+    hue_var = 0.12
+    def render(t, dt, buffer):
+        # hue progresses along the strip (pos) and with time (t)
+        # saturation and value are always 1 (full)
+        hue = hue_mean + hue_var * np.sin(t*t_rate+pos*i_rate)
+        buffer.set(hsv_to_rgb_array(hue,1,1))
+        return True
+    return render
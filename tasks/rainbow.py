@@ -1,24 +1,24 @@
 from .common import *
 
-def rainbow(strip: ws.PixelStrip, exit_event: threading.Event, arg = None):
-    t_rate = 0.015
-    i_rate = 0.002
-    start_time = time.time()
-    elapsed_time = 0
-    while not exit_event.is_set():
-        for i in range(strip.numPixels()):
-            # Strip has zigzag topology, so loop back every 120 pixels
-            #j = i % 240
-            #if j < 120:
-            #    pos = j
-            #else:
-            #    pos = 240 - j
-            pos = i
-            # hue progresses along the strip (i) and with time (elapsed_time)
-            # saturation and value are always 1 (full)
-            color = hsv_to_rgb(elapsed_time*t_rate+pos*i_rate,1,1)
-            color_obj = ws.Color(*color)
-            strip.setPixelColor(i,color_obj)
-        strip.show()
-        exit_event.wait(0.1)
-        elapsed_time = time.time() - start_time
+PARAMS = {
+    "speed": {"type": "number", "default": 0.015, "min": -1.0, "max": 1.0, "unit": "/s", "label": "Hue cycles per second"},
+    "scale": {"type": "number", "default": 0.002, "min": -0.1, "max": 0.1, "unit": "/pixel", "label": "Hue cycles per pixel"},
+    "fps": {"type": "number", "default": None, "min": 1.0, "max": 200.0, "label": "Frames per second"},
+}
+
+def rainbow(num_pixels: int, params):
+    # Strip has zigzag topology, so loop back every 120 pixels
+    #j = np.arange(num_pixels) % 240
+    #pos = np.where(j < 120, j, 240 - j)
+    pos = np.arange(num_pixels)
+    hue = t_start = 0.0
+    def render(t, dt, buffer):
+        nonlocal hue, t_start
+        # hue progresses along the strip (pos) and with time (t)
+        # (from where it got to, so changing the speed doesn't make it jump)
+        hue = (hue + (t - t_start) * params["speed"]) % 1
+        t_start = t
+        # saturation and value are always 1 (full)
+        buffer.set(hsv_to_rgb_array(hue+pos*params["scale"],1,1))
+        return True
+    return render
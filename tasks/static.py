@@ -1,4 +1,8 @@
 from .common import *
 
-def static(strip: ws.PixelStrip, exit_event: threading.Event, arg = None):
-    fill(strip,arg)
\ No newline at end of file
+PARAMS = {
+    "color": {"type": "color", "default": None, "label": "Colour"},
+}
+
+def static(num_pixels: int, params):
+    return fill_color(params["color"])
@@ -0,0 +1,202 @@
+"""Compiled timelines: deterministic animations rendered ahead of time and played back from disk
+
+A timeline is every distinct frame of an animation, stored as an (F,N,3)
+.npy file of 16-bit levels (like FrameBuffer), or (F,1,3) when every frame
+is a single colour, plus a second .npy file with the time each of those
+frames starts. Both are memory-mapped for playback, so playing a timeline is just
+finding the frame for the current time and copying it into the buffer.
+
+Timelines are cached in TIMELINE_DIR, keyed by task, LED count, frame rate,
+parameters and the source of the task (and of the helpers it renders with),
+so editing a task or changing its parameters compiles a new timeline.
+Timelines compiled from an older source are deleted then, and only the
+TIMELINE_CACHE_SIZE most recently used ones of each task are kept."""
+import contextlib
+import hashlib
+import sys
+from .common import *
+
+# Where compiled timelines are kept
+TIMELINE_DIR = os.environ.get("TIMELINE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "timelines"))
+# Frames per second of animation time stored in a timeline
+TIMELINE_FPS = float(os.environ.get("TIMELINE_FPS", 30))
+# Timelines of each task kept for other LED counts and parameters (like the sunsets from different starting colours)
+TIMELINE_CACHE_SIZE = int(os.environ.get("TIMELINE_CACHE_SIZE", 16))
+
+compile_threads = {} # Background compiles in progress, by cache key
+compile_lock = threading.Lock()
+
+def timeline_key(task: str, num_pixels: int, params, fps: float):
+    """Cache key of a timeline: changes whenever anything the frames depend on changes
+    It's task-LEDs-source-settings, with a hash of the source and one of the frame rate and parameters"""
+    source = hashlib.sha256()
+    for module in (importlib.import_module(f'{__package__}.{task}'), sys.modules[__name__], sys.modules[f'{__package__}.common']):
+        with open(module.__file__, 'rb') as f:
+            source.update(f.read())
+    settings = hashlib.sha256(repr((fps, params)).encode())
+    return f'{task}-{num_pixels}-{source.hexdigest()[:12]}-{settings.hexdigest()[:12]}'
+
+def process_exists(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # someone else's
+    return True
+
+def remove_stale(key: str):
+    """Delete the timelines of the task of key which were compiled from another version of its source, or are
+    beyond the TIMELINE_CACHE_SIZE most recently used ones, and the temporary files of compiles whose process
+    has gone (a compile thread doesn't get to clean up at exit)"""
+    task, _, source, _ = key.split('-')
+    names = os.listdir(TIMELINE_DIR)
+    # Least recently used first, by when their times file was last loaded (see load_timeline)
+    used = []
+    for name in names:
+        if name.startswith(f'{task}-') and name.endswith('.times.npy') and not name.startswith(key):
+            with contextlib.suppress(FileNotFoundError):
+                used.append((os.stat(os.path.join(TIMELINE_DIR, name)).st_mtime, name))
+    used = [name for _, name in sorted(used)]
+    evicted = {name[:-len('.times.npy')] for name in used[:max(0, len(used) + 1 - TIMELINE_CACHE_SIZE)]}
+    for name in names:
+        if name.startswith('.'):
+            # .key.pid.thread.suffix
+            parts = name.split('.')
+            stale = len(parts) > 3 and parts[2].isdigit() and not process_exists(int(parts[2]))
+        else:
+            # (keys from before the source had a hash of its own have three parts)
+            parts = name.split('.')[0].split('-')
+            stale = parts[0] == task and (len(parts) != 4 or parts[2] != source or name.split('.')[0] in evicted)
+        if stale:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(TIMELINE_DIR, name))
+
+def timeline_paths(key: str):
+    """Frames and times files of a timeline"""
+    base = os.path.join(TIMELINE_DIR, key)
+    return base + '.frames.npy', base + '.times.npy'
+
+def load_timeline(key: str):
+    """Memory-map a compiled timeline, returns (times, frames) or None if it isn't in the cache"""
+    frames_path, times_path = timeline_paths(key)
+    # The times file is written last, so if it's there the frames are complete
+    try:
+        timeline = np.load(times_path, mmap_mode='r'), np.load(frames_path, mmap_mode='r')
+        # Marks it as used, for the eviction of the least recently used timelines
+        os.utime(times_path)
+        return timeline
+    except FileNotFoundError:
+        # (or it has just been removed, as stale)
+        return None
+
+def compile_timeline(key: str, num_pixels: int, duration: float, render_factory, fps: float = TIMELINE_FPS):
+    """Render render_factory() for duration seconds at fps, and store the distinct frames as a timeline
+
+    Frames go to a raw file as they are rendered, so a long timeline never
+    has to fit in memory, and are copied into the .npy once the count is known.
+    While every frame is a single colour (like a sunrise), only that colour is
+    kept, and the timeline is stored as (F,1,3)."""
+    os.makedirs(TIMELINE_DIR, exist_ok=True)
+    start = time.perf_counter()
+    frames_path, times_path = timeline_paths(key)
+    # Unique names, in case another process is compiling the same timeline
+    tmp = os.path.join(TIMELINE_DIR, f'.{key}.{os.getpid()}.{threading.get_ident()}')
+    render = render_factory()
+    buffer = FrameBuffer(num_pixels)
+    previous = None
+    times = []
+    colors = [] # the colour of each frame, until a frame has more than one
+    try:
+        with open(tmp + '.raw', 'wb') as raw:
+            for frame in range(math.ceil(duration * fps)):
+                if not render(frame / fps, 1 / fps, buffer):
+                    break
+                # Only keep frames which differ from the one before
+                if previous is not None and np.array_equal(previous, buffer.pixels):
+                    continue
+                times.append(frame / fps)
+                previous = buffer.pixels.copy()
+                if colors is not None and np.all(buffer.pixels == buffer.pixels[0]):
+                    colors.append(previous[0].copy())
+                    continue
+                if colors is not None:
+                    # Not a single colour any more: write out the frames so far in full
+                    for color in colors:
+                        raw.write(np.broadcast_to(color, buffer.pixels.shape).tobytes())
+                    colors = None
+                raw.write(buffer.pixels.tobytes())
+        if colors is not None:
+            np.save(tmp + '.frames.npy', np.array(colors, dtype=buffer.pixels.dtype).reshape(len(times), 1, 3))
+        else:
+            shape = (len(times), num_pixels, 3)
+            frames = np.lib.format.open_memmap(tmp + '.frames.npy', mode='w+', dtype=buffer.pixels.dtype, shape=shape)
+            frames[:] = np.memmap(tmp + '.raw', dtype=buffer.pixels.dtype, mode='r', shape=shape)
+            frames.flush()
+            del frames
+        np.save(tmp + '.times.npy', np.array(times))
+        os.replace(tmp + '.frames.npy', frames_path)
+        os.replace(tmp + '.times.npy', times_path)
+    finally:
+        # Nothing is left behind, even if the compile failed or was interrupted
+        for suffix in ('.raw', '.frames.npy', '.times.npy'):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp + suffix)
+    remove_stale(key)
+    log.info("Compiled timeline %s: %s frames in %.1f s", key, len(times), time.perf_counter() - start)
+
+def start_compile(key: str, num_pixels: int, duration: float, render_factory, fps: float):
+    """Compile a timeline in a background thread, unless it is already being compiled"""
+    with compile_lock:
+        thread = compile_threads.get(key)
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=compile_timeline, args=(key, num_pixels, duration, render_factory, fps), daemon=True)
+            compile_threads[key] = thread
+            thread.start()
+        return thread
+
+def wait_for_compiles():
+    """Wait until every background compile has finished"""
+    with compile_lock:
+        threads = list(compile_threads.values())
+    for thread in threads:
+        thread.join()
+
+def compiled(task: str, num_pixels: int, duration: float, render_factory, params=(), fps: float = TIMELINE_FPS):
+    """Render callback which plays back the compiled timeline of a deterministic animation
+
+    render_factory() must return a new render callback whose frames depend only
+    on t, the number of pixels, params and the source of the task. When there
+    is no timeline for it yet, one is compiled in the background straight away,
+    and the animation is rendered live until it is ready."""
+    key = timeline_key(task, num_pixels, params, fps)
+    timeline = load_timeline(key)
+    thread = live = None
+    if timeline is None:
+        thread = start_compile(key, num_pixels, duration, render_factory, fps)
+        live = render_factory()
+    def render(t, dt, buffer):
+        nonlocal timeline, thread
+        if t >= duration:
+            return False
+        if thread is not None and not thread.is_alive():
+            # Switch to the timeline as soon as it's compiled (and stay live if compiling failed)
+            timeline = load_timeline(key)
+            thread = None
+        if timeline is None:
+            return live(t, dt, buffer)
+        times, frames = timeline
+        if len(times) > 0:
+            buffer.pixels[:] = frames[max(0, np.searchsorted(times, t, side='right') - 1)]
+        return True
+    return render
+
+if __name__ == '__main__':
+    # Compile the timelines of a task ahead of time: python -m tasks.timeline sunrise 300
+    logging.basicConfig(level=logging.INFO)
+    task_name, num_pixels = sys.argv[1], int(sys.argv[2])
+    # With the default parameters (of its preset, if it's one), like the task gets when it's started without any
+    registry = importlib.import_module(__package__).TaskRegistry()
+    registry[task_name](num_pixels, registry.params(task_name))
+    # The task started its compile through tasks.timeline, not this copy of the module (__main__)
+    importlib.import_module(f'{__package__}.timeline').wait_for_compiles()
@@ -0,0 +1,5 @@
+"""The modules under test are at the top of the repository, next to tests/"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
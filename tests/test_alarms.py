@@ -0,0 +1,73 @@
+"""Alarms on a fake clock, fast-forwarded across the 2026 daylight saving time changes"""
+import datetime
+import zoneinfo
+import pytest
+from alarms import Alarm, AlarmScheduler, DAYS
+
+class FakeClock:
+    """Clock which only moves when the test moves it"""
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+def timestamp(timezone: str, *args, fold: int = 0):
+    return datetime.datetime(*args, tzinfo=zoneinfo.ZoneInfo(timezone), fold=fold).timestamp()
+
+def run(timezone: str, alarms: list, start: float, end: float):
+    """Add the alarms at start and fast-forward to end, returns when each alarm fired, by name"""
+    fired = {alarm["name"]: [] for alarm in alarms}
+    clock = FakeClock(start)
+    scheduler = AlarmScheduler(timezone, lambda alarm, when: fired[alarm.name].append(when), clock=clock)
+    for alarm in alarms:
+        scheduler.add(Alarm.from_dict(alarm))
+    while (deadline := scheduler.run_due()) is not None and deadline <= end:
+        clock.now = deadline
+    return fired
+
+# Time zone, the day the clocks go forward and a time they skip, the day they go back and a time which happens twice
+CHANGES = [
+    ("America/New_York", (2026, 3, 8), "02:30", (2026, 11, 1), "01:30"),
+    ("Europe/London", (2026, 3, 29), "01:30", (2026, 10, 25), "01:30"),
+]
+
+@pytest.mark.parametrize("timezone, forward, skipped, back, repeated", CHANGES)
+def test_nonexistent_time(timezone, forward, skipped, back, repeated):
+    """A time skipped when the clocks go forward goes off as long after the change (02:30 becomes 03:30)"""
+    hour, minute = map(int, skipped.split(":"))
+    fired = run(timezone, [{"name": "skipped", "time": skipped, "date": datetime.date(*forward).isoformat()}],
+                timestamp(timezone, *forward) - 86400, timestamp(timezone, *forward) + 86400)
+    assert fired["skipped"] == [timestamp(timezone, *forward, hour + 1, minute)]
+    local = datetime.datetime.fromtimestamp(fired["skipped"][0], zoneinfo.ZoneInfo(timezone))
+    assert (local.hour, local.minute) == (hour + 1, minute)
+
+@pytest.mark.parametrize("timezone, forward, skipped, back, repeated", CHANGES)
+def test_ambiguous_time(timezone, forward, skipped, back, repeated):
+    """A time which happens twice when the clocks go back goes off once, the first time"""
+    hour, minute = map(int, repeated.split(":"))
+    fired = run(timezone, [{"name": "daily", "time": repeated}],
+                timestamp(timezone, *back) - 3600, timestamp(timezone, *back) + 3 * 86400)
+    first, second = timestamp(timezone, *back, hour, minute, fold=0), timestamp(timezone, *back, hour, minute, fold=1)
+    assert second - first == 3600
+    assert first in fired["daily"]
+    assert second not in fired["daily"]
+    # Once a day, at the same time on the wall clock
+    assert len(fired["daily"]) == 3
+    for when in fired["daily"]:
+        local = datetime.datetime.fromtimestamp(when, zoneinfo.ZoneInfo(timezone))
+        assert (local.hour, local.minute) == (hour, minute)
+
+@pytest.mark.parametrize("timezone, forward, skipped, back, repeated", CHANGES)
+@pytest.mark.parametrize("change", ["forward", "back"])
+def test_weekday_repeat(timezone, forward, skipped, back, repeated, change):
+    """An alarm on weekdays keeps its time on the wall clock across the change, and skips the weekend"""
+    day = datetime.date(*(forward if change == "forward" else back))
+    start, end = day - datetime.timedelta(days=7), day + datetime.timedelta(days=7)
+    fired = run(timezone, [{"name": "weekdays", "time": "7:00", "days": DAYS[:5]}],
+                timestamp(timezone, start.year, start.month, start.day), timestamp(timezone, end.year, end.month, end.day))
+    expected = [timestamp(timezone, date.year, date.month, date.day, 7)
+                for date in (start + datetime.timedelta(days=days) for days in range(14)) if date.weekday() < 5]
+    assert fired["weekdays"] == expected
+    # The UTC offset changed in between, so the alarms aren't a whole number of days apart
+    assert len({(when - expected[0]) % 86400 for when in fired["weekdays"]}) == 2
@@ -0,0 +1,24 @@
+"""Preview encoder, with the frame rates and sizes a client may ask for"""
+import struct
+import numpy as np
+import pytest
+from preview import PreviewEncoder, DEFAULT_PREVIEW_FPS, MIN_PREVIEW_FPS, MAX_PREVIEW_FPS, MIN_PREVIEW_PIXELS
+
+FRAME = np.arange(300 * 3, dtype=np.uint32).reshape(-1, 3).astype(np.uint8)
+
+@pytest.mark.parametrize("max_pixels", [0, -5, 1, MIN_PREVIEW_PIXELS])
+def test_too_few_pixels(max_pixels):
+    message = PreviewEncoder(max_pixels=max_pixels).encode(FRAME)
+    assert message[:1] == b"F"
+    assert struct.unpack("<H", message[1:3])[0] == MIN_PREVIEW_PIXELS
+    assert len(message) == 3 + MIN_PREVIEW_PIXELS * 3
+
+def test_more_pixels_than_the_strip():
+    message = PreviewEncoder(max_pixels=10000).encode(FRAME)
+    assert struct.unpack("<H", message[1:3])[0] == len(FRAME)
+
+@pytest.mark.parametrize("fps, expected", [(0.0, MIN_PREVIEW_FPS), (-3.0, MIN_PREVIEW_FPS), (1e9, MAX_PREVIEW_FPS),
+                                           (float("inf"), MAX_PREVIEW_FPS), (float("-inf"), MIN_PREVIEW_FPS),
+                                           (float("nan"), DEFAULT_PREVIEW_FPS), (25.0, 25.0)])
+def test_frame_rate_in_range(fps, expected):
+    assert PreviewEncoder(fps=fps).period == pytest.approx(1.0 / expected)
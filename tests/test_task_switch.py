@@ -0,0 +1,148 @@
+"""Task switching (and the rest of the engine) through the API, against the emulated strip"""
+import os
+import time
+import numpy as np
+import pytest
+
+BURST = 50          # task switches posted one after another
+MAX_P99_MS = 50.0   # a POST only queues the switch, so it must not wait for one
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    """Test client of an app driving the emulated strip, with its files in a directory of its own"""
+    directory = tmp_path_factory.mktemp("neocontrol")
+    cwd = os.getcwd()
+    os.chdir(directory)
+    environ = dict(os.environ)
+    os.environ.update({"TIMELINE_DIR": str(directory / "timelines"), "TASK_POLL_INTERVAL": "0",
+                       "ALARM_LEAD_TIME": "0", "LOG_LEVEL": "WARNING"})
+    try:
+        import neocontrol # pylint: disable=import-outside-toplevel
+        app = neocontrol.create_app()
+        neocontrol.wait_for_hardware()
+        yield app.test_client()
+        # The state is still written after the test (at exit), into this directory
+        neocontrol.store.path = os.path.abspath(neocontrol.store.path)
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        os.chdir(cwd)
+
+def wait_for(client, requests, timeout=10.0):
+    """Statuses of the task requests, once they have all settled (or the timeout is up)"""
+    deadline = time.monotonic() + timeout
+    while True:
+        statuses = [client.get(f"/api/v1/task/{request}").get_json()["status"] for request in requests]
+        if all(status in ("done", "superseded", "failed") for status in statuses) or time.monotonic() > deadline:
+            return statuses
+        time.sleep(0.05)
+
+def test_burst_of_switches(client):
+    tasks = [task for task in client.get("/api/v1/tasks").get_json()["tasks"] if task != "static"]
+    latencies = []
+    requests = []
+    for i in range(BURST):
+        start = time.perf_counter()
+        response = client.post("/api/v1/task", json={"task": tasks[i % len(tasks)], "transition": 0})
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 202
+        requests.append(response.get_json()["id"])
+    p99 = np.percentile(np.array(latencies) * 1000, 99)
+    assert p99 < MAX_P99_MS, f"p99 POST latency {p99:.1f} ms"
+
+    # Every request settles, and only the newest one in the queue is sure to run
+    statuses = wait_for(client, requests)
+    assert statuses[-1] == "done"
+    assert "failed" not in statuses
+    assert client.get("/api/v1/task").get_json()["task"] == tasks[(BURST - 1) % len(tasks)]
+
+@pytest.mark.parametrize("transition", [0, 1.0])
+def test_switch_to_a_task_which_fails_to_load(client, transition):
+    import neocontrol # pylint: disable=import-outside-toplevel
+    request = client.post("/api/v1/task", json={"task": "rainbow", "transition": 0}).get_json()["id"]
+    assert wait_for(client, [request]) == ["done"]
+    zone = neocontrol.default_zone()
+    before = (neocontrol.current_tasks[zone], neocontrol.task_args[zone], neocontrol.exit_events[zone],
+              neocontrol.zone_stats[zone], neocontrol.worker_threads[zone])
+
+    # A task file which raises when it's imported
+    path = os.path.join(neocontrol.TASKS.directory, f"broken_{os.getpid()}.py")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("raise RuntimeError('broken on purpose')\n")
+    try:
+        neocontrol.TASKS.scan()
+        request = client.post("/api/v1/task", json={"task": f"broken_{os.getpid()}", "transition": transition}).get_json()["id"]
+        assert wait_for(client, [request]) == ["failed"]
+    finally:
+        os.remove(path)
+        neocontrol.TASKS.scan()
+
+    # The old task is still the zone's, and still running
+    assert (neocontrol.current_tasks[zone], neocontrol.task_args[zone], neocontrol.exit_events[zone],
+            neocontrol.zone_stats[zone], neocontrol.worker_threads[zone]) == before
+    assert not neocontrol.exit_events[zone].is_set()
+    assert neocontrol.worker_threads[zone].is_alive()
+    assert client.get("/api/v1/task").get_json()["task"] == "rainbow"
+
+def test_new_version_of_a_task(client):
+    import neocontrol # pylint: disable=import-outside-toplevel
+    zone = neocontrol.default_zone()
+    # A task which was asked for switches to the new version
+    request = client.post("/api/v1/task", json={"task": "sunrise", "transition": 0}).get_json()["id"]
+    assert wait_for(client, [request]) == ["done"]
+    neocontrol.tasks_changed({"sunrise"})
+    assert wait_for(client, [max(neocontrol.task_requests)]) == ["done"]
+    assert max(neocontrol.task_requests) > request
+
+    # One an alarm started keeps running (starting it again would start the sunrise over, and save it)
+    with neocontrol.task_lock:
+        neocontrol.switch_task("sunrise", zone=zone, transition=0, alarm_id="test")
+    worker, latest = neocontrol.worker_threads[zone], max(neocontrol.task_requests)
+    neocontrol.tasks_changed({"sunrise"})
+    assert max(neocontrol.task_requests) == latest
+    assert neocontrol.worker_threads[zone] is worker
+    assert neocontrol.alarm_tasks[zone] == "test"
+
+    # Until something else is asked for
+    request = client.post("/api/v1/task", json={"task": "rainbow", "transition": 0}).get_json()["id"]
+    assert wait_for(client, [request]) == ["done"]
+    assert zone not in neocontrol.alarm_tasks
+
+def test_alarms_which_cant_be_read(client):
+    import neocontrol # pylint: disable=import-outside-toplevel
+    scheduler, alarms = neocontrol.scheduler, neocontrol.store.get("alarms")
+    try:
+        neocontrol.store.set("alarms", [{"name": "good", "time": "07:15"}, {"name": "bad", "time": "25:00"},
+                                        {"name": "no time"}, "junk", None])
+        neocontrol.load_alarms()
+        assert [alarm.name for alarm in neocontrol.scheduler.list()] == ["good"]
+        assert [alarm["name"] for alarm in neocontrol.store.get("alarms")] == ["good"]
+    finally:
+        neocontrol.scheduler = scheduler
+        neocontrol.store.set("alarms", alarms)
+
+def test_too_many_event_subscribers(client, monkeypatch):
+    import threading # pylint: disable=import-outside-toplevel
+    import neocontrol # pylint: disable=import-outside-toplevel
+    monkeypatch.setattr(neocontrol, "event_subscribers", threading.BoundedSemaphore(2))
+    streams = [client.get("/api/v1/events", buffered=False) for _ in range(2)]
+    assert [stream.status_code for stream in streams] == [200, 200]
+    refused = client.get("/api/v1/events")
+    assert refused.status_code == 503
+    assert "Retry-After" in refused.headers
+    # A subscriber which goes away makes room for another
+    subscribed = len(neocontrol.event_streams)
+    streams.pop().close()
+    assert len(neocontrol.event_streams) == subscribed - 1
+    streams.append(client.get("/api/v1/events", buffered=False))
+    assert streams[-1].status_code == 200
+    for stream in streams:
+        stream.close()
+    assert neocontrol.event_subscribers.acquire(blocking=False)
+    assert neocontrol.event_subscribers.acquire(blocking=False)
+
+@pytest.mark.parametrize("brightness", [True, False, -1, 256, 12.5, "128", None])
+def test_invalid_brightness(client, brightness):
+    before = client.get("/api/v1/brightness").get_json()
+    assert client.post("/api/v1/brightness", json={"brightness": brightness}).status_code == 400
+    assert client.get("/api/v1/brightness").get_json() == before
@@ -0,0 +1,22 @@
+"""Precompiling timelines from the command line"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_precompile_cli(tmp_path, monkeypatch):
+    result = subprocess.run([sys.executable, "-m", "tasks.timeline", "sunrise", "60"], cwd=ROOT, capture_output=True, text=True,
+                            env={**os.environ, "TIMELINE_DIR": str(tmp_path)}, timeout=120)
+    assert result.returncode == 0, result.stderr
+    assert len(list(tmp_path.glob("sunrise-60-*.times.npy"))) == 1
+    assert not list(tmp_path.glob(".*")), "temporary files left behind"
+
+    # The task, started with its default parameters, plays that timeline instead of compiling one
+    from tasks import TaskRegistry # pylint: disable=import-outside-toplevel
+    from tasks import timeline # pylint: disable=import-outside-toplevel
+    monkeypatch.setattr(timeline, "TIMELINE_DIR", str(tmp_path))
+    registry = TaskRegistry()
+    compiles = dict(timeline.compile_threads)
+    registry["sunrise"](60, registry.params("sunrise"))
+    assert timeline.compile_threads == compiles